@@ -34,9 +34,14 @@
 # This is a class definition for the data object.
 #
 # Each input file is represented as one data object.
-# descriptive_data and xy_pairs are pandas DataFrames
+# descriptive_data is a pandas DataFrame, or the raw header of the file
+# (bytes) which is parsed into a DataFrame the first time 'descriptive'
+# is used (see space_metadata.py), and xy_pairs is a pandas DataFrame
 # filepath is the filepath in form ("ecostress_data_files\\datafile.txt")
 
+from space_metadata import parse_header
+
+
 # linked to functional requirement 3 - preprocessing of data files into data objects
 class DataObject:
     def __init__(self, descriptive_data, xy_pairs, filepath):
@@ -45,5 +50,19 @@ class DataObject:
         self.path = filepath
         self.filename = self.path.split("\\")[-1]
 
+    @property
+    def descriptive(self):
+        if self._descriptive is None:
+            # parse the header the first time it is asked for
+            self._descriptive = parse_header(self.header)
+        return self._descriptive
+
+    @descriptive.setter
+    def descriptive(self, descriptive_data):
+        if isinstance(descriptive_data, bytes):
+            self.header, self._descriptive = descriptive_data, None
+        else:
+            self.header, self._descriptive = None, descriptive_data
+
     def __str__(self):
         return self.path
@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+# 
+# Spectral Analysis Clustering Explorer (SpACE)
+# Missouri State University
+# CSC450 Fall 2020 - Dr. Razib Iqbal
+#
+# Team 2 (FTIR/ECOSTRESS/SpACE team):
+# Austin Alvidrez
+# Brad Meyer
+# Collin Tinen
+# Kegan Moore
+# Sam Nack
+#
+# Copyright 2020 Austin Alvidrez, Brad Meyer, Collin Tinen,
+# Kegan Moore, Sam Nack
+#
+# Spectral Analysis Clustering Explorer (SpACE) is free software:
+# you can redistribute it and/or modify it under the terms of the
+# GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Spectral Analysis Clustering Explorer (SpACE) is distributed in
+# the hope that it will be useful, but WITHOUT ANY WARRANTY;
+# without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Spectral Analysis Clustering Explorer (SpACE).
+# If not, see <https://www.gnu.org/licenses/>.
+
+
+# space_align.py
+# This file contains the alignment engine.
+#
+# Includes: an engine that resamples spectra onto one target wavelength
+# axis with linear interpolation or by averaging over bins, for many
+# spectra at a time, writing the results straight into rows of an
+# output matrix. By default it gives the same numbers as aligning each
+# 'pairs' dataframe to the target with pandas (outer align,
+# interpolate, left align), without the dataframe copies.
+
+import numpy as np
+
+# number of interpolation plans (one per distinct source wavelength
+# axis) kept by an engine before they are thrown away
+MAX_PLANS = 64
+
+
+# linked to functional requirement #6 - data normalization
+class AlignmentEngine:
+    """
+    Resamples spectra onto the target wavelength axis given when the
+    engine is made.
+    By default, like pandas' 'linear' interpolate after an outer align,
+    a target wavelength's value is interpolated by its position in the
+    merged source and target axes. With by_wavelength it is interpolated
+    by wavelength instead (like np.interp), which is what a target axis
+    that does not come from one of the spectra (e.g. a uniform grid)
+    needs. In both cases target wavelengths outside the source take the
+    nearest end value.
+    With bin_average (which implies by_wavelength), each target
+    wavelength is given the mean of the source points in its bin,
+    which reaches halfway to the neighbouring target wavelengths on
+    each side; bins without source points are interpolated.
+    Spectra that share a source wavelength axis share one plan, and
+    are resampled together as one matrix.
+    """
+
+    def __init__(self, wavelengths, by_wavelength=False, bin_average=False):
+        self.wavelengths = np.asarray(wavelengths, dtype=float)
+        self.by_wavelength = by_wavelength or bin_average
+        self.bin_average = bin_average
+        self._plans = {}
+
+    def _plan(self, source_wavelengths):
+        """Returns the plan for a source wavelength axis: a tuple
+        (left, offset, step, before, after, bins). The value at each
+        target wavelength is interpolated from source points left and
+        left + 1, offset and step are the positions used for the slope,
+        and before/after mark target wavelengths before the first and
+        at or after the last source point. bins is None, or a tuple
+        (first, stop, filled) of the source points in each target bin."""
+        key = source_wavelengths.tobytes()
+        plan = self._plans.get(key)
+        if plan is None:
+            if self.by_wavelength:
+                source_positions, target_positions = source_wavelengths, self.wavelengths
+            else:
+                merged = np.union1d(source_wavelengths, self.wavelengths)
+                source_positions = np.searchsorted(merged, source_wavelengths).astype(float)
+                target_positions = np.searchsorted(merged, self.wavelengths).astype(float)
+            left = np.searchsorted(source_positions, target_positions, side='right') - 1
+            left = np.clip(left, 0, max(len(source_positions) - 2, 0))
+            right = np.minimum(left + 1, len(source_positions) - 1)
+            bins = self._bins(source_wavelengths) if self.bin_average else None
+            plan = (left, target_positions - source_positions[left],
+                    source_positions[right] - source_positions[left],
+                    target_positions < source_positions[0], target_positions >= source_positions[-1], bins)
+            if len(self._plans) >= MAX_PLANS:
+                self._plans.clear()
+            self._plans[key] = plan
+        return plan
+
+    def _bins(self, source_wavelengths):
+        """Returns a tuple (first, stop, filled): the range of source
+        points in each target bin, and which bins have any."""
+        if len(self.wavelengths) > 1:
+            middles = (self.wavelengths[1:] + self.wavelengths[:-1]) / 2
+            edges = np.concatenate(([2 * self.wavelengths[0] - middles[0]], middles,
+                                    [2 * self.wavelengths[-1] - middles[-1]]))
+        else:
+            edges = np.array([-np.inf, np.inf])
+        first = np.searchsorted(source_wavelengths, edges[:-1], side='left')
+        stop = np.searchsorted(source_wavelengths, edges[1:], side='left')
+        return first, stop, stop > first
+
+    def align_rows(self, source_wavelengths, rows, out):
+        """
+        Resamples rows (a 2-D array, one spectrum per row, sampled at
+        source_wavelengths) onto the target axis, writing into out
+        (one row per spectrum, one column per target wavelength).
+        Missing values (NaN) in a row are filled from its other points.
+        """
+        source_wavelengths = np.asarray(source_wavelengths, dtype=float)
+        rows = np.asarray(rows, dtype=float)
+        missing = np.isnan(rows).any(axis=1)
+        if missing.any():
+            # rows with missing values have their own set of source points
+            for row in np.flatnonzero(missing):
+                self._align_row_with_missing(source_wavelengths, rows[row], out[row])
+            if missing.all():
+                return
+            complete = ~missing
+            resampled = np.empty((complete.sum(), len(self.wavelengths)))
+            self.align_rows(source_wavelengths, rows[complete], resampled)
+            out[complete] = resampled
+            return
+        left, offset, step, before, after, bins = self._plan(source_wavelengths)
+        if rows.shape[1] < 2:
+            out[...] = rows[:, :1]
+            return
+        # same arithmetic as np.interp, so results match it exactly
+        slope = (rows[:, left + 1] - rows[:, left]) / step
+        np.multiply(slope, offset, out=out)
+        out += rows[:, left]
+        out[:, before] = rows[:, :1]
+        out[:, after] = rows[:, -1:]
+        if bins is not None:
+            first, stop, filled = bins
+            sums = np.zeros((rows.shape[0], rows.shape[1] + 1))
+            np.cumsum(rows, axis=1, out=sums[:, 1:])
+            out[:, filled] = (sums[:, stop[filled]] - sums[:, first[filled]]) / (stop - first)[filled]
+
+    def _align_row_with_missing(self, source_wavelengths, values, out):
+        """Resamples one spectrum that has missing values, using only
+        the points that are there."""
+        present = ~np.isnan(values)
+        if not present.any():
+            out[...] = np.nan
+        elif self.by_wavelength:
+            self.align_rows(source_wavelengths[present], values[present].reshape(1, -1), out.reshape(1, -1))
+        else:
+            # positions still count the missing points, as pandas does
+            merged = np.union1d(source_wavelengths, self.wavelengths)
+            source_positions = np.searchsorted(merged, source_wavelengths[present]).astype(float)
+            target_positions = np.searchsorted(merged, self.wavelengths).astype(float)
+            out[...] = np.interp(target_positions, source_positions, values[present])
+
+    def align_spectra(self, spectra, out):
+        """
+        Resamples a list of spectra, each a tuple (source wavelengths,
+        1-D array of values), onto the target axis, writing spectrum i
+        into row i of out. Spectra with the same source wavelengths are
+        resampled together.
+        """
+        groups = {}
+        for row, (source_wavelengths, _) in enumerate(spectra):
+            groups.setdefault(np.asarray(source_wavelengths, dtype=float).tobytes(), []).append(row)
+        for rows in groups.values():
+            source_wavelengths = np.asarray(spectra[rows[0]][0], dtype=float)
+            values = np.array([spectra[row][1] for row in rows], dtype=float)
+            resampled = np.empty((len(rows), len(self.wavelengths)))
+            self.align_rows(source_wavelengths, values, resampled)
+            out[rows] = resampled
@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+# 
+# Spectral Analysis Clustering Explorer (SpACE)
+# Missouri State University
+# CSC450 Fall 2020 - Dr. Razib Iqbal
+#
+# Team 2 (FTIR/ECOSTRESS/SpACE team):
+# Austin Alvidrez
+# Brad Meyer
+# Collin Tinen
+# Kegan Moore
+# Sam Nack
+#
+# Copyright 2020 Austin Alvidrez, Brad Meyer, Collin Tinen,
+# Kegan Moore, Sam Nack
+#
+# Spectral Analysis Clustering Explorer (SpACE) is free software:
+# you can redistribute it and/or modify it under the terms of the
+# GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Spectral Analysis Clustering Explorer (SpACE) is distributed in
+# the hope that it will be useful, but WITHOUT ANY WARRANTY;
+# without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Spectral Analysis Clustering Explorer (SpACE).
+# If not, see <https://www.gnu.org/licenses/>.
+
+
+# space_cache.py
+# This file contains the on-disk cache of parsed input files.
+#
+# Includes: a cache that stores each parsed ECOSTRESS file (its pairs and
+# raw header) as a compact binary record (.npz) next to a manifest (.json).
+# Records are keyed by the file path, size and modification time, so a
+# file is only parsed again when it is new or has changed. Records are evicted when their
+# source file disappears or when the cache grows beyond a size cap.
+
+import os
+import json
+import time
+import hashlib
+import numpy as np
+import pandas as pd
+from DataObject import DataObject
+
+MANIFEST_FILE = "manifest.json"
+
+
+def default_cache_folder():
+    """
+    Returns the folder the parse cache is kept in by default: a
+    "SpACE" folder in the user's cache folder (%LOCALAPPDATA% on
+    Windows, $XDG_CACHE_HOME or ~/.cache elsewhere), so nothing is
+    written into the input folders. Records are keyed by the absolute
+    path of their file, so one cache serves every input folder.
+    """
+    if os.name == "nt" and os.environ.get("LOCALAPPDATA"):
+        base = os.environ["LOCALAPPDATA"]
+    else:
+        base = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(base, "SpACE", "parse_cache")
+
+
+# linked to functional requirement #3 - preprocessing of data files
+# linked to non-functional requirement #3 - accept up to 2000 files
+class ParseCache:
+    """
+    A cache of parsed DataObjects stored in a folder.
+    Use load() before parsing a file and store() after parsing it,
+    then save() to evict stale records and write the manifest.
+    A file that can't be looked at (e.g. it has disappeared) is treated
+    as not cached, so the parser reports it.
+    hits and misses count the files loaded from the cache and the
+    files that had to be parsed and stored.
+    max_bytes is the size cap for all records together (None = no cap).
+    """
+
+    def __init__(self, folder, max_bytes=None):
+        self.folder = folder
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        # raises OSError if the folder can't be made (e.g. it is read-only)
+        os.makedirs(self.folder, exist_ok=True)
+        self._entries = self._read_manifest()
+
+    def _read_manifest(self):
+        """Returns the manifest entries, or an empty dict if there is
+        no manifest yet or it can't be read."""
+        try:
+            with open(os.path.join(self.folder, MANIFEST_FILE), "r") as file:
+                return json.load(file)["entries"]
+        except (OSError, ValueError, KeyError):
+            return {}
+
+    def contains(self, filename):
+        """Returns True if filename is cached and has not been
+        modified since it was cached."""
+        entry = self._entries.get(os.path.abspath(filename))
+        if entry is None:
+            return False
+        try:
+            stat = os.stat(filename)
+        except OSError:
+            return False
+        return entry["size"] == stat.st_size and entry["mtime"] == stat.st_mtime_ns
+
+    def load(self, filename):
+        """
+        Returns a DataObject for filename from the cache, or None if the
+        file is not cached or was modified after it was cached.
+        """
+        if not self.contains(filename):
+            return None
+        entry = self._entries[os.path.abspath(filename)]
+        try:
+            with np.load(os.path.join(self.folder, entry["record"]), allow_pickle=False) as record:
+                xy_pairs = pd.DataFrame(record["pairs"], columns=list(record["pair_columns"]))
+                header = record["header"].tobytes()
+        except (OSError, ValueError, KeyError):
+            return None
+        entry["used"] = time.time()
+        self.hits += 1
+        return DataObject(header, xy_pairs, filename)
+
+    def store(self, filename, dobj):
+        """Writes the record for a freshly parsed DataObject and adds it
+        to the manifest. Every call counts as a cache miss.
+        If the record can't be written, the file is just not cached."""
+        self.misses += 1
+        key = os.path.abspath(filename)
+        record_name = hashlib.sha1(key.encode("utf-8")).hexdigest() + ".npz"
+        record_path = os.path.join(self.folder, record_name)
+        try:
+            stat = os.stat(filename)
+            # the raw header is stored as it was read, it is parsed when it is used
+            np.savez(record_path,
+                     pairs=dobj.pairs.to_numpy(dtype=float),
+                     pair_columns=np.array(dobj.pairs.columns, dtype=str),
+                     header=np.frombuffer(dobj.header, dtype=np.uint8))
+            record_bytes = os.path.getsize(record_path)
+        except OSError:
+            return
+        self._entries[key] = {"size": stat.st_size,
+                              "mtime": stat.st_mtime_ns,
+                              "record": record_name,
+                              "bytes": record_bytes,
+                              "used": time.time()}
+
+    def evict(self):
+        """
+        Removes records whose source file no longer exists, then the least
+        recently used records until the cache is under max_bytes.
+        """
+        for key in [key for key in self._entries if not os.path.exists(key)]:
+            self._remove(key)
+        if self.max_bytes is not None:
+            total_bytes = sum(entry["bytes"] for entry in self._entries.values())
+            for key in sorted(self._entries, key=lambda k: self._entries[k]["used"]):
+                if total_bytes <= self.max_bytes:
+                    break
+                total_bytes -= self._entries[key]["bytes"]
+                self._remove(key)
+
+    def _remove(self, key):
+        """Deletes one record file and its manifest entry."""
+        record_path = os.path.join(self.folder, self._entries.pop(key)["record"])
+        if os.path.exists(record_path):
+            os.remove(record_path)
+
+    def save(self):
+        """Evicts stale records and writes the manifest."""
+        self.evict()
+        manifest_path = os.path.join(self.folder, MANIFEST_FILE)
+        with open(manifest_path + ".tmp", "w") as file:
+            json.dump({"entries": self._entries}, file)
+        os.replace(manifest_path + ".tmp", manifest_path)
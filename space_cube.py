@@ -0,0 +1,360 @@
+# -*- coding: utf-8 -*-
+# 
+# Spectral Analysis Clustering Explorer (SpACE)
+# Missouri State University
+# CSC450 Fall 2020 - Dr. Razib Iqbal
+#
+# Team 2 (FTIR/ECOSTRESS/SpACE team):
+# Austin Alvidrez
+# Brad Meyer
+# Collin Tinen
+# Kegan Moore
+# Sam Nack
+#
+# Copyright 2020 Austin Alvidrez, Brad Meyer, Collin Tinen,
+# Kegan Moore, Sam Nack
+#
+# Spectral Analysis Clustering Explorer (SpACE) is free software:
+# you can redistribute it and/or modify it under the terms of the
+# GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Spectral Analysis Clustering Explorer (SpACE) is distributed in
+# the hope that it will be useful, but WITHOUT ANY WARRANTY;
+# without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Spectral Analysis Clustering Explorer (SpACE).
+# If not, see <https://www.gnu.org/licenses/>.
+
+
+# space_cube.py
+# This file contains the memory-mapped backend for the combined dataset.
+#
+# Includes: a spectral cube that keeps all aligned spectra in one
+# memory-mapped file (laid out like the spectral block format in
+# space_file_ops.py) instead of an in-memory dataframe, combining data
+# objects into a cube, normalizing the cube in chunks of rows,
+# PCA over the cube (or any block of spectra) in chunks of rows,
+# and the full explained-variance spectrum of a PCA.
+
+import os.path
+import numpy as np
+import pandas as pd
+from sklearn.decomposition import PCA, IncrementalPCA
+import space_file_ops as fileops
+import space_data_ops as dataops
+
+
+# linked to functional requirement #6 - data normalization
+# linked to non-functional requirement #3 - accept up to 2000 files
+class SpectralCube:
+    """
+    An N x M matrix of aligned spectra (one row per spectrum, one column
+    per wavelength) kept in a memory-mapped spectral block file, so only
+    the rows being worked on have to be in memory.
+    Use SpectralCube.create to make a new, empty cube and
+    SpectralCube.open to open one that was saved before.
+    """
+
+    def __init__(self, folder, matrix, wavelengths, table):
+        self.folder = folder
+        self.matrix = matrix
+        self.wavelengths = wavelengths
+        self.table = table
+
+    @classmethod
+    def create(cls, folder, wavelengths, table, dtype=float):
+        """Creates the block files for a cube with one row per table
+        row (see space_file_ops.block_table) and one column per wavelength,
+        and returns the cube."""
+        if not fileops.path_exists(folder):
+            os.makedirs(folder)
+        matrix = np.lib.format.open_memmap(os.path.join(folder, fileops.BLOCK_MATRIX_FILE), mode="w+",
+                                           dtype=dtype, shape=(len(table), len(wavelengths)))
+        np.save(os.path.join(folder, fileops.BLOCK_WAVELENGTH_FILE), wavelengths)
+        table.to_csv(os.path.join(folder, fileops.BLOCK_TABLE_FILE), index=False)
+        return cls(folder, matrix, wavelengths, table)
+
+    @classmethod
+    def open(cls, folder, mmap_mode="r+"):
+        """Opens the cube saved in folder."""
+        return cls(folder, *fileops.load_spectral_block(folder, mmap_mode=mmap_mode))
+
+    @property
+    def shape(self):
+        return self.matrix.shape
+
+    def iter_chunks(self, chunk_rows, min_rows=1):
+        """Yields (start, stop, rows) for consecutive chunks of at most
+        chunk_rows rows (see space_data_ops.iter_row_chunks). rows is a
+        view of the memory-mapped matrix."""
+        return dataops.iter_row_chunks(self.matrix, chunk_rows, min_rows)
+
+    def flush(self):
+        """Writes any changes to the matrix out to disk."""
+        self.matrix.flush()
+
+    def resize(self, table):
+        """Keeps the first len(table) rows of the cube and saves table
+        as its table (see space_file_ops.block_table). If rows are
+        dropped, the matrix file is rewritten in chunks of rows, so any
+        other views of the old matrix have to be let go of first."""
+        rows = len(table)
+        if rows < self.shape[0]:
+            matrix_file = os.path.join(self.folder, fileops.BLOCK_MATRIX_FILE)
+            temp_file = os.path.join(self.folder, "new_" + fileops.BLOCK_MATRIX_FILE)
+            new_matrix = np.lib.format.open_memmap(temp_file, mode="w+", dtype=self.matrix.dtype,
+                                                   shape=(rows, self.shape[1]))
+            for start in range(0, rows, 1024):
+                new_matrix[start:start + 1024] = self.matrix[start:min(start + 1024, rows)]
+            new_matrix.flush()
+            del new_matrix
+            self.matrix = None
+            os.replace(temp_file, matrix_file)
+            self.matrix = np.load(matrix_file, mmap_mode="r+")
+        table.to_csv(os.path.join(self.folder, fileops.BLOCK_TABLE_FILE), index=False)
+        self.table = table
+
+    def as_dataframe(self):
+        """Returns the matrix as a dataframe shaped like the one built by
+        space_data_ops.combine. The dataframe is a view of the
+        memory-mapped matrix, nothing is read into memory."""
+        return pd.DataFrame(self.matrix, columns=pd.Index(self.wavelengths, name='wavelength'), copy=False)
+
+    def data_objects(self):
+        """Returns one DataObject per row, with 'pairs' dataframes that
+        are views of the memory-mapped matrix."""
+        return dataops.block_to_data_objects(self.matrix, self.wavelengths, self.table)
+
+
+# Number of components fitted by incremental_pca on top of the ones
+# asked for. Each chunk only updates the components that are kept, so
+# keeping a few more makes the first ones much closer to an exact PCA
+# (for smooth spectra the error goes from about 1e-4 to rounding error).
+INCREMENTAL_PCA_EXTRA_COMPONENTS = 10
+
+
+# linked to functional requirement #6 - data normalization
+def combine_to_cube(data_objects, folder, dtype=float):
+    """
+    This function takes a list of data objects all sharing a common
+    x axis (i.e., they are already aligned) and writes them all into a
+    new cube in folder, one row per data object.
+    As each row is written, the data object's 'pairs' dataframe is
+    replaced with a view of that row, so the data is not held twice.
+    Returns the cube.
+    """
+    wavelengths = data_objects[0].pairs.index.to_numpy(dtype=float)
+    cube = SpectralCube.create(folder, wavelengths, fileops.block_table(data_objects), dtype)
+    wavelength_index = pd.Index(wavelengths, name='wavelength')
+    for row, dobj in enumerate(data_objects):
+        cube.matrix[row] = dobj.pairs.iloc[:, 0].to_numpy()
+        dobj.pairs = dataops.pairs_view(cube.matrix[row], wavelength_index, dobj.pairs.columns[0])
+    cube.flush()
+    return cube
+
+
+# linked to functional requirement #6 - data normalization
+def normalize_cube(cube, normalization, chunk_rows):
+    """
+    This function normalizes every row of the cube in place with the
+    normalization type named normalization (a key of
+    space_data_ops.NORMALIZATION_TYPES), reading and writing chunk_rows
+    rows at a time.
+    Returns None.
+    """
+    normalize_rows = dataops.NORMALIZATION_TYPES[normalization]
+    if normalize_rows is dataops.no_normalize_rows:
+        # no need to read the whole cube
+        return None
+    for _, _, rows in cube.iter_chunks(chunk_rows):
+        normalize_rows(rows)
+    cube.flush()
+    return None
+
+
+# linked to functional requirement #7 - PCA
+class PCASpectrum:
+    """
+    Every principal component of a block of spectra, from one
+    decomposition: the mean spectrum, the components (one row per
+    component, by decreasing variance) and the variance each of them
+    explains. Reducing the block to any number of dimensions only
+    takes the first components, so it needs no new fit.
+    Use pca_spectrum (in-memory block) or pca_spectrum_cube (cube) to
+    make one.
+    """
+
+    def __init__(self, mean, components, explained_variance):
+        self.mean = mean
+        self.components = components
+        self.explained_variance = explained_variance
+
+    @property
+    def max_dimensions(self):
+        return len(self.explained_variance)
+
+    @property
+    def explained_variance_ratio(self):
+        """The share of the total variance explained by each component."""
+        total = self.explained_variance.sum()
+        if total == 0:
+            # all spectra are the same, there is no variance to explain
+            return np.zeros_like(self.explained_variance)
+        return self.explained_variance / total
+
+    def cumulative_variance(self, dimensions):
+        """Returns the share of the total variance (0 to 1) explained by
+        the first dimensions components."""
+        return float(self.explained_variance_ratio[:dimensions].sum())
+
+    def dimensions_for_variance(self, threshold):
+        """Returns the smallest number of dimensions that explains at
+        least threshold (0 to 1) of the total variance."""
+        if self.explained_variance.sum() == 0:
+            # all spectra are the same, one dimension is as good as any
+            return 1
+        cumulative = np.cumsum(self.explained_variance_ratio)
+        # allow for rounding, so that e.g. a threshold of 1 can be met
+        dimensions = int(np.searchsorted(cumulative, threshold - 1e-9)) + 1
+        return min(dimensions, self.max_dimensions)
+
+    def transform(self, matrix, dimensions, chunk_rows):
+        """Returns the block of spectra matrix (a 2-D array with one
+        spectrum per row, e.g. the block the spectrum was made from)
+        transformed to n-dimensions, chunk_rows rows at a time. The
+        transformed block has the matrix's dtype."""
+        components = self.components[:dimensions].T
+        transformed = np.empty((matrix.shape[0], dimensions), dtype=matrix.dtype)
+        for start, stop, rows in dataops.iter_row_chunks(matrix, chunk_rows):
+            transformed[start:stop] = (rows - self.mean) @ components
+        return pd.DataFrame(transformed)
+
+
+# linked to functional requirement #7 - PCA
+def pca_spectrum(matrix):
+    """
+    This function does a full PCA of a block of spectra in memory (a
+    2-D array with one spectrum per row, e.g. the matrix of an imported
+    library) with one SVD, keeping every component.
+    The block itself is not changed.
+    Returns the PCASpectrum of the block.
+    """
+    model = PCA(svd_solver="full").fit(matrix)
+    return PCASpectrum(model.mean_, model.components_, model.explained_variance_)
+
+
+def _scatter_eigen(cube, chunk_rows):
+    """
+    Returns (mean, eigenvalues, eigenvectors) of the scatter matrix
+    (features x features) of the cube, by decreasing eigenvalue (one
+    eigenvector per column). The mean and the scatter matrix are
+    summed up chunk by chunk, in float64 whatever the cube's dtype.
+    """
+    n_rows, n_features = cube.shape
+    mean = np.zeros(n_features)
+    for _, _, rows in cube.iter_chunks(chunk_rows):
+        mean += rows.sum(axis=0)
+    mean /= n_rows
+    scatter = np.zeros((n_features, n_features))
+    for _, _, rows in cube.iter_chunks(chunk_rows):
+        centered = rows - mean
+        scatter += centered.T @ centered
+    # eigh returns eigenvalues in ascending order, so reverse them
+    eigenvalues, eigenvectors = np.linalg.eigh(scatter)
+    return mean, eigenvalues[::-1], eigenvectors[:, ::-1]
+
+
+def _flip_signs(components):
+    """
+    Flips the signs of components (one per row) the way sklearn's PCA
+    does, so that the largest loading of each component is positive.
+    Returns the components (flipped in place).
+    """
+    largest = np.abs(components).argmax(axis=1)
+    components *= np.sign(components[range(components.shape[0]), largest])[:, np.newaxis]
+    return components
+
+
+# linked to functional requirement #7 - PCA
+def pca_spectrum_cube(cube, chunk_rows):
+    """
+    This function does a full PCA of the cube, reading chunk_rows rows
+    at a time (see pca_cube), keeping every component.
+    The components' signs are flipped the way sklearn's PCA does, so
+    that the largest loading of each component is positive.
+    Returns the PCASpectrum of the cube.
+    """
+    mean, eigenvalues, eigenvectors = _scatter_eigen(cube, chunk_rows)
+    # as many components as sklearn's PCA keeps
+    rank = min(cube.shape)
+    components = _flip_signs(eigenvectors[:, :rank].T)
+    # rounding can leave tiny negative eigenvalues
+    explained_variance = np.clip(eigenvalues[:rank], 0, None) / max(cube.shape[0] - 1, 1)
+    return PCASpectrum(mean, components, explained_variance)
+
+
+# linked to functional requirement #7 - PCA
+def pca_cube(cube, dimensions, chunk_rows):
+    """
+    This function performs PCA dimensionality reduction on the cube to
+    the specified number of dimensions, reading chunk_rows rows at a time
+    so that the cube never has to be in memory.
+    The mean and the scatter matrix (features x features) are summed up
+    chunk by chunk, and the principal components are the eigenvectors
+    of the scatter matrix, which gives the same result as a full SVD
+    of the whole block. The components' signs are flipped the way
+    sklearn's PCA does (see pca_spectrum_cube).
+    The sums are kept in float64 whatever the cube's dtype, and the
+    transformed block has the cube's dtype.
+    Returns a tuple (the data block transformed to n-dimensions (in memory), "")
+    on success, or (None, error message) if the cube cannot be reduced
+    to that many dimensions.
+    """
+    error = dataops.pca_dimensions_error(cube.shape, dimensions)
+    if error:
+        return None, error
+    mean, _, eigenvectors = _scatter_eigen(cube, chunk_rows)
+    # signs flipped as in pca_spectrum_cube, so both give the same result
+    components = _flip_signs(eigenvectors[:, :dimensions].T).T
+    transformed = np.empty((cube.shape[0], dimensions), dtype=cube.matrix.dtype)
+    for start, stop, rows in cube.iter_chunks(chunk_rows):
+        transformed[start:stop] = (rows - mean) @ components
+    return pd.DataFrame(transformed), ""
+
+
+# linked to functional requirement #7 - PCA
+def incremental_pca(matrix, dimensions, chunk_rows):
+    """
+    This function performs PCA dimensionality reduction on a block of
+    spectra (a 2-D array with one spectrum per row, e.g. a cube's
+    memory-mapped matrix or the matrix of an imported library) to the
+    specified number of dimensions with an incremental PCA: the
+    components are fitted one chunk of chunk_rows rows at a time, then
+    the block is transformed chunk by chunk. Only one chunk is read into
+    memory at a time, and nothing is kept per wavelength but the
+    components, so the block can be bigger than memory. Unlike
+    pca_cube, the result is an approximation of PCA, not an exact one;
+    a few more components than asked for are fitted (see
+    INCREMENTAL_PCA_EXTRA_COMPONENTS) to keep it close.
+    The block itself is not changed.
+    Returns a tuple (the data block transformed to n-dimensions (in memory), "")
+    on success, or (None, error message) if the block cannot be reduced
+    to that many dimensions.
+    """
+    error = dataops.pca_dimensions_error(matrix.shape, dimensions)
+    if error:
+        return None, error
+    components = max(dimensions, min(dimensions + INCREMENTAL_PCA_EXTRA_COMPONENTS, *matrix.shape))
+    model = IncrementalPCA(n_components=components)
+    # every chunk needs at least as many rows as there are components
+    for _, _, rows in dataops.iter_row_chunks(matrix, chunk_rows, components):
+        model.partial_fit(rows)
+    transformed = np.empty((matrix.shape[0], dimensions), dtype=matrix.dtype)
+    for start, stop, rows in dataops.iter_row_chunks(matrix, chunk_rows, components):
+        transformed[start:stop] = model.transform(rows)[:, :dimensions]
+    return pd.DataFrame(transformed), ""
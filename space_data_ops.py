@@ -40,116 +40,355 @@
 # with interpolation, normalization, principal component analysis (PCA)
 # dimensionality reduction, combine dataframes.
 
+import csv
+import os
+from io import StringIO
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
 import pandas as pd
 import numpy as np
 from DataObject import DataObject
-from sklearn import preprocessing
+from space_align import AlignmentEngine
+from space_metadata import header_field
 from sklearn.decomposition import PCA
-from scipy.stats import zscore
-
-# columns include overflow for extra ":" characters found in the description field
-columns = ['descriptor', 'value', 'overflow', 'overflow2', 'overflow3']
-
+from scipy.sparse.linalg import ArpackError
 
 # linked to functional requirement #3 - preprocessing of data files
-def file_to_data_object(file_list):
+def file_to_data_object(file_list, cache=None):
     """
     Function: File to DataObject
-    Description: This function takes a list of files (files variable above) and converts them to two pandas
-    DataFrames, one of descriptive data, and one of float values for the xy_pairs. The DataFrames are used as
-    parameters to construct a DataObject. The function then returns an array of each file as a DataObject.
+    Description: This function takes a list of files (files variable above) and converts them to the raw
+    header (descriptive data, parsed when it is first used) and a pandas DataFrame of float values for the
+    xy_pairs. These are used as parameters to construct a DataObject. The function then returns an array of each file as a DataObject.
+    Parsing of the individual files is done by parse_spectrum_file.
+    If a ParseCache (see space_cache.py) is given, files that are already in the
+    cache are loaded from it and only new or modified files are parsed.
     Returns: DataObjects array
     """
     DataObjects = []
-    # DataFrame conversion - one DF for descriptive data, and one DF for the (x, y) pairs
     for item in file_list:
-        data = pd.read_csv(item, sep=":", header=None, engine="python", names=columns, quotechar='"')
-
-        pairs, pair_index, desc_index = [], 0, 0
-        # the first column contains both the pairs and the labels for descriptive data
-        first_col = data['descriptor']
-        # search every row in the first column for \t
-        for value in first_col:
-            # find the index where xy_pairs begin
-            # I noticed that all the pairs contain tabs, so search each file for the first occurrence of \t
-            if "\t" in value and len(value.split("\t")) == 2:
-                for val in value.split("\t"):
-                    try:
-                        float(val)
-                    except ValueError:
-                        return [], f"{item} contains an invalid or missing value at numerical pair: {value}"
-                pairs.append(value.split("\t"))
-                if pair_index == 0:
-                    pair_index = first_col[first_col == value].index[0]
-            # find the index for the description field for description processing below
-            elif "Description" in value:
-                desc_index = first_col[first_col == "Description"].index[0]
-
-        # convert pairs to DataFrame, with column labels for given X Units and Y Units
-        if pair_index != 0:
-            descriptive_data = data.head(pair_index)
-            # find index of "X Units" and "Y Units" to find unit labels
-            x_units = first_col[first_col == "X Units"].index[0]
-            y_units = first_col[first_col == "Y Units"].index[0]
-            xy_pairs = pd.DataFrame(pairs,
-                                    columns=[descriptive_data.loc[x_units, 'value'],
-                                             descriptive_data.loc[y_units, 'value']])
-        # throw an error if the pair_index is zero (means that "\t" was not found in the file)
-        else:
-            descriptive_data = data
-            return [], f"Numerical coordinate pairs could not found for {item}"
-
-        # Description Processing: for DataFrame conversion, overflow columns were needed
-        # for the descriptions of each spectra, the code below removes the overflow.
-
-        # Make a copy, this is recommended by pandas documentation for modifying individual cells
-        descriptive_copy = descriptive_data.copy()
-        # if overflow is nan, drop overflow columns
-        if pd.isna(descriptive_data.loc[desc_index, 'overflow']):
-            descriptive_data = descriptive_data.dropna(axis=1)
-
-        # if overflow2 is nan, combine value and overflow for description, and drop overflow columns
-        elif pd.isna(descriptive_data.loc[desc_index, 'overflow2']):
-            combine_string = ': ' + descriptive_data.loc[desc_index, 'overflow']
-            descriptive_copy.loc[desc_index, 'value'] = descriptive_data.loc[desc_index, 'value'] + combine_string
-            descriptive_data = descriptive_copy.drop(['overflow', 'overflow2', 'overflow3'], axis=1)
-
-        # if overflow3 is nan, combine value and overflow1 and 2 for description, and drop overflow columns
-        elif pd.isna(descriptive_data.loc[desc_index, 'overflow3']):
-            combine_string = ': ' + descriptive_data.loc[desc_index, 'overflow'] + ': ' + \
-                             descriptive_data.loc[desc_index, 'overflow2']
-            descriptive_copy.loc[desc_index, 'value'] = descriptive_data.loc[desc_index, 'value'] + combine_string
-            descriptive_data = descriptive_copy.drop(['overflow', 'overflow2', 'overflow3'], axis=1)
-
-        # else combine all overflow columns with value, and drop overflow columns
-        else:
-            combine_string = ': ' + descriptive_data.loc[desc_index, 'overflow'] + ': ' + \
-                             descriptive_data.loc[desc_index, 'overflow2'] + ': ' + \
-                             descriptive_data.loc[desc_index, 'overflow3']
-            descriptive_copy.loc[desc_index, 'value'] = descriptive_data.loc[desc_index, 'value'] + combine_string
-            descriptive_data = descriptive_copy.drop(['overflow', 'overflow2', 'overflow3'], axis=1)
-
-        # DataFrame values are initially typed as objects, code below is conversion to workable data types
-        # convert descriptive data to strings
-        descriptive_data = descriptive_data.convert_dtypes(convert_string=True)
-        # convert xy_pairs to floats
-        xy_pairs[xy_pairs.columns[0]] = xy_pairs[xy_pairs.columns[0]].astype(float)
-        xy_pairs[xy_pairs.columns[1]] = xy_pairs[xy_pairs.columns[1]].astype(float)
-        # construct DataObject with DataFrames and filepath (may want more parameters later)
-        processed_item = DataObject(descriptive_data, xy_pairs, item)
+        processed_item = cache.load(item) if cache is not None else None
+        if processed_item is None:
+            processed_item, return_msg = parse_spectrum_file(item)
+            if processed_item is None:
+                return [], return_msg
+            if cache is not None:
+                cache.store(item, processed_item)
         DataObjects.append(processed_item)
 
+    if cache is not None:
+        cache.save()
     return DataObjects, ""
 
-def aligned_file_to_data_object(file_list):
+
+# linked to functional requirement #3 - preprocessing of data files
+def parse_spectrum_file(item, x_range=None):
+    """
+    This function takes the path of one ECOSTRESS spectrum file and
+    converts it into a DataObject.
+    The file is read once, the line where the xy_pairs begin is located
+    with a single scan of the header, and the numerical block below it is
+    handed to the pandas C parser in one call. Only if that fast read does
+    not produce a clean two column block of floats (missing values, stray
+    lines, etc.) is the block scanned line by line, so that the error
+    message names the offending pair.
+    If x_range (a tuple (min, max)) is given, only the pairs with an x
+    value from min to max are kept, like truncate would.
+    Only the X Units and Y Units fields are read from the header; the
+    DataObject keeps the raw header and parses the rest of it only when
+    its descriptive data is asked for (see space_metadata.py).
+    Returns a tuple (DataObject, "") on success, or (None, error message).
+    """
+    with open(item, "r", encoding="utf-8") as file:
+        text = file.read()
+
+    pair_start = _find_pairs_start(text)
+    header_text = text[:pair_start] if pair_start != -1 else text
+    # throw an error if there is no header above the pairs, or no pairs at all
+    # ("\t" was not found in the file)
+    if pair_start == -1 or header_text.strip() == "":
+        return None, f"Numerical coordinate pairs could not found for {item}"
+
+    xy_values = _read_pairs_block(text[pair_start:])
+    if xy_values is None:
+        xy_values, return_msg = _scan_pairs_block(text[pair_start:], item)
+        if xy_values is None:
+            return None, return_msg
+    if x_range is not None:
+        xy_values = xy_values[(xy_values[:, 0] >= x_range[0]) & (xy_values[:, 0] <= x_range[1])]
+
+    # unit labels
+    x_units = header_field(header_text, "X Units")
+    y_units = header_field(header_text, "Y Units")
+    if x_units is None or y_units is None:
+        return None, f"X Units or Y Units could not be found in the header of {item}"
+    xy_pairs = pd.DataFrame(xy_values, columns=[x_units, y_units])
+    return DataObject(header_text.encode("utf-8"), xy_pairs, item), ""
+
+
+# linked to functional requirement #3 - preprocessing of data files
+# linked to non-functional requirement #3 - accept up to 2000 files
+def parallel_file_to_data_object(file_list, workers=None, chunk_size=None, cache=None, x_range=None):
+    """
+    This function does the same work as file_to_data_object, but the
+    files are parsed by a pool of worker processes (see iter_parse,
+    also for x_range).
+    Files that can't be parsed don't stop the import; their error
+    messages are collected into a report instead.
+    Returns a tuple (DataObjects array in the same order as file_list,
+    list of error messages).
+    """
+    error_report = []
+    DataObjects = list(iter_parse(file_list, error_report, workers, chunk_size, cache, x_range))
+    return DataObjects, error_report
+
+
+# linked to functional requirement #3 - preprocessing of data files
+# linked to non-functional requirement #3 - accept up to 2000 files
+def iter_parse(file_list, error_report, workers=None, chunk_size=None, cache=None, x_range=None):
+    """
+    Pipeline stage: parses the files in file_list and yields one
+    DataObject at a time, in the same order as file_list.
+    workers is the number of processes (None means one per CPU core,
+    1 means parse in this process without a pool).
+    chunk_size is the number of files sent to a worker at a time
+    (None means the list is split into about four chunks per worker).
+    If a ParseCache is given, only the files missing from it are parsed.
+    If x_range (a tuple (min, max), e.g. from find_prescan_range) is
+    given, only the pairs with an x value in that range are kept.
+    Files going into the cache are still parsed whole, so that their
+    record can be used with any range.
+    The error message of every file that can't be parsed is appended
+    to error_report and the file is skipped.
+    """
+    is_cached = [cache is not None and cache.contains(item) for item in file_list]
+    parse_list = [item for item, cached in zip(file_list, is_cached) if not cached]
+    if workers is None:
+        workers = os.cpu_count() or 1
+    workers = max(1, min(workers, len(parse_list)))
+    if chunk_size is None:
+        chunk_size = max(1, len(parse_list) // (workers * 4))
+    executor = ProcessPoolExecutor(max_workers=workers) if workers > 1 else None
+    parse = partial(_parse_spectrum_file_for_report, x_range=x_range if cache is None else None)
+    try:
+        # map hands results back in the order of parse_list, as they become available
+        if executor is not None:
+            results = executor.map(parse, parse_list, chunksize=chunk_size)
+        else:
+            results = map(parse, parse_list)
+        for item, cached in zip(file_list, is_cached):
+            processed_item = cache.load(item) if cached else None
+            if processed_item is None:
+                # parse files that are not cached, or whose cached record could not be read
+                processed_item, return_msg = next(results) if not cached else parse(item)
+                if processed_item is None:
+                    error_report.append(return_msg)
+                    continue
+                if cache is not None:
+                    cache.store(item, processed_item)
+            if cache is not None and x_range is not None:
+                processed_item.pairs = _restrict_pairs(processed_item.pairs, x_range)
+            yield processed_item
+    finally:
+        if executor is not None:
+            executor.shutdown()
+    if cache is not None:
+        cache.save()
+
+
+def _parse_spectrum_file_for_report(item, x_range=None):
+    """
+    Wraps parse_spectrum_file for iter_parse so that an
+    unexpected exception in one file becomes an entry in the error report.
+    Must stay a module level function so it can be sent to worker processes.
+    """
+    try:
+        return parse_spectrum_file(item, x_range)
+    except Exception as e:
+        return None, f"{item} could not be loaded: {e}"
+
+
+def _restrict_pairs(xy_pairs, x_range):
+    """Returns the rows of a parsed (not yet re-indexed) 'pairs' dataframe
+    with an x value in x_range, numbered from 0 like a fresh parse."""
+    x_values = xy_pairs.iloc[:, 0]
+    return xy_pairs[(x_values >= x_range[0]) & (x_values <= x_range[1])].reset_index(drop=True)
+
+
+def drop_out_of_range(data_objects, x_range, error_report):
+    """
+    Takes a list of re-indexed data objects parsed with x_range (see
+    iter_parse) and returns the ones that have data in that range.
+    The others are reported in error_report.
+    """
+    return list(iter_drop_out_of_range(data_objects, x_range, error_report))
+
+
+def iter_drop_out_of_range(data_objects, x_range, error_report):
+    """
+    Pipeline stage for drop_out_of_range: yields the data objects that
+    have data in x_range and reports the others in error_report.
+    """
+    for dobj in data_objects:
+        if dobj.pairs.empty:
+            error_report.append(f"{dobj.path} has no data in the common range {x_range[0]} to {x_range[1]}")
+        else:
+            yield dobj
+
+
+# ECOSTRESS header fields read by prescan_header
+PRESCAN_FIELDS = ("First X Value", "Last X Value", "Number of X Values")
+
+
+# linked to functional requirement #3 - preprocessing of data files
+def prescan_header(item):
+    """
+    Reads only the header of one ECOSTRESS spectrum file, stopping at
+    the first numerical pair, and gets the range of x values from its
+    First X Value, Last X Value and Number of X Values fields.
+    Returns a tuple ((lowest x, highest x, number of x values), "")
+    on success, or (None, error message).
+    """
+    fields = {}
+    try:
+        with open(item, "r", encoding="utf-8") as file:
+            for line in file:
+                descriptor = line.split(":", 1)[0]
+                # same test for the first pair as _find_pairs_start
+                if descriptor.count("\t") == 1:
+                    break
+                if descriptor in PRESCAN_FIELDS:
+                    fields[descriptor] = line.split(":", 1)[1].strip()
+    except (OSError, UnicodeDecodeError) as e:
+        return None, f"{item} could not be loaded: {e}"
+    try:
+        first_x, last_x = float(fields["First X Value"]), float(fields["Last X Value"])
+        count = int(fields["Number of X Values"])
+    except (KeyError, ValueError):
+        return None, f"{item} has no usable {', '.join(PRESCAN_FIELDS)} in its header"
+    return (min(first_x, last_x), max(first_x, last_x), count), ""
+
+
+# linked to functional requirement #3 - preprocessing of data files
+# linked to functional requirement #6 - data normalization
+def find_prescan_range(header_ranges):
+    """
+    This function takes the header ranges returned by prescan_header
+    for a list of files and finds their common range, the same way
+    find_common_range does for parsed data objects.
+    If there is no range in common, the files that have no overlap with
+    the range covered by most of the others are rejected, and the
+    common range of the rest is found instead.
+    Returns a tuple (min, max, list of the indexes of the rejected
+    files), with (None, None) for min and max if there is still no
+    range in common.
+    """
+    lows = np.array([low for low, _, _ in header_ranges])
+    highs = np.array([high for _, high, _ in header_ranges])
+    rejected = []
+    if lows.max() >= highs.min():
+        no_overlap = (lows >= np.median(highs)) | (highs <= np.median(lows))
+        rejected = [int(index) for index in np.flatnonzero(no_overlap)]
+        lows, highs = lows[~no_overlap], highs[~no_overlap]
+    if len(lows) > 0 and lows.max() < highs.min():
+        return lows.max(), highs.min(), rejected
+    return None, None, rejected
+
+
+def _find_pairs_start(text):
+    """
+    Returns the character offset of the first line whose first field
+    (everything before the first ":") holds exactly one tab, i.e. the
+    first numerical pair. Returns -1 if there is no such line.
+    """
+    line_start = 0
+    while line_start < len(text):
+        line_end = text.find("\n", line_start)
+        if line_end == -1:
+            line_end = len(text)
+        if text[line_start:line_end].split(":", 1)[0].count("\t") == 1:
+            return line_start
+        line_start = line_end + 1
+    return -1
+
+
+def _read_pairs_block(pairs_text):
+    """
+    Reads a block of tab separated (x, y) pairs with the pandas C parser.
+    Returns an n x 2 float array, or None if the block is not a clean
+    two column block of floats.
+    """
+    try:
+        xy_values = pd.read_csv(StringIO(pairs_text), sep="\t", header=None, engine="c",
+                                dtype=float, na_filter=False, quoting=csv.QUOTE_NONE).to_numpy()
+    except ValueError:
+        return None
+    if xy_values.ndim != 2 or xy_values.shape[1] != 2 or np.isnan(xy_values).any():
+        return None
+    return xy_values
+
+
+def _scan_pairs_block(pairs_text, item):
+    """
+    Slow path for blocks that _read_pairs_block could not read.
+    Every line containing exactly one tab is a pair, and both of its
+    values must be floats, other lines are skipped.
+    Returns a tuple (n x 2 float array, "") or (None, error message).
+    """
+    pairs = []
+    for line in pairs_text.splitlines():
+        value = line.split(":", 1)[0]
+        if "\t" in value and len(value.split("\t")) == 2:
+            try:
+                pairs.append([float(val) for val in value.split("\t")])
+            except ValueError:
+                return None, f"{item} contains an invalid or missing value at numerical pair: {value}"
+    return np.array(pairs, dtype=float).reshape(-1, 2), ""
+
+
+def block_to_data_objects(matrix, wavelengths, table):
+    """
+    This function takes a spectral block as returned by
+    space_file_ops.load_spectral_block and converts each row into a
+    DataObject whose 'pairs' dataframe is indexed by 'wavelength'
+    (like after reindex and align).
+    The 'pairs' dataframes are views of the matrix rows, nothing is copied.
+    Returns: DataObjects array
+    """
+    wavelength_index = pd.Index(wavelengths, name='wavelength')
     Data_Objects = []
-    for file_name in file_list:
-        xy_pairs = pd.read_csv(file_name,index_col=0)
-        xy_pairs[xy_pairs.columns[0]] = xy_pairs[xy_pairs.columns[0]].astype(float)
-        obj = DataObject("None", xy_pairs, file_name)
-        Data_Objects.append(obj)
+    for row, (path, y_units) in enumerate(zip(table['path'], table['y_units'])):
+        Data_Objects.append(DataObject("None", pairs_view(matrix[row], wavelength_index, y_units), path))
     return Data_Objects
 
+
+def iter_row_chunks(matrix, chunk_rows, min_rows=1):
+    """
+    Yields (start, stop, rows) for consecutive chunks of at most
+    chunk_rows rows of a 2-D array (in memory or memory-mapped), except
+    that a last chunk of fewer than min_rows rows is joined to the chunk
+    before it. rows is a view of the array.
+    """
+    n_rows = matrix.shape[0]
+    chunk_rows = max(chunk_rows, min_rows)
+    start = 0
+    while start < n_rows:
+        stop = min(start + chunk_rows, n_rows)
+        if n_rows - stop < min_rows:
+            stop = n_rows
+        yield start, stop, matrix[start:stop]
+        start = stop
+
+
+def pairs_view(values, wavelength_index, column_name):
+    """
+    Wraps one row of a block (a 1-D array of y values) in a 'pairs'
+    dataframe indexed by wavelength, without copying the row.
+    Returns the dataframe.
+    """
+    return pd.DataFrame(values.reshape(-1, 1), index=wavelength_index, columns=[column_name], copy=False)
+
+
 # linked to functional requirement #6 - data normalization
 def reindex(data_objects):
     """
@@ -162,13 +401,23 @@ def reindex(data_objects):
     The ' Wavelength (micrometers)' column is renamed 'wavelength'.
     Dataframes are modified in-place, so None is returned.
     """
+    for _ in iter_reindex(data_objects):
+        pass
+    return None
+
+
+def iter_reindex(data_objects):
+    """
+    Pipeline stage for reindex: re-indexes the 'pairs' dataframe
+    of each data object in place and yields the data object.
+    """
     for dobj in data_objects:
         dataframe = dobj.pairs
         wavelength_col_name = dataframe.columns[0]
         dataframe.rename(columns={wavelength_col_name: 'wavelength'}, inplace=True)
         dataframe.set_index('wavelength', inplace=True)
         dataframe.sort_index(inplace=True)
-    return None
+        yield dobj
 
 
 # linked to functional requirement #6 - data normalization
@@ -207,11 +456,22 @@ def truncate(data_objects, min, max):
     constructed and then the DataObject 'pairs' dataframe is replaced
     with the new dataframe. Returns None.
     """
+    for _ in iter_truncate(data_objects, min, max):
+        pass
+    return None
+
+
+def iter_truncate(data_objects, min, max):
+    """
+    Pipeline stage for truncate: replaces the 'pairs' dataframe of each
+    data object with a copy truncated to 'min' to 'max' and yields the
+    data object.
+    """
     for dobj in data_objects:
         original_dataframe = dobj.pairs
         truncated_dataframe = original_dataframe.truncate(before=min, after=max, axis='index', copy=True)
         dobj.pairs = truncated_dataframe
-    return None
+        yield dobj
 
 
 # linked to functional requirement #6 - data normalization
@@ -232,7 +492,7 @@ def find_max_res(data_objects):
 
 
 # linked to functional requirement #6 - data normalization
-def align(data_objects, align_to):
+def align(data_objects, align_to, dtype=float):
     """
     This function takes a list of data objects, iterates over them,
     and makes every 'pairs' dataframe use the same x axis by aligning
@@ -240,83 +500,287 @@ def align(data_objects, align_to):
     The result is that all 'pairs' dataframes will use the same x
     axis and thus be aligned.  This will then fill in any missing
     values caused by the alignment using linear interpolation.
+    All spectra are resampled into one matrix by the alignment engine
+    (see space_align.py), and each 'pairs' dataframe becomes a view
+    of its row. The matrix has the given dtype (see PRECISION_TYPES).
     """
-    alignment_pairs = data_objects[align_to].pairs
-    for dobj in data_objects:
-        (_, dobj.pairs) = alignment_pairs.align(dobj.pairs, join="outer", axis=0)
-        dobj.pairs = dobj.pairs.interpolate(limit_direction='both')
-        (_, dobj.pairs) = alignment_pairs.align(dobj.pairs, join="left", axis=0)
+    wavelength_index = data_objects[align_to].pairs.index
+    _align_into_matrix(data_objects, wavelength_index, AlignmentEngine(wavelength_index.to_numpy(dtype=float)),
+                       dtype)
     return None
 
 
 # linked to functional requirement #6 - data normalization
-def combine(data_objects):
+def align_to_grid(data_objects, wavelengths, bin_average=False, dtype=float):
+    """
+    This function takes a list of data objects and makes every 'pairs'
+    dataframe use the wavelengths given (e.g. a uniform grid from
+    ALIGNMENT_TARGETS) as its x axis, interpolating by wavelength, or
+    averaging the points around each wavelength if bin_average is True.
+    Each 'pairs' dataframe becomes a view of its row of one matrix of
+    the given dtype.
+    """
+    _align_into_matrix(data_objects, pd.Index(wavelengths, name='wavelength'),
+                       AlignmentEngine(wavelengths, by_wavelength=True, bin_average=bin_average), dtype)
+    return None
+
+
+def _align_into_matrix(data_objects, wavelength_index, engine, dtype=float):
+    """Resamples every data object into a row of one matrix of the given
+    dtype with engine, and replaces each 'pairs' dataframe with a view
+    of its row."""
+    matrix = np.empty((len(data_objects), len(wavelength_index)), dtype=dtype)
+    engine.align_spectra([(dobj.pairs.index.to_numpy(dtype=float), dobj.pairs.iloc[:, 0].to_numpy(dtype=float))
+                          for dobj in data_objects], matrix)
+    for row, dobj in enumerate(data_objects):
+        dobj.pairs = pairs_view(matrix[row], wavelength_index, dobj.pairs.columns[0])
+
+
+def iter_align(data_objects, alignment_pairs, out=None, engine=None, dtype=float):
+    """
+    Pipeline stage for align: resamples the 'pairs' dataframe of each
+    data object onto the index of the alignment_pairs dataframe with
+    the alignment engine (see space_align.py), by default the same way
+    align does, and yields the data object.
+    If out is given, data object i is written into row i of out and its
+    'pairs' dataframe becomes a view of that row, otherwise the
+    resampled values have the given dtype.
+    """
+    wavelength_index = alignment_pairs.index
+    if engine is None:
+        engine = AlignmentEngine(wavelength_index.to_numpy(dtype=float))
+    for row, dobj in enumerate(data_objects):
+        values = np.empty(len(wavelength_index), dtype=dtype) if out is None else out[row]
+        engine.align_rows(dobj.pairs.index.to_numpy(dtype=float),
+                          dobj.pairs.iloc[:, 0].to_numpy(dtype=float).reshape(1, -1), values.reshape(1, -1))
+        dobj.pairs = pairs_view(values, wavelength_index, dobj.pairs.columns[0])
+        yield dobj
+
+
+def uniform_grid_by_step(min, max, step):
+    """
+    Returns a uniform wavelength grid (numpy array) from 'min' up to
+    at most 'max', 'step' apart.
+    """
+    count = int(np.floor((max - min) / step + 1e-9)) + 1
+    return min + step * np.arange(count)
+
+
+def uniform_grid_by_points(min, max, points):
+    """
+    Returns a uniform wavelength grid (numpy array) of 'points'
+    wavelengths from 'min' to 'max'.
+    """
+    return np.linspace(min, max, int(points))
+
+
+# Alignment targets.
+# Key is the name shown in the GUI (and used in the config), value is
+# the function that makes the target grid from the common range and
+# the step or number of points chosen by the user.
+# None means aligning to the file with the highest resolution
+# (see find_max_res and align).
+ALIGNMENT_TARGETS = {
+    "Highest resolution": None,
+    "Uniform step": uniform_grid_by_step,
+    "Uniform points": uniform_grid_by_points,
+}
+
+
+# Precision types.
+# Key is the name shown in the GUI (and used in the config), value is
+# the dtype of the aligned and normalized matrices (and so of the PCA
+# and clustering inputs). float32 halves the memory they take.
+PRECISION_TYPES = {
+    "float64": np.float64,
+    "float32": np.float32,
+}
+
+
+# linked to functional requirement #6 - data normalization
+def combine(data_objects, dtype=float):
     """
     This function takes a list of data objects all sharing a common
     x axis (i.e., they are already aligned) and outputs them all as
     one block.
     This block will have each data_object taking up one row where
     each column is a different y coordinate.
+    The block is allocated once, with the given dtype (see
+    PRECISION_TYPES), and filled row by row; each 'pairs' dataframe is
+    replaced with a view of its row, so the data is not held twice.
     Returns a block of data.
     """
-    data_block = pd.concat([dobj.pairs.transpose() for dobj in data_objects], ignore_index=True)
-    return data_block
+    return pd.DataFrame(_combine_rows(data_objects, dtype), columns=data_objects[0].pairs.index, copy=False)
+
+
+def _combine_rows(data_objects, dtype):
+    """Copies the y values of every data object into its row of one new
+    matrix of the given dtype, and replaces each 'pairs' dataframe with
+    a view of its row. Returns the matrix."""
+    wavelength_index = data_objects[0].pairs.index
+    matrix = np.empty((len(data_objects), len(wavelength_index)), dtype=dtype)
+    for row, dobj in enumerate(data_objects):
+        matrix[row] = dobj.pairs.iloc[:, 0].to_numpy()
+        dobj.pairs = pairs_view(matrix[row], wavelength_index, dobj.pairs.columns[0])
+    return matrix
 
 
 # linked to functional requirement #6 - data normalization
 # linked to functional requirement #7 - PCA
-def pca(dataObjectArray, dimensions):
+def pca(dataObjectArray, dimensions, solver="auto", max_retries=3):
     """
     This function takes a data block (combined dataframe)
     and a number of dimensions and performs PCA dimensionality
     reduction to the specified number of dimensions.
-    Returns the data block transformed to n-dimensions.
+    solver is "auto" or a key of PCA_SOLVERS below; "auto" picks one
+    from the shape of the data block (see choose_pca_solver).
     A bug arose during testing that we believe to be Windows build-related (np.linalg.LinAlgError).
-    As far as we have tested, the bug does not affect the results of PCA or of any other process.
-    We also could not find an actual solution (or source) after several hours of debugging with two team members,
-    so, in the interest of time, we have added a while-try-except statement to PCA to ignore this bug/warning.
+    As far as we have tested, the bug does not affect the results of PCA or of any other process,
+    so a failed fit is tried again, up to max_retries times, then once more with the fallback
+    solver (see PCA_SOLVERS) before giving up.
+    The solver actually used is picked by pca_solver.
+    Returns a tuple (the data block transformed to n-dimensions, "") on success,
+    or (None, error message).
+    """
+    error = pca_dimensions_error(dataObjectArray.shape, dimensions)
+    if error:
+        return None, error
+    solver = pca_solver(dataObjectArray.shape, dimensions, solver)
+    error = None
+    for svd_solver in (solver, PCA_SOLVERS[solver]):
+        for _ in range(max_retries):
+            try:
+                # a fixed random_state, so randomized and arpack give the same result every run
+                pca = PCA(n_components=dimensions, copy=False, svd_solver=svd_solver, random_state=0)
+                transformed = pca.fit_transform(dataObjectArray)
+                return pd.DataFrame(transformed, index=dataObjectArray.index), ""
+            except (np.linalg.LinAlgError, ArpackError) as e:
+                error = e
+    return None, f"PCA to {dimensions} dimensions failed with the {solver} and {PCA_SOLVERS[solver]} " \
+                 f"solvers ({max_retries} tries each): {error}"
+
+
+def pca_dimensions_error(shape, dimensions):
+    """
+    Checks that a data block of the given shape (spectra x wavelengths)
+    can be reduced to the given number of dimensions by PCA, which needs
+    from 1 to as many dimensions as the smaller side of the block.
+    Returns an error message, or "" if it can.
     """
-    while True:
-        try:
-            pca = PCA(n_components=dimensions, copy=False, svd_solver='full')
-            pca.fit(dataObjectArray)
-            transformed = pca.transform(dataObjectArray)
-            return pd.DataFrame(transformed, index=dataObjectArray.index)
-        except np.linalg.LinAlgError:
-            continue
+    smallest = min(shape)
+    if not 1 <= dimensions <= smallest:
+        return f"PCA to {dimensions} dimensions is not possible for {shape[0]} spectra " \
+               f"of {shape[1]} wavelengths: the number of dimensions must be from 1 to {smallest}"
+    return ""
 
 
-def linear_normalize(data_objects):
+def pca_solver(shape, dimensions, solver="auto"):
     """
-    This function takes a list of data objects
-    and normalizes data from range 0 to 1.
-    Returns the normalized data objects
+    Returns the PCA solver (a key of PCA_SOLVERS) that pca uses for a
+    data block of the given shape: the one chosen by choose_pca_solver
+    for "auto", otherwise solver itself, except that arpack can only
+    find fewer components than the smaller side of the data block, so
+    the full SVD is used instead for more.
     """
-    scaler = preprocessing.MinMaxScaler()
-    for i in data_objects:
-        normalized_pairs = scaler.fit_transform(i.pairs)
-        n = i.pairs.columns[0]
-        i.pairs.drop(n, axis=1, inplace=True)
-        i.pairs[n] = normalized_pairs
-    return data_objects
+    if solver == "auto":
+        solver = choose_pca_solver(shape, dimensions)
+    if solver == "arpack" and dimensions >= min(shape):
+        solver = "full"
+    return solver
 
 
-def no_normalize(data_objects):
+def choose_pca_solver(shape, dimensions):
+    """
+    Picks the PCA solver for a data block of the given shape
+    (number of spectra, number of wavelengths): the full SVD for a
+    small block, otherwise a truncated SVD, arpack (exact) when very
+    few components are wanted or randomized (approximate, but much
+    faster for more components). The full SVD of a block of thousands
+    of spectra by thousands of wavelengths takes about ten times as
+    long as either of these.
+    Returns a key of PCA_SOLVERS.
+    """
+    smallest = min(shape)
+    if smallest <= 500 or dimensions >= 0.8 * smallest:
+        return "full"
+    if dimensions <= 0.01 * smallest:
+        return "arpack"
+    return "randomized"
+
+
+# PCA solvers (the svd_solver of sklearn's PCA) that can be picked in
+# the config, and the solver each one falls back to if it keeps failing
+PCA_SOLVERS = {
+    "full": "randomized",
+    "randomized": "full",
+    "arpack": "full",
+}
+
+
+def no_normalize_rows(rows):
     """This function is a no-op; it does no normalization.
     Null design pattern in action!"""
-    return data_objects
+    return None
 
 
-def zScore_normalize(data_objects):
+def linear_normalize_rows(rows):
     """
-    This function takes a list of data objects
-    and rescales data based on how many standard deviations
-    the point is away from the mean of the dataset.
-    Returns the modified data objects
+    This function scales each row of a 2-D float array (one spectrum
+    per row) to the range 0 to 1 in place, giving the same numbers as
+    sklearn's MinMaxScaler does for one spectrum.
     """
-    for df in data_objects:
-        df.pairs = df.pairs.apply(zscore)
-    return data_objects
+    row_min = rows.min(axis=1, keepdims=True)
+    row_range = rows.max(axis=1, keepdims=True) - row_min
+    row_range[row_range == 0.0] = 1.0
+    scale = 1.0 / row_range
+    rows *= scale
+    rows -= row_min * scale
+    return None
+
+
+def zScore_normalize_rows(rows):
+    """
+    This function rescales each row of a 2-D float array (one spectrum
+    per row) to zero mean and unit standard deviation in place, giving
+    the same numbers as scipy's zscore does for one spectrum.
+    """
+    row_mean = rows.mean(axis=1, keepdims=True)
+    row_std = rows.std(axis=1, keepdims=True)
+    rows -= row_mean
+    rows /= row_std
+    return None
+
+
+# linked to functional requirement #6 - data normalization
+def normalize_combined(data_objects, normalization, dtype=float):
+    """
+    This function takes a list of aligned data objects, combines them
+    into one matrix (one row per data object, like combine) and
+    normalizes the whole matrix in place in one pass, with the
+    normalization type named normalization (a key of
+    NORMALIZATION_TYPES below).
+    The matrix has the given dtype (see PRECISION_TYPES).
+    Each 'pairs' dataframe is replaced with a view of its normalized row.
+    Returns the combined dataframe, like combine does.
+    """
+    matrix = _combine_rows(data_objects, dtype)
+    NORMALIZATION_TYPES[normalization](matrix)
+    return pd.DataFrame(matrix, columns=data_objects[0].pairs.index, copy=False)
+
+
+def iter_normalize(data_objects, normalization):
+    """
+    Pipeline stage for normalization: normalizes each data object with
+    the normalization type named normalization (a key of
+    NORMALIZATION_TYPES below) and yields the data object.
+    The normalized values keep the dtype of the 'pairs' dataframe.
+    """
+    normalize_rows = NORMALIZATION_TYPES[normalization]
+    for dobj in data_objects:
+        values = dobj.pairs.iloc[:, 0].to_numpy(copy=True)
+        normalize_rows(values.reshape(1, -1))
+        dobj.pairs = pairs_view(values, dobj.pairs.index, dobj.pairs.columns[0])
+        yield dobj
 
 
 # Normalization types that are implemented
@@ -326,10 +790,17 @@ def zScore_normalize(data_objects):
 # Otherwise these function names are unknown.
 #
 # Key is the name that will appear in the GUI combobox.
-# Value is the function that will be called.
+# Value is the function that will be called. It normalizes a block
+# (a 2-D float array with one spectrum per row, e.g. the combined
+# matrix or a chunk of a cube's rows) in place.
 
 NORMALIZATION_TYPES = {
-    "None": no_normalize,
-    "0-to-1": linear_normalize,
-    "Z-Score": zScore_normalize,
+    "None": no_normalize_rows,
+    "0-to-1": linear_normalize_rows,
+    "Z-Score": zScore_normalize_rows,
 }
+
+# Normalization types that only look at one spectrum at a time, so that
+# newly added spectra can be normalized without touching the rest of
+# the dataset (see space_pipeline.update_spectra).
+PER_SPECTRUM_NORMALIZATIONS = {"None", "0-to-1", "Z-Score"}
@@ -34,12 +34,26 @@
 # This file contains functions that interact with files and folders.
 #
 # Includes: check if a path is valid, selecting files in
-# a folder and subfolders, filtering files by filename, save modified
+# a folder and subfolders, filtering files by filename, reading and
+# writing a manifest of input files, save modified
 # data files as .csv, save data blocks as .csv, save cluster
-# compositions as .csv
+# compositions as .csv, save and load aligned data as a spectral block,
+# fingerprint a list of files
 
+import os
 import os.path
 import glob
+import json
+import hashlib
+import numpy as np
+import pandas as pd
+
+# file names used by the spectral block format
+# (see save_spectral_block and load_spectral_block below)
+BLOCK_MATRIX_FILE = "spectra.npy"
+BLOCK_WAVELENGTH_FILE = "wavelengths.npy"
+BLOCK_TABLE_FILE = "spectra.csv"
+BLOCK_INFO_FILE = "block_info.json"
 
 
 # linked to functional requirement #5 - accepting input from files
@@ -72,11 +86,79 @@ def filter_filenames(file_list):
     those that have 'tir' 'nicolet' 'spectrum' and '.txt'
     in the filename. Returns a Python list.
     """
-    return list(filter(lambda filename: 'tir' in filename
-                                        and 'nicolet' in filename
-                                        and 'spectrum' in filename
-                                        and '.txt' in filename,
-                       file_list))
+    return list(filter(matches_filename_filter, file_list))
+
+
+# linked to functional requirement #4 - filtering input from files
+def matches_filename_filter(filename):
+    """
+    Returns True if the filename has 'tir' 'nicolet'
+    'spectrum' and '.txt' in it.
+    """
+    return 'tir' in filename and 'nicolet' in filename and 'spectrum' in filename and '.txt' in filename
+
+
+# linked to functional requirement #4 - filtering input from files
+# linked to functional requirement #5 - accepting input from files
+# linked to functional requirement #10 - accept subset of data files in folders
+# linked to non-functional requirement #3 - accept up to 2000 files
+def find_spectrum_files(folder):
+    """
+    Walks a given folder and all of its subfolders with os.scandir
+    and applies the filename filter to each file name as it goes,
+    so only matching files are ever collected and directories are
+    never returned. Hidden files and folders (names starting with
+    '.') are skipped, as glob does.
+    Returns a Python list of matching files with full path, in the
+    same order collect_all_filenames would list them.
+    """
+    file_list = []
+    _scan_folder(folder, file_list)
+    return file_list
+
+
+def _scan_folder(folder, file_list):
+    """Appends the matching files in folder to file_list,
+    descending into each subfolder as it is found.
+    Folders that can't be read are skipped."""
+    try:
+        with os.scandir(folder) as entries:
+            for entry in entries:
+                if entry.name.startswith('.'):
+                    continue
+                if entry.is_dir():
+                    _scan_folder(entry.path, file_list)
+                elif matches_filename_filter(entry.name) and entry.is_file():
+                    file_list.append(entry.path)
+    except OSError:
+        pass
+
+
+# linked to functional requirement #5 - accepting input from files
+def write_file_manifest(manifest_file, file_list):
+    """
+    Accepts a manifest filename and a list of files.
+    Saves the list as a text file with one path per line, each
+    relative to the folder holding the manifest (as read_file_manifest
+    expects), so the folder can be moved or given as a relative path.
+    """
+    manifest_folder = os.path.dirname(os.path.abspath(manifest_file))
+    with open(manifest_file, "w", encoding="utf-8") as file:
+        file.writelines(os.path.relpath(os.path.abspath(path), manifest_folder) + "\n" for path in file_list)
+
+
+# linked to functional requirement #5 - accepting input from files
+def read_file_manifest(manifest_file):
+    """
+    Reads a text file listing one file path per line (blank lines
+    and lines starting with '#' are ignored). Relative paths are
+    taken to be relative to the folder holding the manifest.
+    Returns a Python list of paths.
+    """
+    manifest_folder = os.path.dirname(manifest_file)
+    with open(manifest_file, "r", encoding="utf-8") as file:
+        lines = [line.strip() for line in file]
+    return [os.path.join(manifest_folder, line) for line in lines if line != "" and not line.startswith("#")]
 
 
 # linked to functional requirement #8 - saving data after modifications
@@ -99,6 +181,152 @@ def save_data_files(folder, suffix, data_objects):
         dobj.pairs.to_csv(save_string)  # other arguments can be supplied, check pandas docs
 
 
+# linked to functional requirement #8 - saving data after modifications
+# linked to non-functional requirement #5 - save files in a tree format
+def save_spectral_block(folder, suffix, data_objects, info=None):
+    """
+    Accepts a specified filepath, a suffix to add to it,
+    and a list of aligned data_objects (all 'pairs' dataframes
+    share the same wavelength index).
+    Saves them all as one spectral block made of three files:
+    a float matrix with one row per data object, in the dtype of the
+    'pairs' dataframes (.npy, can be memory-mapped when loading), the shared wavelength axis (.npy),
+    and a table with the filename, path, y units label, and the
+    size and modification time of the source file of each row (.csv).
+    info is an optional dict saved with the block as .json
+    (see read_block_info).
+    """
+    dir_name = os.path.join(folder, suffix)
+    # saves may run on the background writer (see space_writer.py),
+    # so another save may create the folder at the same time
+    os.makedirs(dir_name, exist_ok=True)
+    wavelengths = data_objects[0].pairs.index.to_numpy(dtype=float)
+    matrix = np.lib.format.open_memmap(os.path.join(dir_name, BLOCK_MATRIX_FILE), mode="w+",
+                                       dtype=data_objects[0].pairs.iloc[:, 0].dtype,
+                                       shape=(len(data_objects), len(wavelengths)))
+    for row, dobj in enumerate(data_objects):
+        matrix[row] = dobj.pairs.iloc[:, 0].to_numpy()
+    matrix.flush()
+    del matrix
+    np.save(os.path.join(dir_name, BLOCK_WAVELENGTH_FILE), wavelengths)
+    block_table(data_objects).to_csv(os.path.join(dir_name, BLOCK_TABLE_FILE), index=False)
+    write_block_info(dir_name, info)
+
+
+def block_table(data_objects):
+    """
+    Accepts a list of data_objects and returns the table
+    saved with a spectral block: the filename, path,
+    y units label, and the size and modification time
+    (-1 if the source file is gone) of each row.
+    """
+    stats = [os.stat(dobj.path) if path_exists(dobj.path) else None for dobj in data_objects]
+    return pd.DataFrame({"filename": [dobj.filename for dobj in data_objects],
+                         "path": [dobj.path for dobj in data_objects],
+                         "y_units": [dobj.pairs.columns[0] for dobj in data_objects],
+                         "size": [stat.st_size if stat else -1 for stat in stats],
+                         "mtime": [stat.st_mtime_ns if stat else -1 for stat in stats]})
+
+
+# linked to functional requirement #8 - saving data after modifications
+def append_spectral_block(folder, data_objects, keep_rows=None):
+    """
+    Accepts the folder of a spectral block, a list of data_objects
+    aligned to the block's wavelengths, and the row numbers of the
+    existing rows to keep (None keeps them all).
+    Rewrites the block so it holds the kept rows, in the given order,
+    followed by one new row per data object.
+    """
+    matrix, wavelengths, table = load_spectral_block(folder)
+    keep_rows = list(range(len(table))) if keep_rows is None else list(keep_rows)
+    temp_file = os.path.join(folder, "new_" + BLOCK_MATRIX_FILE)
+    new_matrix = np.lib.format.open_memmap(temp_file, mode="w+", dtype=matrix.dtype,
+                                           shape=(len(keep_rows) + len(data_objects), len(wavelengths)))
+    # copy the kept rows over in chunks, so the block never has to be in memory
+    for start in range(0, len(keep_rows), 1024):
+        rows = keep_rows[start:start + 1024]
+        new_matrix[start:start + len(rows)] = matrix[rows]
+    for row, dobj in enumerate(data_objects, start=len(keep_rows)):
+        new_matrix[row] = dobj.pairs.iloc[:, 0].to_numpy()
+    new_matrix.flush()
+    del new_matrix, matrix
+    os.replace(temp_file, os.path.join(folder, BLOCK_MATRIX_FILE))
+    new_table = pd.concat([table.iloc[keep_rows], block_table(data_objects).astype(str)], ignore_index=True)
+    new_table.to_csv(os.path.join(folder, BLOCK_TABLE_FILE), index=False)
+
+
+# linked to functional requirement #8 - saving data after modifications
+def write_block_info(folder, info):
+    """
+    Saves a dict of extra information about the spectral block in
+    folder as .json (e.g. the normalization it was made with).
+    Nothing is saved if info is None.
+    """
+    if info is not None:
+        with open(os.path.join(folder, BLOCK_INFO_FILE), "w") as file:
+            json.dump(info, file)
+
+
+# linked to functional requirement #5 - accepting input from files
+def read_block_info(folder):
+    """
+    Returns the dict saved with the spectral block in folder by
+    write_block_info, or an empty dict if there is none.
+    """
+    info_file = os.path.join(folder, BLOCK_INFO_FILE)
+    if not path_exists(info_file):
+        return {}
+    with open(info_file, "r") as file:
+        return json.load(file)
+
+
+# linked to functional requirement #5 - accepting input from files
+def spectral_block_exists(folder):
+    """
+    Checks to see if a folder contains a spectral block.
+    Returns True if it does.
+    """
+    return all(path_exists(path) for path in spectral_block_files(folder))
+
+
+def spectral_block_files(folder):
+    """
+    Returns the paths of the files that make up the
+    spectral block in folder (the info file is optional
+    and not included).
+    """
+    return [os.path.join(folder, name) for name in (BLOCK_MATRIX_FILE, BLOCK_WAVELENGTH_FILE, BLOCK_TABLE_FILE)]
+
+
+def files_fingerprint(file_list):
+    """
+    Accepts a list of files and returns a fingerprint (hex
+    string) of their paths, sizes and modification times,
+    which changes when a file is added, removed, moved
+    or modified.
+    """
+    digest = hashlib.sha1()
+    for item in file_list:
+        stat = os.stat(item) if path_exists(item) else None
+        digest.update(("%s\t%s\t%s\n" % (os.path.abspath(item), stat.st_size if stat else -1,
+                                          stat.st_mtime_ns if stat else -1)).encode("utf-8"))
+    return digest.hexdigest()
+
+
+# linked to functional requirement #5 - accepting input from files
+def load_spectral_block(folder, mmap_mode="r"):
+    """
+    Loads a spectral block saved by save_spectral_block.
+    The matrix is memory-mapped with the given mmap_mode
+    (None reads it all into memory).
+    Returns a tuple (matrix, wavelengths, table).
+    """
+    matrix = np.load(os.path.join(folder, BLOCK_MATRIX_FILE), mmap_mode=mmap_mode)
+    wavelengths = np.load(os.path.join(folder, BLOCK_WAVELENGTH_FILE))
+    table = pd.read_csv(os.path.join(folder, BLOCK_TABLE_FILE), dtype=str, keep_default_na=False)
+    return matrix, wavelengths, table
+
+
 # linked to functional requirement #8 - saving data after modifications
 # linked to functional requirement #9 - saving clustered data
 # linked to non-functional requirement #4 - save as .csv
@@ -117,8 +345,9 @@ def save_block_data(folder, suffix, dataset):
         dir_name = os.path.join(folder, *suffix)
     else:
         dir_name = os.path.join(folder, suffix)
-    if not path_exists(dir_name):
-        os.mkdir(dir_name)
+    # saves may run on the background writer (see space_writer.py),
+    # so another save may create the folder at the same time
+    os.makedirs(dir_name, exist_ok=True)
     save_string = os.path.join(dir_name, "data_block.csv")
     dataset.to_csv(save_string)  # other arguments can be supplied, check pandas docs
 
@@ -133,8 +362,7 @@ def save_composition(folder, clustering_type, file_suffix, c):
     a filename suffix, and a cluster composition dataframe.
     Saves the cluster composition info.
     """
-    if not path_exists(folder):
-        os.mkdir(folder)
+    os.makedirs(folder, exist_ok=True)
     file_name = clustering_type + "_composition_" + file_suffix + ".csv"
     save_string = os.path.join(folder, file_name)
     c.to_csv(save_string)  # other arguments can be supplied, check pandas docs
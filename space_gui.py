@@ -39,12 +39,20 @@ import tkinter.messagebox as tkmb
 import tkinter.filedialog as tkfd
 from time import sleep
 import os.path
+import copy
 
+import numpy as np
 from pandas.core.frame import DataFrame
+from sklearn.metrics import adjusted_rand_score
 import space_file_ops as fileops
 import space_data_ops as dataops
 import space_kmeans as km
 import space_dbscan as db
+import space_cube as cube
+import space_pipeline as pipeline
+from space_cache import ParseCache, default_cache_folder
+from space_writer import BackgroundWriter
+from space_library import SpectralLibrary
 from matplotlib.backends.backend_tkagg import NavigationToolbar2Tk
 
 
@@ -82,10 +90,41 @@ class SpaceApp(tk.Frame):
             self._set_defaults()
         self.log("SpACE graphical user interface startup")
 
-        # data objects holding pandas dataframes (empty for now)
+        # data objects holding pandas dataframes, then a SpectralLibrary
+        # once the import is done (empty for now)
         self._data_objs = []
         # combined dataframe (none for now)
         self._dataset = None
+        # memory-mapped cube behind the combined dataframe (none unless
+        # DISK_BACKED_DATASET is turned on in the config)
+        self._cube = None
+        # background writer for saving files (none if BACKGROUND_SAVING
+        # is turned off in the config, then files are saved right away)
+        self._writer = None
+        if self.app_config.get("BACKGROUND_SAVING", False):
+            self._writer = BackgroundWriter(self.app_config.get("SAVE_WORKERS", 2),
+                                            self.app_config.get("SAVE_BATCH_SIZE", 16))
+        self._writer_polling = False
+        # results of the import stages kept from the last run, by stage
+        # name (see _cached_stage)
+        self._stage_cache = {}
+        # True if the last import was incremental
+        self._incremental = False
+        # (dataset, its PCA projection to 3 dimensions) for the plots
+        # (see _plot_projection), none until a plot needs it
+        self._projection = None
+        # (normalized dataset, its space_cube.PCASpectrum) for picking the
+        # PCA dimensions by explained variance (see _do_pca_by_variance)
+        self._variance = None
+        # (path of each spectrum, its cluster) from the last K-means run,
+        # for warm starting the next one (see _warm_start_centers)
+        self._k_previous = None
+        # (dataset, K-means engine, {K: kmeans object}) from the last K
+        # sweep (see _on_sweep_k), none until a sweep is done
+        self._k_sweep = None
+        # keep the explained variance readout up to date as the PCA entries change
+        self._Var_pca_dimensions.trace_add("write", self._on_pca_dimensions_changed)
+        self._Var_pca_variance.trace_add("write", self._on_pca_variance_changed)
 
     def _create_widgets(self):
         """Create and configure all the widgets in the main frame."""
@@ -117,6 +156,28 @@ class SpaceApp(tk.Frame):
         self._Checkbutton_align.grid(row=0,sticky=tk.W)
         self._Frame_align.grid(row=1,padx=5,pady=(10,0),sticky=tk.W)
 
+        # -- alignment target sub-frame --
+        Frame_align_target = ttk.Frame(self._LabelFrame_data)
+        Label_align_target = ttk.Label(Frame_align_target, text="Align to:")
+        self._Var_align_target = tk.StringVar()
+        self._Combobox_align_target = ttk.Combobox(Frame_align_target, width=16, justify="center",
+                                                   state="readonly", textvariable=self._Var_align_target,
+                                                   values=list(dataops.ALIGNMENT_TARGETS.keys()))
+        self._Combobox_align_target.bind("<<ComboboxSelected>>", self._on_align_target_selected)
+        Label_grid_value = ttk.Label(Frame_align_target, text="Grid step or points:")
+        self._Var_grid_value = tk.DoubleVar()
+        self._Entry_grid_value = ttk.Entry(Frame_align_target, width=8, justify="center",
+                                           textvariable=self._Var_grid_value)
+        self._Var_bin_average = tk.BooleanVar()
+        self._Checkbutton_bin_average = ttk.Checkbutton(Frame_align_target, text="Average over grid bins",
+                                                        variable=self._Var_bin_average)
+        Label_align_target.grid(row=0, column=0, sticky=tk.W)
+        self._Combobox_align_target.grid(row=0, column=1, padx=(5, 0), sticky=tk.W)
+        Label_grid_value.grid(row=1, column=0, sticky=tk.W)
+        self._Entry_grid_value.grid(row=1, column=1, padx=(5, 0), sticky=tk.W)
+        self._Checkbutton_bin_average.grid(row=2, columnspan=2, sticky=tk.W)
+        Frame_align_target.grid(row=2, padx=5, pady=(10, 0), sticky=tk.W)
+
         # -- normalize sub-frame --
         Frame_normalize = ttk.Frame(self._LabelFrame_data)
         Label_normalize = ttk.Label(Frame_normalize, text="Normalization:")
@@ -125,9 +186,16 @@ class SpaceApp(tk.Frame):
                                           state="readonly", textvariable=self._Var_normalize,
                                           values=list(dataops.NORMALIZATION_TYPES.keys()))
         Combobox_normalize.current(0)
+        Label_precision = ttk.Label(Frame_normalize, text="Precision:")
+        self._Var_precision = tk.StringVar()
+        Combobox_precision = ttk.Combobox(Frame_normalize, width=10, justify="center",
+                                          state="readonly", textvariable=self._Var_precision,
+                                          values=list(dataops.PRECISION_TYPES.keys()))
         Label_normalize.grid(row=0, column=0, sticky=tk.W)
         Combobox_normalize.grid(row=0, column=1, padx=(5, 0), sticky=tk.W)
-        Frame_normalize.grid(row=2, padx=5, pady=(10, 0), sticky=tk.W)
+        Label_precision.grid(row=1, column=0, pady=(5, 0), sticky=tk.W)
+        Combobox_precision.grid(row=1, column=1, padx=(5, 0), pady=(5, 0), sticky=tk.W)
+        Frame_normalize.grid(row=3, padx=5, pady=(10, 0), sticky=tk.W)
 
         # -- pca sub-frame --
         self._Frame_pca = ttk.Frame(self._LabelFrame_data)
@@ -136,16 +204,28 @@ class SpaceApp(tk.Frame):
         self._Checkbutton_pca = ttk.Checkbutton(self._Frame_pca, text="Perform PCA", variable=self._Var_pca)
         self._Label_pca_text = ttk.Label(self._Frame_pca, text="Number of dimensions:")
         self._Entry_pca = ttk.Entry(self._Frame_pca, width=5, justify="center", textvariable=self._Var_pca_dimensions)
+        self._Var_pca_by_variance = tk.BooleanVar()
+        self._Var_pca_variance = tk.DoubleVar()
+        self._Checkbutton_pca_variance = ttk.Checkbutton(self._Frame_pca, text="Dimensions for variance (%):",
+                                                         variable=self._Var_pca_by_variance,
+                                                         command=self._on_pca_variance_changed)
+        self._Entry_pca_variance = ttk.Entry(self._Frame_pca, width=5, justify="center",
+                                             textvariable=self._Var_pca_variance)
+        self._Var_pca_readout = tk.StringVar(value="Explained variance: -")
+        Label_pca_readout = ttk.Label(self._Frame_pca, textvariable=self._Var_pca_readout)
         self._Checkbutton_pca.grid(row=0, sticky=tk.W)
         self._Label_pca_text.grid(row=1, column=0, sticky=tk.W)
         self._Entry_pca.grid(row=1, column=1, padx=5)
-        self._Frame_pca.grid(row=3, padx=5, pady=(10, 0), sticky=tk.W)
+        self._Checkbutton_pca_variance.grid(row=2, column=0, sticky=tk.W)
+        self._Entry_pca_variance.grid(row=2, column=1, padx=5)
+        Label_pca_readout.grid(row=3, columnspan=2, sticky=tk.W)
+        self._Frame_pca.grid(row=4, padx=5, pady=(10, 0), sticky=tk.W)
 
         # -- save after processing steps --
         self._Var_save_after_modify = tk.BooleanVar()
         Checkbutton_save_after_modify = ttk.Checkbutton(self._LabelFrame_data, text="Save after each data modification",
                                                         variable=self._Var_save_after_modify)
-        Checkbutton_save_after_modify.grid(row=4, padx=5, pady=10, sticky=tk.W)
+        Checkbutton_save_after_modify.grid(row=5, padx=5, pady=10, sticky=tk.W)
 
         # - DATA widgets grid -
         self._LabelFrame_data.grid(row=0, column=0, padx=(10, 0), pady=(5, 0))
@@ -159,6 +239,29 @@ class SpaceApp(tk.Frame):
         w.grid(row=0, column=0, padx=5, pady=(5, 10), sticky=tk.W)
         w = ttk.Entry(Labelframe, width=5, justify="center", textvariable=self._Var_kmeans_clusters)
         w.grid(row=0, column=1, pady=(5, 10))
+        self._Var_kmeans_engine = tk.StringVar()
+        w = ttk.Label(Labelframe, text="Engine:")
+        w.grid(row=1, column=0, padx=5, pady=(0, 10), sticky=tk.W)
+        w = ttk.Combobox(Labelframe, width=18, justify="center", state="readonly",
+                         textvariable=self._Var_kmeans_engine, values=list(km.KMEANS_ENGINES))
+        w.grid(row=1, column=1, padx=(0, 5), pady=(0, 10))
+        self._Var_kmeans_warm_start = tk.BooleanVar()
+        w = ttk.Checkbutton(Labelframe, text="Warm start from the last run", variable=self._Var_kmeans_warm_start)
+        w.grid(row=2, columnspan=2, padx=5, pady=(0, 10), sticky=tk.W)
+        Frame_sweep = ttk.Frame(Labelframe)
+        self._Var_sweep_min = tk.IntVar()
+        self._Var_sweep_max = tk.IntVar()
+        w = ttk.Label(Frame_sweep, text="Sweep K from")
+        w.grid(row=0, column=0, sticky=tk.W)
+        w = ttk.Entry(Frame_sweep, width=4, justify="center", textvariable=self._Var_sweep_min)
+        w.grid(row=0, column=1, padx=5)
+        w = ttk.Label(Frame_sweep, text="to")
+        w.grid(row=0, column=2)
+        w = ttk.Entry(Frame_sweep, width=4, justify="center", textvariable=self._Var_sweep_max)
+        w.grid(row=0, column=3, padx=5)
+        w = ttk.Button(Frame_sweep, text="Sweep", width=8, command=self._on_sweep_k)
+        w.grid(row=0, column=4)
+        Frame_sweep.grid(row=3, columnspan=2, padx=5, pady=(0, 10), sticky=tk.W)
         # - KMEANS widgets grid -
         Labelframe.grid(row=1, column=0, padx=(10, 0), pady=(40, 5), sticky=tk.EW)
 
@@ -199,13 +302,15 @@ class SpaceApp(tk.Frame):
         self._Tab_log = ttk.Frame(Notebook_controller)
         self._Tab_kmeans = ttk.Frame(Notebook_controller)
         self._Tab_dbscan = ttk.Frame(Notebook_controller)
+        self._Tab_sweep = ttk.Frame(Notebook_controller)
         # resize setup
-        for tab in (self._Tab_log, self._Tab_kmeans, self._Tab_dbscan):
+        for tab in (self._Tab_log, self._Tab_kmeans, self._Tab_dbscan, self._Tab_sweep):
             tab.grid_columnconfigure(index=0, weight=1)
             tab.grid_rowconfigure(index=0, weight=1)
         Notebook_controller.add(self._Tab_log, text="Log")
         Notebook_controller.add(self._Tab_kmeans, text="K-means plot")
         Notebook_controller.add(self._Tab_dbscan, text="DBSCAN plot")
+        Notebook_controller.add(self._Tab_sweep, text="K sweep")
         # log text box and scrollbars
         self._Scroll_H = ttk.Scrollbar(self._Tab_log, orient=tk.HORIZONTAL)
         self._Scroll_V = ttk.Scrollbar(self._Tab_log, orient=tk.VERTICAL)
@@ -234,10 +339,20 @@ class SpaceApp(tk.Frame):
 
     def _set_defaults(self):
         self._Var_folder.set(self.app_config["DEFAULT_INPUT_PATH"])
+        self._Var_align_target.set(self.app_config.get("DEFAULT_ALIGNMENT_TARGET", "Highest resolution"))
+        self._on_align_target_selected()
+        self._Var_bin_average.set(self.app_config.get("GRID_BIN_AVERAGE_BY_DEFAULT", False))
+        self._Var_precision.set(self.app_config.get("DEFAULT_PRECISION", "float64"))
         self._Var_pca.set(self.app_config["PCA_BY_DEFAULT"])
         self._Var_pca_dimensions.set(self.app_config["DEFAULT_PCA_DIMENSIONS"])
+        self._Var_pca_by_variance.set(self.app_config.get("PCA_BY_VARIANCE_BY_DEFAULT", False))
+        self._Var_pca_variance.set(self.app_config.get("DEFAULT_PCA_VARIANCE", 99.0))
         self._Var_save_after_modify.set(self.app_config["SAVE_AFTER_DATA_MODIFICATION_BY_DEFAULT"])
         self._Var_kmeans_clusters.set(self.app_config["DEFAULT_KMEANS_K"])
+        self._Var_kmeans_engine.set(self.app_config.get("DEFAULT_KMEANS_ENGINE", "K-means"))
+        self._Var_kmeans_warm_start.set(self.app_config.get("KMEANS_WARM_START_BY_DEFAULT", False))
+        self._Var_sweep_min.set(self.app_config.get("DEFAULT_KMEANS_SWEEP_MIN", 2))
+        self._Var_sweep_max.set(self.app_config.get("DEFAULT_KMEANS_SWEEP_MAX", 12))
         self._Var_eps.set(self.app_config["DEFAULT_DBSCAN_EPS"])
         self._Var_minpts.set(self.app_config["DEFAULT_DBSCAN_MINPTS"])
         self._Button_save["state"] = "disabled"
@@ -282,6 +397,7 @@ class SpaceApp(tk.Frame):
         """Check for valid input from user in the following controls:
         - input folder entry
         - kmeans number of clusters k
+        - pca explained variance
         - dbscan epsilon
         - dbscan minpts
         Gives error message to user if anything is wrong.
@@ -293,6 +409,18 @@ class SpaceApp(tk.Frame):
             self.log("Invalid path: %s" % self._Var_folder.get())
             self._quick_message_box("Invalid path:\n%s" % self._Var_folder.get())
             return False
+        # verify the uniform grid step or number of points
+        if dataops.ALIGNMENT_TARGETS[self._Var_align_target.get()] is not None:
+            if self._Var_align_target.get() == "Uniform step" and self._Var_grid_value.get() <= 0:
+                # a bad grid step is a fatal error
+                self.log("Grid step must be greater than zero.")
+                self._quick_message_box("Grid step must be greater than zero.")
+                return False
+            if self._Var_align_target.get() == "Uniform points" and self._Var_grid_value.get() < 2:
+                # a bad number of grid points is a fatal error
+                self.log("Number of grid points must be at least 2.")
+                self._quick_message_box("Number of grid points must be at least 2.")
+                return False
         # verify kmeans number of clusters
         if self._Var_kmeans.get():
             if self._Var_kmeans_clusters.get() < 2:
@@ -300,6 +428,13 @@ class SpaceApp(tk.Frame):
                 self.log("Number of clusters for K-means must be at least 2.")
                 self._quick_message_box("Number of clusters for K-means must be at least 2.")
                 return False
+        # verify the explained variance threshold for PCA
+        if self._Var_pca.get() and self._Var_pca_by_variance.get():
+            if not 0 < self._Var_pca_variance.get() <= 100:
+                # a bad threshold is a fatal error
+                self.log("PCA explained variance must be greater than 0% and at most 100%.")
+                self._quick_message_box("PCA explained variance must be greater than 0% and at most 100%.")
+                return False
         # verify dbscan epsilon and minpts
         if self._Var_dbscan.get():
             if self._Var_eps.get() < 0:
@@ -329,40 +464,601 @@ class SpaceApp(tk.Frame):
     def _on_clear_log(self):
         self._Text_log.delete(1.0, tk.END)
 
+    def _on_align_target_selected(self, event=None):
+        """Put the default grid step or number of points for the selected
+        alignment target in the grid entry, and only enable the grid
+        widgets for a uniform grid."""
+        target = self._Var_align_target.get()
+        if target == "Uniform step":
+            self._Var_grid_value.set(self.app_config.get("DEFAULT_GRID_STEP", 0.01))
+        elif target == "Uniform points":
+            self._Var_grid_value.set(self.app_config.get("DEFAULT_GRID_POINTS", 1000))
+        state = "disabled" if dataops.ALIGNMENT_TARGETS[target] is None else "normal"
+        self._Entry_grid_value.config(state=state)
+        self._Checkbutton_bin_average.config(state=state)
+
+    def _alignment_settings(self):
+        """Return the alignment settings chosen by the user as a tuple
+        (alignment target, grid step or number of points, bin averaging),
+        the same way they are saved with the aligned block."""
+        if dataops.ALIGNMENT_TARGETS[self._Var_align_target.get()] is None:
+            return self._Var_align_target.get(), None, False
+        return self._Var_align_target.get(), self._Var_grid_value.get(), self._Var_bin_average.get()
+
+    def _alignment_grid(self, min, max):
+        """Return the uniform grid inside the common range min to max
+        for the chosen alignment target, or None to align to the
+        highest resolution file."""
+        target, grid_value, _ = self._alignment_settings()
+        make_grid = dataops.ALIGNMENT_TARGETS[target]
+        return None if make_grid is None else make_grid(min, max, grid_value)
+
+    def _aligned_block_info(self, min, max):
+        """Return the info saved with the aligned block for the common
+        range min to max (see space_pipeline.aligned_block_info)."""
+        return pipeline.aligned_block_info(min, max, *self._alignment_settings(), self._Var_precision.get())
+
+    def _dtype(self):
+        """Return the dtype of the precision chosen by the user."""
+        return dataops.PRECISION_TYPES[self._Var_precision.get()]
+
+    def _open_parse_cache(self):
+        """Open the parse cache for the input folder, or return None
+        if the cache is turned off in the config.
+        The default cache folder is in the user's cache folder (see
+        space_cache.default_cache_folder).
+        If the cache folder can't be made, the import goes on without
+        the cache."""
+        if not self.app_config.get("USE_PARSE_CACHE", False):
+            return None
+        folder = self.app_config.get("PARSE_CACHE_FOLDER")
+        if folder is None:
+            folder = default_cache_folder()
+        max_mb = self.app_config.get("PARSE_CACHE_MAX_MB")
+        try:
+            return ParseCache(folder, None if max_mb is None else max_mb * 1024 * 1024)
+        except OSError as e:
+            self.log("Warning: parse cache turned off for this import, %s could not be made: %s" % (folder, e))
+            return None
+
     # linked to functional requirement #6 - normalize data
     # linked to functional requirement #3 - preprocess data files
     # linked to functional requirement #7 - PCA
     def _do_import_data(self):
+        # files still being saved from the last run may be views of the
+        # data about to be replaced, so let them finish first
+        self._wait_for_writer()
         # reset everything, in case we are running multiple times
         self._data_objs = []
         self._dataset = None
+        self._cube = None
         self.log("-- Begin data import and pre-processing --")
-        # search for all files in input folder and subfolder
-        file_list = fileops.collect_all_filenames(self._Var_folder.get())
-        self.log("Found %s files and folders in %s" % (len(file_list), self._Var_folder.get()))
-        # filter by filename
-        filtered_file_list = fileops.filter_filenames(file_list)
+        filtered_file_list = None
+        if not self._Var_align.get():
+            # working with the raw ECOSTRESS files
+            filtered_file_list = self._collect_input_files()
+            if filtered_file_list is None:
+                return
+        # the cache keys of the stages, None if the stage cache is off
+        stage_keys = self._stage_keys(filtered_file_list) if self.app_config.get("STAGE_CACHE", False) else None
+        normalized = self._cached_stage("normalized", stage_keys)
+        if normalized is not None:
+            # nothing the normalized data depends on has changed since the last run
+            self._data_objs, self._dataset, self._cube = normalized
+        else:
+            if not self._do_import_and_normalize(filtered_file_list, stage_keys):
+                return
+            self._store_stage("normalized", stage_keys, (self._data_objs, self._dataset, self._cube))
+
+        if self._Var_save_after_modify.get() or (self.app_config.get("INCREMENTAL_IMPORT", False)
+                                                 and normalized is None and not self._incremental):
+            # the normalized block is always saved when incremental import is on,
+            # so the next import can start from it
+            self.log("Saving normalized data...")
+            self._save("normalized data", fileops.save_spectral_block, self._Var_folder.get(), "normalized",
+                       self._data_objs, {"normalization": self._Var_normalize.get()})
+        if self._Var_save_after_modify.get():
+            self.log("Saving final combined dataframe...")
+            self._save("final combined dataframe", fileops.save_block_data, self._Var_folder.get(), "block",
+                       self._dataset)
+        if self._variance is not None and self._variance[0] is not self._dataset:
+            # the explained variance shown is for other data
+            self._variance = None
+            self._Var_pca_readout.set("Explained variance: -")
+        # PCA
+        if self._Var_pca.get():
+            if self._Var_pca_by_variance.get():
+                self._do_pca_by_variance()
+            else:
+                reduced = self._cached_stage("PCA", stage_keys)
+                if reduced is not None:
+                    self._dataset = reduced
+                else:
+                    self.log('Performing PCA to ' + str(self._Var_pca_dimensions.get()) + ' dimensions...')
+                    if self._variance is not None and \
+                            self._Var_pca_dimensions.get() <= self._variance[1].max_dimensions:
+                        # every component of this dataset is known already
+                        self.log("Using the components of the explained variance of the data set")
+                        self._transform_by_spectrum(self._Var_pca_dimensions.get())
+                    elif self.app_config.get("INCREMENTAL_PCA", False):
+                        # fitted and transformed in chunks of rows, straight
+                        # from the cube or the library, without copying it
+                        self.log("Using incremental PCA")
+                        matrix = self._cube.matrix if self._cube is not None else self._data_objs.matrix
+                        self._dataset, return_msg = cube.incremental_pca(
+                            matrix, self._Var_pca_dimensions.get(),
+                            self.app_config.get("INCREMENTAL_PCA_CHUNK_ROWS", 512))
+                    elif self._cube is not None:
+                        self._dataset, return_msg = cube.pca_cube(self._cube, self._Var_pca_dimensions.get(),
+                                                                  self.app_config.get("DISK_BACKEND_CHUNK_ROWS", 256))
+                    else:
+                        # PCA centers the dataset in place, and the dataset holds
+                        # the spectra of the library (and may still be saving in
+                        # the background), so it works on a copy
+                        self._dataset = self._do_pca(self._dataset.copy(), self._Var_pca_dimensions.get())
+                        if self._dataset is None:
+                            self._data_objs = []
+                            return
+                    if self._dataset is None:
+                        # the number of dimensions does not fit the data
+                        # log to console and pop up a messagebox
+                        self.log(return_msg)
+                        self._quick_message_box(return_msg)
+                        self._data_objs = []
+                        return
+                    self.log('PCA applied')
+                    self._store_stage("PCA", stage_keys, self._dataset)
+            if self._Var_save_after_modify.get():
+                self.log("Saving PCA-reduced data...")
+                # the folder suffix here is a nested subfolder path like:
+                # \block\PCA-<number of dimensions> so the individual
+                # path components are passed as a tuple
+                self._save("PCA-reduced data", fileops.save_block_data, self._Var_folder.get(),
+                           ("block", "PCA-" + self._Entry_pca.get()), self._dataset)
+        self._flush_writer()
+        if self._projection is not None and self._projection[0] is not self._dataset:
+            # the plots need a new projection of the new dataset
+            self._projection = None
+
+        self.log("-- End data import and pre-processing --")
+
+    # linked to functional requirement #7 - PCA
+    def _do_pca(self, dataset, dimensions):
+        """Reduce dataset to the given number of dimensions with PCA,
+        using the solver and number of retries from the config (see
+        space_data_ops.pca). PCA centers dataset in place.
+        Returns the reduced dataset, or None if PCA failed."""
+        solver = dataops.pca_solver(dataset.shape, dimensions, self.app_config.get("PCA_SOLVER", "auto"))
+        self.log("Using the %s PCA solver" % solver)
+        reduced, return_msg = dataops.pca(dataset, dimensions, solver, self.app_config.get("PCA_MAX_RETRIES", 3))
+        if reduced is None:
+            # PCA failing even with the fallback solver is a fatal error
+            # log to console and pop up a messagebox
+            self.log(return_msg)
+            self._quick_message_box(return_msg)
+        return reduced
+
+    # linked to functional requirement #7 - PCA
+    def _do_pca_by_variance(self):
+        """Reduce self._dataset with PCA to the fewest dimensions that
+        explain the variance threshold entered, and put that number in
+        the number of dimensions entry. Every component and the variance
+        it explains (a space_cube.PCASpectrum) is only worked out once
+        per normalized dataset, after that any number of dimensions
+        needs no new fit."""
+        chunk_rows = self.app_config.get("DISK_BACKEND_CHUNK_ROWS", 256)
+        if self._variance is None:
+            self.log("Working out the explained variance of every PCA dimension...")
+            if self._cube is not None:
+                spectrum = cube.pca_spectrum_cube(self._cube, chunk_rows)
+            else:
+                spectrum = cube.pca_spectrum(self._data_objs.matrix)
+            self._variance = (self._dataset, spectrum)
+        else:
+            self.log("Reusing the explained variance of the data set")
+        spectrum = self._variance[1]
+        dimensions = spectrum.dimensions_for_variance(self._Var_pca_variance.get() / 100)
+        self._Var_pca_dimensions.set(dimensions)
+        self.log("%d PCA dimensions explain %.2f%% of the variance"
+                 % (dimensions, 100 * spectrum.cumulative_variance(dimensions)))
+        self._transform_by_spectrum(dimensions)
+        self.log('PCA applied')
+
+    def _transform_by_spectrum(self, dimensions):
+        """Reduce self._dataset to the given number of dimensions with
+        the explained-variance spectrum kept for it (see
+        _do_pca_by_variance), which needs no new fit."""
+        spectrum = self._variance[1]
+        if self._cube is not None:
+            self._dataset = spectrum.transform(self._cube.matrix, dimensions,
+                                               self.app_config.get("DISK_BACKEND_CHUNK_ROWS", 256))
+        else:
+            # the whole library is transformed at once, like PCA does
+            matrix = self._data_objs.matrix
+            self._dataset = spectrum.transform(matrix, dimensions, max(len(matrix), 1))
+
+    def _on_pca_dimensions_changed(self, *args):
+        """Show the share of the variance explained by the number of
+        PCA dimensions entered, if the explained variance of the data
+        set has been worked out (see _do_pca_by_variance)."""
+        if self._variance is None:
+            return
+        try:
+            dimensions = self._Var_pca_dimensions.get()
+        except tk.TclError:
+            # the entry is empty or not a number (yet)
+            self._Var_pca_readout.set("Explained variance: -")
+            return
+        spectrum = self._variance[1]
+        dimensions = min(max(dimensions, 0), spectrum.max_dimensions)
+        self._Var_pca_readout.set("Explained variance: %.2f%% (%d of %d dimensions)"
+                                  % (100 * spectrum.cumulative_variance(dimensions), dimensions,
+                                     spectrum.max_dimensions))
+
+    def _on_pca_variance_changed(self, *args):
+        """Put the fewest PCA dimensions that explain the variance
+        threshold entered in the number of dimensions entry, if
+        dimensions are picked by explained variance and the explained
+        variance of the data set has been worked out."""
+        if self._variance is None or not self._Var_pca_by_variance.get():
+            return
+        try:
+            threshold = self._Var_pca_variance.get()
+        except tk.TclError:
+            # the entry is empty or not a number (yet)
+            return
+        if 0 < threshold <= 100:
+            self._Var_pca_dimensions.set(self._variance[1].dimensions_for_variance(threshold / 100))
+
+    # linked to functional requirement #3 - preprocess data files
+    # linked to functional requirement #6 - normalize data
+    def _do_import_and_normalize(self, filtered_file_list, stage_keys):
+        """Import the input data and normalize it into self._data_objs
+        (a SpectralLibrary) and self._dataset, reusing the aligned data
+        of the last run if the stage cache has it.
+        Returns True if successful, False on a fatal error."""
+        self._incremental = False
+        disk_backed = self.app_config.get("DISK_BACKED_DATASET", False)
+        # the aligned data is only kept for the stage cache (a second copy
+        # of the spectra, in memory) if the config asks for it, and never
+        # for a disk-backed dataset; the streaming import normalizes in
+        # place, so it is only used when the aligned data is not kept
+        keep_aligned = stage_keys is not None and not disk_backed and \
+            self.app_config.get("STAGE_CACHE_KEEP_ALIGNED", False)
+        aligned = self._cached_stage("aligned", stage_keys) if keep_aligned else None
+        if aligned is None and not self._Var_align.get() and self._incremental_import_possible():
+            # bring the blocks saved by the last import up to date with
+            # only the new or changed files
+            if not self._do_incremental_import(filtered_file_list):
+                return False
+            self._incremental = True
+        elif aligned is None and not self._Var_align.get() and not keep_aligned and \
+                self.app_config.get("STREAMING_IMPORT", False):
+            # parse, align, normalize and combine the raw ECOSTRESS files
+            # one spectrum at a time
+            if not self._do_streaming_import(filtered_file_list):
+                return False
+        else:
+            if aligned is None:
+                if not self._Var_align.get():
+                    # working with the raw ECOSTRESS files
+                    if not self._do_load_raw_data(filtered_file_list):
+                        return False
+                else:
+                    # working with an already aligned spectral block, so file
+                    # discovery, parsing and alignment can be skipped
+                    if not self._do_load_aligned_data():
+                        return False
+                if keep_aligned:
+                    # combined into one aligned library that is kept for the next run
+                    aligned = SpectralLibrary.from_dataset(dataops.combine(self._data_objs, self._dtype()),
+                                                           self._data_objs)
+                    self._store_stage("aligned", stage_keys, aligned)
+
+            if disk_backed:
+                # the combined dataset lives in a memory-mapped file
+                self._do_preprocess_cube()
+            else:
+                # Normalization
+                self.log("Normalizing data with method: %s" % self._Var_normalize.get())
+                if aligned is not None:
+                    # normalized copy of the aligned library, which is kept as it is
+                    self._data_objs = aligned.normalized(self._Var_normalize.get())
+                    self._dataset = self._data_objs.as_dataframe()
+                else:
+                    # final, pre-processed dataset, normalized as one block
+                    self._dataset = dataops.normalize_combined(self._data_objs, self._Var_normalize.get(),
+                                                               self._dtype())
+        if not isinstance(self._data_objs, SpectralLibrary):
+            # keep the spectra in one compact library backed by the dataset,
+            # instead of a dataframe or two per data object
+            self._data_objs = SpectralLibrary.from_dataset(self._dataset, self._data_objs)
+        return True
+
+    def _stage_keys(self, filtered_file_list):
+        """Return the stage cache key of each stage of the import (see
+        _cached_stage): the fingerprint of the input files (or of the
+        aligned block) and the settings the stage and the stages before
+        it depend on."""
+        if self._Var_align.get():
+            files = fileops.spectral_block_files(self._aligned_data_folder())
+        else:
+            files = filtered_file_list
+        aligned = (fileops.files_fingerprint(files), self._Var_align.get(), self._alignment_settings(),
+                   self._Var_precision.get(), self.app_config.get("HEADER_PRESCAN", False))
+        normalized = aligned + (self._Var_normalize.get(), self.app_config.get("DISK_BACKED_DATASET", False))
+        return {"aligned": aligned,
+                "normalized": normalized,
+                "PCA": normalized + (self._Var_pca_dimensions.get(),)}
+
+    def _cached_stage(self, stage, stage_keys):
+        """Return the result of the stage (a key of stage_keys, see
+        _stage_keys) kept by the stage cache if its key has not changed
+        since, or None if the stage has to be run again."""
+        if stage_keys is None:
+            # the stage cache is off, so free anything it still holds
+            self._stage_cache.clear()
+            return None
+        key, result = self._stage_cache.pop(stage, (None, None))
+        if key != stage_keys[stage]:
+            self.log("Stage cache: %s data has to be made again" % stage)
+            return None
+        self.log("Stage cache hit: reusing %s data from the last run" % stage)
+        self._stage_cache[stage] = (key, result)
+        return result
+
+    def _store_stage(self, stage, stage_keys, result):
+        """Keep the result of the stage in the stage cache, with its key
+        from stage_keys (nothing is kept if the stage cache is off)."""
+        if stage_keys is not None:
+            self._stage_cache[stage] = (stage_keys[stage], result)
+
+    # linked to functional requirement #8 - save data after modification
+    # linked to functional requirement #9 - save clustered data
+    def _save(self, description, save_function, *args):
+        """Save a file with save_function(*args) (one of the save
+        functions in space_file_ops.py) on the background writer,
+        or right away if there is no writer. The data being saved
+        must not be changed afterwards (see _wait_for_writer).
+        description names the file in the log."""
+        if self._writer is None:
+            save_function(*args)
+        else:
+            self._writer.submit(description, save_function, *args)
+
+    def _flush_writer(self):
+        """Start the saves queued on the background writer and check
+        on them until they are done."""
+        if self._writer is not None:
+            self._writer.flush()
+            if not self._writer_polling:
+                self._writer_polling = True
+                self.after(200, self._poll_writer)
+
+    def _poll_writer(self):
+        """Log the saves that have finished on the background writer,
+        checking again later while there are more to come."""
+        self._log_writer_results(self._writer.poll())
+        if self._writer.pending:
+            self.after(200, self._poll_writer)
+        else:
+            self._writer_polling = False
+
+    def _wait_for_writer(self):
+        """Block until every save queued on the background writer is done."""
+        if self._writer is not None and self._writer.pending:
+            self.log("Waiting for %s files to finish saving..." % self._writer.pending)
+            self._log_writer_results(self._writer.wait())
+
+    def _log_writer_results(self, results):
+        """Log the results of background saves and tell the user about failures."""
+        failed = []
+        for description, error in results:
+            if error is None:
+                self.log("Finished saving %s" % description)
+            else:
+                self.log("Could not save %s: %s" % (description, error))
+                failed.append(description)
+        if failed:
+            self._quick_message_box("Could not save:\n%s\nSee the log for details." % "\n".join(failed))
+
+    def _cube_folder(self):
+        """Return the folder for the memory-mapped cube: DISK_BACKEND_FOLDER
+        from the config, or .space_cube under the input folder."""
+        folder = self.app_config.get("DISK_BACKEND_FOLDER")
+        if folder is None:
+            folder = os.path.join(self._Var_folder.get(), ".space_cube")
+        return folder
+
+    # linked to functional requirement #6 - normalize data
+    def _do_preprocess_cube(self):
+        """Combine self._data_objs into a memory-mapped cube, then
+        normalize it in chunks of rows, so a dataset larger than
+        memory never has to be loaded all at once."""
+        folder = self._cube_folder()
+        self.log("Combining data into memory-mapped cube in %s..." % folder)
+        self._cube = cube.combine_to_cube(self._data_objs, folder, self._dtype())
+        # Normalization
+        self.log("Normalizing data with method: %s" % self._Var_normalize.get())
+        cube.normalize_cube(self._cube, self._Var_normalize.get(),
+                            self.app_config.get("DISK_BACKEND_CHUNK_ROWS", 256))
+        # final, pre-processed dataset (a view of the cube)
+        self._dataset = self._cube.as_dataframe()
+
+    def _collect_input_files(self):
+        """Find all files in the input folder and subfolders that match
+        the filename filter.
+        If USE_FILE_MANIFEST is on in the config, the list is read from
+        the manifest file in the input folder instead of walking the
+        folder, and the manifest is written after a walk if it does not
+        exist yet.
+        Returns the list of files, or None on a fatal error."""
+        manifest_file = None
+        if self.app_config.get("USE_FILE_MANIFEST", False):
+            manifest_file = os.path.join(self._Var_folder.get(),
+                                         self.app_config.get("FILE_MANIFEST_NAME", "file_manifest.txt"))
+        if manifest_file is not None and fileops.path_exists(manifest_file):
+            self.log("Reading file list from manifest %s (delete it to search the folder again)" % manifest_file)
+            filtered_file_list = fileops.read_file_manifest(manifest_file)
+        else:
+            # search input folder and subfolders for files matching the filename filter
+            filtered_file_list = fileops.find_spectrum_files(self._Var_folder.get())
+            if manifest_file is not None:
+                self.log("Writing file manifest %s" % manifest_file)
+                fileops.write_file_manifest(manifest_file, filtered_file_list)
         self.log("Found %s files matching the filename filter criteria" % len(filtered_file_list))
         if len(filtered_file_list) == 0:
             # a empty path is a fatal error
             # log to console and pop up a messagebox
             self.log("No files found path: %s" % self._Var_folder.get())
             self._quick_message_box("No files found:\n%s" % self._Var_folder.get())
-            return
-        # parse
-        if not self._Var_align:
-            #This means we are working with the raw Ecostress files,
-            #if false, we are working with already aligned files, and we can skip this step
-            self.log("Loading into data objects...")
-            self._data_objs, return_msg = dataops.file_to_data_object(filtered_file_list)
-            if not self._data_objs:
+            return None
+        return filtered_file_list
+
+    # linked to functional requirement #3 - preprocess data files
+    def _do_header_prescan(self, file_list, error_report):
+        """If HEADER_PRESCAN is on in the config, read only the headers
+        of the files in file_list to find their common range before any
+        numerical data is parsed (see space_data_ops.prescan_header).
+        Files with no overlap with the others are removed from file_list
+        and reported in error_report.
+        Returns the common range as a tuple (min, max), (None, None) if
+        there is no range in common (a fatal error), or None if the
+        prescan is off or not possible (the range is then found after
+        parsing)."""
+        if not self.app_config.get("HEADER_PRESCAN", False):
+            return None
+        self.log("Pre-scanning file headers for the common range...")
+        header_ranges = []
+        for item in file_list:
+            header_range, return_msg = dataops.prescan_header(item)
+            if header_range is None:
                 self.log(return_msg)
-                self._quick_message_box(return_msg)
-                return
-            self.log("Loaded %s data objects" % len(self._data_objs))
-            # re-index the pairs dataframes
-            self.log("Re-indexing pairs dataframes...")
-            dataops.reindex(self._data_objs)
+                self.log("Header prescan not possible, the common range will be found after loading")
+                return None
+            header_ranges.append(header_range)
+        min, max, rejected = dataops.find_prescan_range(header_ranges)
+        for index in reversed(rejected):
+            error_report.insert(0, "%s has no wavelength range in common with the other files" % file_list[index])
+            del file_list[index]
+        if (min, max) == (None, None):
+            # lack of a common range across files is a fatal error
+            # log to console and pop up a messagebox
+            for return_msg in error_report:
+                self.log(return_msg)
+            self.log("No range in common!")
+            self._quick_message_box("No range in common!")
+            return min, max
+        self.log("All file headers have this wavelength range in common: %s to %s" % (min, max))
+        return min, max
+
+    def _report_load_errors(self, error_report):
+        """Log the files that could not be loaded and tell the user.
+        Returns True if at least one data object was loaded."""
+        for return_msg in error_report:
+            self.log(return_msg)
+        if not self._data_objs:
+            self._quick_message_box("None of the files could be loaded, see the log for details.")
+            return False
+        self.log("Loaded %s data objects" % len(self._data_objs))
+        if error_report:
+            self.log("Skipped %s files that could not be loaded" % len(error_report))
+            self._quick_message_box("%s files could not be loaded and were skipped, see the log for details."
+                                    % len(error_report))
+        return True
+
+    # linked to functional requirement #3 - preprocess data files
+    # linked to functional requirement #6 - normalize data
+    def _do_streaming_import(self, filtered_file_list):
+        """Run the raw ECOSTRESS files in filtered_file_list (see
+        _collect_input_files) through the streaming pipeline (see
+        space_pipeline.py) into self._data_objs and self._dataset.
+        If the header prescan gives the common range and the data is
+        aligned to a uniform grid, it is done in one pass (see
+        space_pipeline.stream_spectra), otherwise every parsed spectrum
+        is held until the range is known.
+        Returns True if successful, False on a fatal error."""
+        error_report = []
+        x_range = self._do_header_prescan(filtered_file_list, error_report)
+        if x_range == (None, None):
+            return False
+        out_folder = self._cube_folder() if self.app_config.get("DISK_BACKED_DATASET", False) else None
+        aligned_folder = None
+        if self._Var_save_after_modify.get() or self.app_config.get("INCREMENTAL_IMPORT", False):
+            aligned_folder = os.path.join(self._Var_folder.get(), "aligned")
+        cache = self._open_parse_cache()
+        grid = None if x_range is None else self._alignment_grid(*x_range)
+        if grid is not None:
+            self.log("Loading, aligning to a uniform grid of %s wavelengths and normalizing data with method: %s..."
+                     % (len(grid), self._Var_normalize.get()))
+            if aligned_folder is not None:
+                self.log("Saving aligned data while aligning...")
+            self._data_objs, self._dataset, self._cube = pipeline.stream_spectra(
+                filtered_file_list, error_report, x_range, grid, self._Var_normalize.get(),
+                self.app_config.get("IMPORT_WORKERS"), self.app_config.get("IMPORT_CHUNK_SIZE"), cache,
+                out_folder, aligned_folder, self._Var_bin_average.get(), self._aligned_block_info(*x_range),
+                self._dtype())
+            if cache is not None:
+                self.log("Parse cache: %s files loaded from cache, %s files parsed" % (cache.hits, cache.misses))
+            return self._report_load_errors(error_report)
+        self.log("Loading and re-indexing data objects...")
+        self._data_objs, min, max, align_to = pipeline.scan_spectra(
+            filtered_file_list, error_report, self.app_config.get("IMPORT_WORKERS"),
+            self.app_config.get("IMPORT_CHUNK_SIZE"), cache, x_range)
+        if cache is not None:
+            self.log("Parse cache: %s files loaded from cache, %s files parsed" % (cache.hits, cache.misses))
+        if not self._report_load_errors(error_report):
+            return False
+        if (min, max) == (None, None):
+            # lack of a common range across files is a fatal error
+            # log to console and pop up a messagebox
+            self.log("No range in common!")
+            self._quick_message_box("No range in common!")
+            self._data_objs = []
+            return False
+        self.log("All files have this wavelength range in common: %s to %s" % (min, max))
+        self.log("Truncating, aligning and normalizing data with method: %s..." % self._Var_normalize.get())
+        if aligned_folder is not None:
+            self.log("Saving aligned data while aligning...")
+        grid = self._alignment_grid(min, max)
+        if grid is not None:
+            self.log("Aligning the data to a uniform grid of %s wavelengths" % len(grid))
+        self._dataset, self._cube = pipeline.assemble_spectra(
+            self._data_objs, min, max, align_to, self._Var_normalize.get(), out_folder, aligned_folder,
+            grid, self._Var_bin_average.get(), self._aligned_block_info(min, max),
+            truncated=x_range is not None, dtype=self._dtype())
+        return True
+
+    # linked to functional requirement #3 - preprocess data files
+    # linked to functional requirement #6 - normalize data
+    def _do_load_raw_data(self, filtered_file_list):
+        """Parse, truncate and align the raw ECOSTRESS files in
+        filtered_file_list (see _collect_input_files) into self._data_objs.
+        Returns True if successful, False on a fatal error."""
+        prescan_report = []
+        x_range = self._do_header_prescan(filtered_file_list, prescan_report)
+        if x_range == (None, None):
+            return False
+        # parse
+        self.log("Loading into data objects...")
+        cache = self._open_parse_cache()
+        self._data_objs, error_report = dataops.parallel_file_to_data_object(
+            filtered_file_list, self.app_config.get("IMPORT_WORKERS"), self.app_config.get("IMPORT_CHUNK_SIZE"),
+            cache, x_range)
+        error_report = prescan_report + error_report
+        if cache is not None:
+            self.log("Parse cache: %s files loaded from cache, %s files parsed" % (cache.hits, cache.misses))
+        # re-index the pairs dataframes
+        self.log("Re-indexing pairs dataframes...")
+        dataops.reindex(self._data_objs)
+        if x_range is not None:
+            # only the data inside the common range was read, so there is nothing to truncate
+            self._data_objs = dataops.drop_out_of_range(self._data_objs, x_range, error_report)
+        if not self._report_load_errors(error_report):
+            return False
+        if x_range is not None:
+            min, max = x_range
+        else:
             # range check
             self.log("Calculating common range...")
             min, max = dataops.find_common_range(self._data_objs)
@@ -372,61 +1068,232 @@ class SpaceApp(tk.Frame):
                 self.log("No range in common!")
                 self._quick_message_box("No range in common!")
                 self._data_objs = []
-                return
+                return False
             else:
                 self.log("All files have this wavelength range in common: %s to %s" % (min, max))
             # truncate to common range
             self.log("Truncating data to range %s to %s..." % (min, max))
             dataops.truncate(self._data_objs, min, max)
+        grid = self._alignment_grid(min, max)
+        if grid is None:
             # finds the index of the file with the highest resolution
             self.log("Finding highest resolution file...")
             max_res_index = dataops.find_max_res(self._data_objs)
             # align the pairs dataframes to dataframe with highest resolution
             self.log("Aligning the data...")
-            dataops.align(self._data_objs, max_res_index)
-            if self._Var_save_after_modify.get():
-                self.log("Saving aligned data...")
-                fileops.save_data_files(self._Var_folder.get(), "aligned", self._data_objs)
+            dataops.align(self._data_objs, max_res_index, self._dtype())
         else:
-            #Working with already aligned files
-            self.log("Loading aligned files into data objects...")
-            self._data_objs = dataops.aligned_file_to_data_object(filtered_file_list)
-            self.log("Loaded %s data objects" % len(self._data_objs))
+            # align the pairs dataframes to a uniform grid
+            self.log("Aligning the data to a uniform grid of %s wavelengths..." % len(grid))
+            dataops.align_to_grid(self._data_objs, grid, self._Var_bin_average.get(), self._dtype())
+        if self._Var_save_after_modify.get() or self.app_config.get("INCREMENTAL_IMPORT", False):
+            self.log("Saving aligned data...")
+            # normalization replaces the 'pairs' dataframe of each data object
+            # (without changing it), so the save gets shallow copies that keep
+            # the aligned ones
+            self._save("aligned data", fileops.save_spectral_block, self._Var_folder.get(), "aligned",
+                       [copy.copy(dobj) for dobj in self._data_objs], self._aligned_block_info(min, max))
+        return True
 
-        # Normalization
-        self.log("Normalizing data with method: %s" % self._Var_normalize.get())
-        self._data_objs = dataops.NORMALIZATION_TYPES[self._Var_normalize.get()](self._data_objs)
-        if self._Var_save_after_modify.get():
-            self.log("Saving normalized data...")
-            fileops.save_data_files(self._Var_folder.get(), "normalized", self._data_objs)
-        # final, pre-processed dataset
-        self._dataset = dataops.combine(self._data_objs)
-        if self._Var_save_after_modify.get():
-            self.log("Saving final combined dataframe...")
-            fileops.save_block_data(self._Var_folder.get(), "block", self._dataset)
-        # PCA
-        if self._Var_pca.get():
-            self.log('Performing PCA to ' + str(self._Var_pca_dimensions.get()) + ' dimensions...')
-            self._dataset = dataops.pca(self._dataset, self._Var_pca_dimensions.get())
-            self.log('PCA applied')
-            if self._Var_save_after_modify.get():
-                self.log("Saving PCA-reduced data...")
-                # the folder suffix here is a nested subfolder path like:
-                # \block\PCA-<number of dimensions> so the individual
-                # path components are passed as a tuple
-                fileops.save_block_data(self._Var_folder.get(), ("block", "PCA-" + self._Entry_pca.get()),
-                                        self._dataset)
+    def _incremental_import_possible(self):
+        """Return True if INCREMENTAL_IMPORT is on in the config and
+        an aligned block saved by an earlier import with the same
+        alignment settings and precision is in the 'aligned' subfolder
+        of the input folder."""
+        folder = os.path.join(self._Var_folder.get(), "aligned")
+        if not self.app_config.get("INCREMENTAL_IMPORT", False) or not fileops.spectral_block_exists(folder):
+            return False
+        info = fileops.read_block_info(folder)
+        saved_settings = (info.get("alignment_target", "Highest resolution"), info.get("grid_value"),
+                          info.get("bin_average", False))
+        if saved_settings != self._alignment_settings():
+            self.log("Alignment settings changed since the last import, importing all files again")
+            return False
+        if info.get("precision", "float64") != self._Var_precision.get():
+            self.log("Precision changed since the last import, importing all files again")
+            return False
+        return True
 
-        self.log("-- End data import and pre-processing --")
+    # linked to functional requirement #3 - preprocess data files
+    # linked to functional requirement #6 - normalize data
+    def _do_incremental_import(self, filtered_file_list):
+        """Update the aligned and normalized blocks saved by an earlier
+        import with only the files in filtered_file_list (see
+        _collect_input_files) that are new or have changed since (see space_pipeline.update_spectra), then load
+        the normalized block into self._data_objs and self._dataset.
+        Returns True if successful, False on a fatal error."""
+        aligned_folder = os.path.join(self._Var_folder.get(), "aligned")
+        normalized_folder = os.path.join(self._Var_folder.get(), "normalized")
+        self.log("Updating aligned data in %s with new or changed files..." % aligned_folder)
+        cache = self._open_parse_cache()
+        error_report = []
+        added, dropped = pipeline.update_spectra(
+            filtered_file_list, aligned_folder, normalized_folder, self._Var_normalize.get(), error_report,
+            self.app_config.get("IMPORT_WORKERS"), self.app_config.get("IMPORT_CHUNK_SIZE"), cache,
+            self.app_config.get("DISK_BACKEND_CHUNK_ROWS", 256))
+        self.log("Added %s new or changed files, dropped %s files that are gone" % (added, dropped))
+        # load the up to date normalized block, memory-mapped if the
+        # dataset is disk-backed, otherwise read into memory
+        disk_backed = self.app_config.get("DISK_BACKED_DATASET", False)
+        normalized_cube = cube.SpectralCube(normalized_folder, *fileops.load_spectral_block(
+            normalized_folder, mmap_mode="r" if disk_backed else None))
+        self._data_objs = normalized_cube.data_objects()
+        if not self._report_load_errors(error_report):
+            return False
+        self._dataset = normalized_cube.as_dataframe()
+        if disk_backed:
+            self._cube = normalized_cube
+        return True
+
+    # linked to functional requirement #5 - accept input from data files
+    def _do_load_aligned_data(self):
+        """Load a spectral block saved by a previous run (see
+        space_file_ops.save_spectral_block) into self._data_objs.
+        The block is looked for in the 'aligned' subfolder of the
+        input folder first, then in the input folder itself.
+        Returns True if successful, False on a fatal error."""
+        folder = self._aligned_data_folder()
+        if not fileops.spectral_block_exists(folder):
+            # a missing block is a fatal error
+            self.log("No aligned data found in: %s" % self._Var_folder.get())
+            self._quick_message_box("No aligned data found in:\n%s" % self._Var_folder.get())
+            return False
+        self.log("Loading aligned data from %s..." % folder)
+        self._data_objs = dataops.block_to_data_objects(*fileops.load_spectral_block(folder))
+        self.log("Loaded %s data objects" % len(self._data_objs))
+        return True
+
+    def _aligned_data_folder(self):
+        """Return the folder of the aligned spectral block to load: the
+        'aligned' subfolder of the input folder if it has a block,
+        otherwise the input folder itself."""
+        folder = os.path.join(self._Var_folder.get(), "aligned")
+        if not fileops.spectral_block_exists(folder):
+            folder = self._Var_folder.get()
+        return folder
 
     # linked to functional requirement #1 - kmeans clustering algorithm
     def _do_kmeans_clustering(self):
         self.log("-- Begin K-means clustering --")
-        self.log("Clustering...")
-        self._k_clusters = km.do_Kmeans(self._Var_kmeans_clusters.get(), self._dataset)
+        self.log("Clustering with %s..." % self._Var_kmeans_engine.get())
+        swept = self._swept_kmeans()
+        if swept is not None:
+            # fitted to the same data by the last K sweep
+            self.log("Using the K = %d model from the K sweep" % self._Var_kmeans_clusters.get())
+            self._k_clusters = swept
+        elif self._Var_kmeans_engine.get() == "Mini-batch K-means" and self._cube is not None and \
+                not self._Var_pca.get() and self.app_config.get("MINIBATCH_KMEANS_STREAMING", False):
+            # the dataset is the disk-backed cube, so stream it in chunks
+            # of rows instead of reading all of it into memory
+            self.log("Streaming mini-batches from the disk-backed data set")
+            batch_size = self.app_config.get("MINIBATCH_KMEANS_BATCH_SIZE", 1024)
+            max_no_improvement = self.app_config.get("MINIBATCH_KMEANS_MAX_NO_IMPROVEMENT", 10)
+            self._k_clusters = km.stream_minibatch_Kmeans(self._Var_kmeans_clusters.get(), self._cube.matrix,
+                                                          batch_size, max_no_improvement,
+                                                          init=self._warm_start_centers(self._cube.matrix))
+        else:
+            self._k_clusters = self._fit_kmeans(self._dataset, init=self._warm_start_centers(self._dataset))
+        # the labels and the spectra they belong to, for the next run to
+        # start from if warm start is on (see _warm_start_centers)
+        self._k_previous = (self._data_objs.table["path"].to_numpy(), np.array(self._k_clusters.labels_))
         self.log("-- End K-means clustering --")
         self._kmeans_viz_panel.enable_widgets()
 
+    # linked to functional requirement #1 - kmeans clustering algorithm
+    def _fit_kmeans(self, dataset, random_state=None, init=None):
+        """Cluster dataset with the K-means engine selected, starting from
+        the centroids init if given, and return the kmeans object (see
+        space_kmeans.py)."""
+        if self._Var_kmeans_engine.get() == "Mini-batch K-means":
+            return km.do_minibatch_Kmeans(self._Var_kmeans_clusters.get(), dataset,
+                                          self.app_config.get("MINIBATCH_KMEANS_BATCH_SIZE", 1024),
+                                          self.app_config.get("MINIBATCH_KMEANS_MAX_NO_IMPROVEMENT", 10),
+                                          random_state, init)
+        return km.do_Kmeans(self._Var_kmeans_clusters.get(), dataset, random_state, init)
+
+    def _warm_start_centers(self, matrix):
+        """Return the initial centroids for K-means on matrix (the
+        dataset being clustered) from the clusters of the last K-means
+        run (see space_kmeans.warm_start_centers), or None to start
+        from scratch (warm start is off, or there is nothing to start
+        from)."""
+        if not self._Var_kmeans_warm_start.get():
+            return None
+        if self._k_previous is None:
+            self.log("No earlier K-means run to warm start from, starting from scratch")
+            return None
+        centers = km.warm_start_centers(matrix, self._data_objs.table["path"], *self._k_previous,
+                                        self._Var_kmeans_clusters.get(),
+                                        self.app_config.get("DISK_BACKEND_CHUNK_ROWS", 256))
+        if centers is None:
+            self.log("None of the spectra of the last K-means run are in the data set, starting from scratch")
+        else:
+            self.log("Warm starting K-means from the %d clusters of the last run" % len(np.unique(self._k_previous[1])))
+        return centers
+
+    def _dataset_is_cube(self):
+        """Return True if self._dataset is a view of the disk-backed cube
+        (not reduced by PCA)."""
+        return self._cube is not None and np.may_share_memory(self._dataset.to_numpy(), self._cube.matrix)
+
+    def _swept_kmeans(self):
+        """Return the kmeans object the last K sweep fitted for the
+        number of clusters entered, or None if the sweep did not fit it
+        with the same engine and on the same dataset."""
+        if self._k_sweep is None:
+            return None
+        dataset, engine, models = self._k_sweep
+        if dataset is not self._dataset or engine != self._Var_kmeans_engine.get():
+            return None
+        return models.get(self._Var_kmeans_clusters.get())
+
+    # linked to functional requirement #1 - kmeans clustering algorithm
+    def _on_sweep_k(self):
+        """Cluster the pre-processed dataset with K-means for every K in
+        the sweep range (see space_kmeans.kmeans_sweep), log and plot
+        the inertia and silhouette of each K, and keep the fitted
+        models so that pressing Go with one of these K values on the
+        same data does not fit K-means again."""
+        self.log("user: pressed Sweep button (K-means)")
+        if self._dataset is None or len(self._data_objs) == 0:
+            # nothing to sweep
+            self.log("No data to sweep K over. Press Go to import the data first.")
+            self._quick_message_box("No data to sweep K over.\nPress Go to import the data first.")
+            return
+        k_min, k_max = self._Var_sweep_min.get(), self._Var_sweep_max.get()
+        if not 2 <= k_min <= k_max < len(self._dataset):
+            # a bad range is a fatal error
+            self.log("K sweep range must be from at least 2 to less than the number of spectra (%d)."
+                     % len(self._dataset))
+            self._quick_message_box("K sweep range must be from at least 2 to less than the number of spectra (%d)."
+                                    % len(self._dataset))
+            return
+        self.master.config(cursor="watch")
+        self.master.update_idletasks()
+        self.log("-- Begin K-means sweep (K = %d to %d) --" % (k_min, k_max))
+        engine = self._Var_kmeans_engine.get()
+        # a disk-backed cube is handed over as its memory-mapped matrix, so
+        # the workers map it instead of each getting a copy in memory
+        dataset = self._cube.matrix if self._dataset_is_cube() else self._dataset
+        metrics, models = km.kmeans_sweep(range(k_min, k_max + 1), dataset, engine,
+                                          self.app_config.get("MINIBATCH_KMEANS_BATCH_SIZE", 1024),
+                                          self.app_config.get("MINIBATCH_KMEANS_MAX_NO_IMPROVEMENT", 10),
+                                          self.app_config.get("KMEANS_SWEEP_SILHOUETTE_SAMPLE", 2000),
+                                          self.app_config.get("KMEANS_SWEEP_WORKERS"))
+        for k, row in metrics.iterrows():
+            self.log("K = %d: inertia %.6g, silhouette %.4f, %.2f s" % (k, row["inertia"], row["silhouette"],
+                                                                        row["seconds"]))
+        self._k_sweep = (self._dataset, engine, models)
+        for widget in self._Tab_sweep.winfo_children():
+            widget.destroy()
+        canvas = km.plot_sweep(metrics, embedded=True, master=self._Tab_sweep)
+        # pack, not grid, like the canvas of the visualization panels
+        canvas.get_tk_widget().pack(side=tk.TOP, fill=tk.BOTH, expand=1)
+        toolbar = NavigationToolbar2Tk(canvas, self._Tab_sweep)
+        toolbar.update()
+        self.log("-- End K-means sweep --")
+        self.master.config(cursor="")
+
     # linked to functional requirement #2 - dbscan clustering algorithm
     def _do_dbscan_clustering(self):
         # epsilon: self._Var_eps.get()
@@ -437,6 +1304,87 @@ class SpaceApp(tk.Frame):
         self.log("-- End DBSCAN clustering --")
         self._dbscan_viz_panel.enable_widgets()
 
+    def _do_precision_report(self):
+        """Log how much memory the chosen precision saves over float64,
+        and whether the clusters shown to the user are the ones a
+        float64 run would give. The float64 run parses, aligns and
+        normalizes the same files again in float64 (see
+        _float64_reference) and does PCA again if it was on, so it
+        takes about as long as the run itself (PRECISION_REPORT is off
+        by default). K-means is fitted to both precisions from the same
+        spectra as initial centroids, picked by k-means++ with a fixed
+        seed (see space_kmeans.kmeans_plusplus_rows), so only the
+        precision can change the labels.
+        The report is skipped for a disk-backed dataset, which would
+        have to be read into memory twice over."""
+        if self._cube is not None:
+            self.log("Precision report skipped: the data set is disk-backed")
+            return
+        self.log("-- Begin precision report (%s vs float64) --" % self._Var_precision.get())
+        spectra = self._data_objs.matrix
+        saved = spectra.size * np.dtype(np.float64).itemsize - spectra.nbytes
+        self.log("Spectra: %.1f MB in %s, %.1f MB saved over float64"
+                 % (spectra.nbytes / 2 ** 20, self._Var_precision.get(), saved / 2 ** 20))
+        reference = self._float64_reference()
+        if reference is None:
+            self.log("-- End precision report --")
+            return
+        if self._Var_pca.get():
+            reference = self._do_pca(reference, self._Var_pca_dimensions.get())
+            if reference is None:
+                self.log("-- End precision report --")
+                return
+        if self._Var_kmeans.get():
+            num_clusters = self._Var_kmeans_clusters.get()
+            rows = km.kmeans_plusplus_rows(reference, num_clusters, random_state=0)
+            labels = km.do_Kmeans(num_clusters, self._dataset, init=self._dataset.to_numpy()[rows]).labels_
+            reference_labels = km.do_Kmeans(num_clusters, reference, init=reference.to_numpy()[rows]).labels_
+            self._log_label_agreement("K-means", labels, reference_labels)
+        if self._Var_dbscan.get():
+            reference_labels = db.do_dbscan(self._Var_eps.get(), self._Var_minpts.get(), reference).labels_
+            self._log_label_agreement("DBSCAN", self._db_clusters.labels_, reference_labels)
+        self.log("-- End precision report --")
+
+    def _float64_reference(self):
+        """Return the spectra of self._data_objs pre-processed again in
+        float64 from their source: the raw files are parsed, aligned and
+        normalized again, or the aligned block is normalized again if
+        the input is pre-aligned. Returns None (after logging why) if
+        the files no longer give the same spectra."""
+        self.log("Pre-processing the same spectra again in float64...")
+        if self._Var_align.get():
+            matrix, _, table = fileops.load_spectral_block(self._aligned_data_folder())
+            if str(matrix.dtype) != "float64":
+                self.log("Note: the aligned block was saved in %s, only normalization is redone in float64"
+                         % matrix.dtype)
+            matrix = np.array(matrix, dtype=np.float64)
+            dataops.NORMALIZATION_TYPES[self._Var_normalize.get()](matrix)
+            reference = DataFrame(matrix)
+        else:
+            error_report = []
+            data_objects, min, max, align_to = pipeline.scan_spectra(
+                list(self._data_objs.table["path"]), error_report, self.app_config.get("IMPORT_WORKERS"),
+                self.app_config.get("IMPORT_CHUNK_SIZE"), self._open_parse_cache())
+            if error_report or (min, max) == (None, None):
+                self.log("Precision report skipped: the input files could not be imported again")
+                return None
+            reference, _ = pipeline.assemble_spectra(data_objects, min, max, align_to, self._Var_normalize.get(),
+                                                     grid=self._alignment_grid(min, max),
+                                                     bin_average=self._Var_bin_average.get(), dtype=np.float64)
+        if reference.shape != self._data_objs.matrix.shape:
+            self.log("Precision report skipped: the float64 run gave a data set of a different shape")
+            return None
+        return reference
+
+    def _log_label_agreement(self, algorithm, labels, reference_labels):
+        """Log whether two clusterings of the same spectra agree (up to
+        the numbering of the clusters)."""
+        score = adjusted_rand_score(reference_labels, labels)
+        if score == 1.0:
+            self.log("%s: labels match the float64 run" % algorithm)
+        else:
+            self.log("%s: labels differ from the float64 run (adjusted Rand index %.4f)" % (algorithm, score))
+
     # linked to functional requirement #8 - save data after modification
     # linked to functional requirement #9 - save clustered data
     # linked to non-functional requirement #4 - save as .csv files
@@ -448,35 +1396,44 @@ class SpaceApp(tk.Frame):
             self.log("Calculating K-Means cluster compositions...")
             if self.saving_params["kmeans"]["comp"]:
                 comprehensive_composition = km.do_comprehensive(self._k_clusters, self._data_objs)
-                fileops.save_composition(self.saving_params["folder"], "kmeans", "comprehensive", comprehensive_composition)
+                self._save("K-means comprehensive composition", fileops.save_composition,
+                           self.saving_params["folder"], "kmeans", "comprehensive", comprehensive_composition)
             if self.saving_params["kmeans"]["by_type"]:
                 composition_by_type = km.calculate_composition(self._k_clusters, self._Var_kmeans_clusters.get(),
                                                                self._data_objs, 1)
-                fileops.save_composition(self.saving_params["folder"], "kmeans", "by_type", composition_by_type)
+                self._save("K-means by type composition", fileops.save_composition,
+                           self.saving_params["folder"], "kmeans", "by_type", composition_by_type)
             if self.saving_params["kmeans"]["by_class"]:
                 composition_by_class = km.calculate_composition(self._k_clusters, self._Var_kmeans_clusters.get(),
                                                                 self._data_objs, 2)
-                fileops.save_composition(self.saving_params["folder"], "kmeans", "by_class", composition_by_class)
+                self._save("K-means by class composition", fileops.save_composition,
+                           self.saving_params["folder"], "kmeans", "by_class", composition_by_class)
             if self.saving_params["kmeans"]["by_subclass"]:
                 composition_by_subclass = km.calculate_composition(self._k_clusters, self._Var_kmeans_clusters.get(),
                                                                    self._data_objs, 3)
-                fileops.save_composition(self.saving_params["folder"], "kmeans", "by_subclass", composition_by_subclass)
+                self._save("K-means by subclass composition", fileops.save_composition,
+                           self.saving_params["folder"], "kmeans", "by_subclass", composition_by_subclass)
             self.log("Finished K-Means cluster compositions...")
         if self.saving_params["dbscan"]["save"]:
             self.log("Calculating DBSCAN cluster compositions...")
             if self.saving_params["dbscan"]["comp"]:
                 comprehensive_composition = db.do_comprehensive(self._db_clusters, self._data_objs)
-                fileops.save_composition(self.saving_params["folder"], "dbscan", "comprehensive", comprehensive_composition)
+                self._save("DBSCAN comprehensive composition", fileops.save_composition,
+                           self.saving_params["folder"], "dbscan", "comprehensive", comprehensive_composition)
             if self.saving_params["dbscan"]["by_type"]:
                 composition_by_type = db.db_comp(self._db_clusters, self._data_objs, 1)
-                fileops.save_composition(self.saving_params["folder"], "dbscan", "by_type", composition_by_type)
+                self._save("DBSCAN by type composition", fileops.save_composition,
+                           self.saving_params["folder"], "dbscan", "by_type", composition_by_type)
             if self.saving_params["dbscan"]["by_class"]:
                 composition_by_class = db.db_comp(self._db_clusters, self._data_objs, 2)
-                fileops.save_composition(self.saving_params["folder"], "dbscan", "by_class", composition_by_class)
+                self._save("DBSCAN by class composition", fileops.save_composition,
+                           self.saving_params["folder"], "dbscan", "by_class", composition_by_class)
             if self.saving_params["dbscan"]["by_subclass"]:
                 composition_by_subclass = db.db_comp(self._db_clusters, self._data_objs, 3)
-                fileops.save_composition(self.saving_params["folder"], "dbscan", "by_subclass", composition_by_subclass)
+                self._save("DBSCAN by subclass composition", fileops.save_composition,
+                           self.saving_params["folder"], "dbscan", "by_subclass", composition_by_subclass)
             self.log("Finished DBSCAN cluster compositions...")
+        self._flush_writer()
 
     def _on_go(self):
         # this might take a while, so disable the buttons and busy the cursor
@@ -500,10 +1457,13 @@ class SpaceApp(tk.Frame):
         if self._validate_user_input():
             # all input checks passed
             self._do_import_data()
-            if self._Var_kmeans.get() and self._data_objs != []:
+            if self._Var_kmeans.get() and len(self._data_objs) > 0:
                 self._do_kmeans_clustering()
-            if self._Var_dbscan.get() and self._data_objs != []:
+            if self._Var_dbscan.get() and len(self._data_objs) > 0:
                 self._do_dbscan_clustering()
+            if self._Var_precision.get() != "float64" and self.app_config.get("PRECISION_REPORT", False) and \
+                    len(self._data_objs) > 0:
+                self._do_precision_report()
             # re-enable the save button if at least one algorithm was selected
             if self._Var_kmeans.get() or self._Var_dbscan.get():
                 self._Button_save["state"] = "normal"
@@ -523,9 +1483,42 @@ class SpaceApp(tk.Frame):
                    kmeans=self._Var_kmeans.get(), dbscan=self._Var_dbscan.get())
 
     def _on_close(self):
+        # finish any saves still running in the background before exiting
+        if self._writer is not None:
+            self._writer.shutdown()
         self.master.quit()
         self.master.destroy()
 
+    # linked to non-functional requirement #2 - perform 2D and 3D visualization in 5 minutes or less
+    # linked to functional requirement #7 - PCA
+    def _plot_projection(self, dimensions):
+        """Return self._dataset reduced with PCA to dimensions (2 or 3)
+        for plotting. PCA is fitted once per dataset, to the 3 dimensions
+        of a 3D plot, and the 2D view is its first two components, so
+        switching between 2D and 3D or between the K-means and DBSCAN
+        plots does not run PCA again until self._dataset changes.
+        Returns None if PCA failed."""
+        if self._projection is None or self._projection[0] is not self._dataset:
+            self.log("PCA reducing data to 3 dimensions for plotting...")
+            if self._dataset_is_cube():
+                # the dataset is the disk-backed cube, so it is read in
+                # chunks of rows instead of copied into memory
+                projection, return_msg = cube.pca_cube(self._cube, 3,
+                                                       self.app_config.get("DISK_BACKEND_CHUNK_ROWS", 256))
+                if projection is None:
+                    self.log(return_msg)
+                    self._quick_message_box(return_msg)
+                    return None
+            else:
+                # PCA centers its input in place, so it works on a copy
+                projection = self._do_pca(self._dataset.copy(), 3)
+                if projection is None:
+                    return None
+            self._projection = (self._dataset, projection)
+        else:
+            self.log("Reusing the PCA projection of the data set")
+        return self._projection[1].iloc[:, :dimensions]
+
     # linked to non-functional requirement #2 - perform 2D and 3D visualization in 5 minutes or less
     # linked to functional requirement #11 - visualize clustered data
     def _on_generate_plot_kmeans(self):
@@ -546,8 +1539,9 @@ class SpaceApp(tk.Frame):
             plot_dataset = self._dataset
             plot = km.plot2D
         else:
-            self.log("PCA reducing data to %s dimensions..." % dimensions)
-            plot_dataset = dataops.pca(self._dataset, dimensions)
+            plot_dataset = self._plot_projection(dimensions)
+            if plot_dataset is None:
+                return
         self.log("Plotting...")
         canvas = plot(plot_dataset, self._k_clusters, embedded=True,
                       master=self._kmeans_viz_panel.get_canvas_frame_handle())
@@ -575,8 +1569,9 @@ class SpaceApp(tk.Frame):
             plot_dataset = self._dataset
             plot = db.plot2D
         else:
-            self.log("PCA reducing data to %s dimensions..." % dimensions)
-            plot_dataset = dataops.pca(self._dataset, dimensions)
+            plot_dataset = self._plot_projection(dimensions)
+            if plot_dataset is None:
+                return
         self.log("Plotting...")
         canvas = plot(plot_dataset, self._db_clusters, embedded=True,
                       master=self._dbscan_viz_panel.get_canvas_frame_handle())
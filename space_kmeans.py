@@ -33,29 +33,311 @@
 # space_kmeans.py
 # This file contains function related to the KMeans algorithm.
 #
-# Includes: K-means clustering, calculate cluster
-# composition, 2D plotting, 3D plotting.
+# Includes: K-means clustering (full batch, mini-batch, and mini-batch
+# streamed from a block of spectra), warm-start centroids from a
+# previous run, sweeping K over a pool of worker processes, calculate
+# cluster composition, 2D plotting, 3D plotting, sweep plotting.
 
-from sklearn.cluster import KMeans
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from sklearn.base import clone
+from sklearn.cluster import KMeans, MiniBatchKMeans, kmeans_plusplus
+from sklearn.metrics import silhouette_score
+from sklearn.metrics.pairwise import euclidean_distances
+from sklearn.utils import check_random_state
+from threadpoolctl import threadpool_limits
+import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
 from matplotlib.figure import Figure
+from matplotlib.ticker import MaxNLocator
 from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
+import space_data_ops as dataops
+
+# K-means engines to choose from in the GUI
+KMEANS_ENGINES = ("K-means", "Mini-batch K-means")
+
+# the block of spectra and the settings of a K sweep, set once in
+# each worker process (see kmeans_sweep)
+_sweep = None
 
 
 # linked to functional requirement #1 - kmeans clustering algorithm
-def do_Kmeans(num_clusters, dataset):
+def do_Kmeans(num_clusters, dataset, random_state=None, init=None):
     """
     This function accepts an integer number of clusters and
     a combined pandas dataframe of shape n_samples x n_features.
     It fits the dataset, and returns a kmeans object which has
     attributes that describe the cluster centroids,
     and which cluster each sample is in.
+    A random_state makes the initial centroids (and so the result)
+    the same on every run.
+    If init (num_clusters x n_features initial centroids, e.g. from
+    warm_start_centers) is given, K-means starts from it, once,
+    instead of from several random initializations.
+    """
+    if init is not None:
+        return KMeans(n_clusters=num_clusters, init=init, n_init=1, random_state=random_state).fit(dataset)
+    kmeans = KMeans(n_clusters=num_clusters, random_state=random_state).fit(dataset)
+    return kmeans
+
+
+# linked to functional requirement #1 - kmeans clustering algorithm
+def do_minibatch_Kmeans(num_clusters, dataset, batch_size, max_no_improvement, random_state=None, init=None):
+    """
+    This function works like do_Kmeans, but fits the dataset with
+    mini-batch K-means: the centroids are updated from batch_size
+    random samples at a time instead of the whole dataset, which is
+    much faster for large datasets and gives nearly the same clusters.
+    Fitting stops early once max_no_improvement batches in a row have
+    not improved the (smoothed) inertia. init is used as in do_Kmeans.
+    Returns a mini-batch kmeans object, with the same attributes as
+    the kmeans object returned by do_Kmeans.
+    """
+    if init is not None:
+        return MiniBatchKMeans(n_clusters=num_clusters, batch_size=batch_size, max_no_improvement=max_no_improvement,
+                               init=init, n_init=1, random_state=random_state).fit(dataset)
+    return MiniBatchKMeans(n_clusters=num_clusters, batch_size=batch_size, max_no_improvement=max_no_improvement,
+                           random_state=random_state).fit(dataset)
+
+
+# linked to functional requirement #1 - kmeans clustering algorithm
+# linked to non-functional requirement #3 - accept up to 2000 files
+def stream_minibatch_Kmeans(num_clusters, matrix, batch_size, max_no_improvement, max_passes=100,
+                            random_state=None, init=None):
     """
-    kmeans = KMeans(n_clusters=num_clusters).fit(dataset)
+    This function fits mini-batch K-means to a block of spectra (a 2-D
+    array with one spectrum per row, e.g. a cube's memory-mapped matrix)
+    one batch of batch_size rows at a time, so only one batch is ever
+    read into memory. A block is stored in file path order, so its rows
+    come grouped by type; each pass over the block therefore visits the
+    rows in a fresh random order (drawn from random_state), like
+    sklearn's own mini-batches. Passes go on (up to max_passes) until
+    max_no_improvement batches in a row have not improved the inertia
+    of the batches, smoothed over the last pass or so (like sklearn's
+    own early stopping). Then the labels of every row are found chunk by
+    chunk. Unless init is given (used as in do_Kmeans), the initial
+    centroids are picked by k-means++ from 3 * batch_size random rows
+    of the whole block, again like sklearn.
+    Returns a mini-batch kmeans object, with the same attributes as
+    the kmeans object returned by do_Kmeans.
+    """
+    random_state = check_random_state(random_state)
+    n_rows = matrix.shape[0]
+    if init is None:
+        sample = np.sort(random_state.choice(n_rows, min(n_rows, 3 * batch_size), replace=False))
+        init, _ = kmeans_plusplus(np.asarray(matrix[sample]), num_clusters, random_state=random_state)
+    kmeans = MiniBatchKMeans(n_clusters=num_clusters, batch_size=batch_size, init=init, n_init=1,
+                             random_state=random_state)
+    best_inertia = smoothed_inertia = None
+    no_improvement = 0
+    for _ in range(max_passes):
+        # every batch has to have a row for every cluster
+        for _, _, batch in dataops.iter_row_chunks(random_state.permutation(n_rows), batch_size, num_clusters):
+            # rows read in file order, which is faster for a memory-mapped block
+            rows = np.asarray(matrix[np.sort(batch)])
+            kmeans.partial_fit(rows)
+            # mean inertia of the batch's rows, smoothed over about
+            # one pass of batches
+            inertia = -kmeans.score(rows) / len(rows)
+            if smoothed_inertia is None:
+                smoothed_inertia = inertia
+            else:
+                alpha = min(1.0, 2 * len(rows) / (n_rows + 1))
+                smoothed_inertia = smoothed_inertia * (1 - alpha) + inertia * alpha
+            if best_inertia is None or smoothed_inertia < best_inertia:
+                best_inertia = smoothed_inertia
+                no_improvement = 0
+            else:
+                no_improvement += 1
+            if no_improvement >= max_no_improvement:
+                break
+        if no_improvement >= max_no_improvement:
+            break
+    labels = np.empty(n_rows, dtype=np.int32)
+    inertia = 0.0
+    for start, stop, rows in dataops.iter_row_chunks(matrix, batch_size):
+        labels[start:stop] = kmeans.predict(rows)
+        inertia -= kmeans.score(rows)
+    kmeans.labels_ = labels
+    kmeans.inertia_ = inertia
     return kmeans
 
 
+# linked to functional requirement #1 - kmeans clustering algorithm
+def kmeans_plusplus_rows(dataset, num_clusters, random_state=None):
+    """
+    This function picks num_clusters rows of a dataset (a 2-D array or
+    a dataframe) as initial centroids the way K-means does (k-means++).
+    The same rows of another version of the dataset (e.g. in another
+    precision) can then start K-means on it from the same place.
+    Returns a numpy array of the row numbers.
+    """
+    _, rows = kmeans_plusplus(np.asarray(dataset), num_clusters, random_state=random_state)
+    return rows
+
+
+# linked to functional requirement #1 - kmeans clustering algorithm
+def warm_start_centers(matrix, keys, previous_keys, previous_labels, num_clusters, chunk_rows=1024):
+    """
+    This function works out num_clusters initial centroids for K-means
+    on a block of spectra (a 2-D array with one spectrum per row, or
+    a dataframe) from the clusters of a previous run, so that K-means
+    starts close to where that run ended.
+    keys identifies each row of matrix (e.g. its file path), and
+    previous_keys and previous_labels each spectrum of the previous run
+    and the cluster it was in. The centroid of each previous cluster is
+    the mean of its spectra in matrix, so it is in the current
+    pre-processing (normalization, PCA dimensions, ...) even if that has
+    changed. Spectra new since the previous run are left out, and a
+    cluster with none of its spectra left is dropped.
+    While there are too few centroids, the cluster with the largest
+    inertia is split: its spectrum farthest from the centroid becomes
+    a new centroid. While there are too many, the two closest centroids
+    are merged into the mean of their spectra.
+    matrix is read chunk_rows rows at a time, so it can be memory-mapped.
+    Returns an array of num_clusters x n_features, or None if none of
+    the spectra of the previous run are in matrix.
+    """
+    matrix = matrix.to_numpy() if isinstance(matrix, pd.DataFrame) else matrix
+    previous = pd.Series(np.asarray(previous_labels), index=pd.Index(previous_keys))
+    previous = previous[~previous.index.duplicated()]
+    labels = previous.reindex(pd.Index(keys)).to_numpy()
+    kept = ~pd.isna(labels)
+    if not kept.any():
+        return None
+    # number the previous clusters still there from 0, -1 for new spectra
+    _, codes = np.unique(labels[kept].astype(int), return_inverse=True)
+    cluster_of = np.full(len(labels), -1)
+    cluster_of[kept] = codes
+    sizes = np.bincount(codes).astype(float)
+    centers = np.zeros((len(sizes), matrix.shape[1]))
+    for start, stop, rows in dataops.iter_row_chunks(matrix, chunk_rows):
+        inside = cluster_of[start:stop] >= 0
+        np.add.at(centers, cluster_of[start:stop][inside], rows[inside])
+    centers /= sizes[:, np.newaxis]
+    while len(centers) > num_clusters:
+        distances = euclidean_distances(centers, squared=True)
+        np.fill_diagonal(distances, np.inf)
+        first, second = np.unravel_index(distances.argmin(), distances.shape)
+        centers[first] = (centers[first] * sizes[first] + centers[second] * sizes[second]) / \
+            (sizes[first] + sizes[second])
+        sizes[first] += sizes[second]
+        centers = np.delete(centers, second, axis=0)
+        sizes = np.delete(sizes, second)
+    while len(centers) < num_clusters:
+        nearest, distances = _nearest_centers(matrix, centers, chunk_rows)
+        largest = np.bincount(nearest, weights=distances, minlength=len(centers)).argmax()
+        farthest = np.where(nearest == largest, distances, -1).argmax()
+        centers = np.vstack([centers, matrix[farthest]])
+    return centers
+
+
+def _nearest_centers(matrix, centers, chunk_rows):
+    """
+    Returns (index of the nearest center, squared distance to it) for
+    every row of matrix, reading chunk_rows rows at a time.
+    """
+    nearest = np.empty(matrix.shape[0], dtype=int)
+    distances = np.empty(matrix.shape[0])
+    for start, stop, rows in dataops.iter_row_chunks(matrix, chunk_rows):
+        chunk_distances = euclidean_distances(rows, centers, squared=True)
+        nearest[start:stop] = chunk_distances.argmin(axis=1)
+        distances[start:stop] = chunk_distances[np.arange(stop - start), nearest[start:stop]]
+    return nearest, distances
+
+
+# linked to functional requirement #1 - kmeans clustering algorithm
+def kmeans_sweep(k_values, dataset, engine, batch_size, max_no_improvement, silhouette_sample, workers=None):
+    """
+    This function clusters the dataset (n_samples x n_features) once
+    for every number of clusters in k_values, with the K-means engine
+    named engine (one of KMEANS_ENGINES, see do_Kmeans and
+    do_minibatch_Kmeans for batch_size and max_no_improvement).
+    The K values are spread over a pool of worker processes (workers
+    None means one per CPU core, 1 means run in this process without a
+    pool); each worker gets a copy of the dataset once, and an equal
+    share of the CPU cores for its own threads. If the dataset is a
+    memory-mapped .npy file (e.g. a cube's matrix), each worker maps
+    the file itself instead, so it is shared through the page cache
+    rather than copied into every worker.
+    For every K the inertia, the silhouette score and the time the fit
+    took are recorded. The silhouette score needs the distances between
+    all pairs of samples, so it is worked out on a random sample of
+    silhouette_sample samples if there are more.
+    Returns a tuple (dataframe of inertia, silhouette and seconds with
+    one row per K, dict of the kmeans object fitted for each K).
+    """
+    global _sweep
+    k_values = list(k_values)
+    if workers is None:
+        workers = os.cpu_count() or 1
+    workers = max(1, min(workers, len(k_values)))
+    if workers > 1 and isinstance(dataset, np.memmap) and str(dataset.filename).endswith(".npy"):
+        matrix = str(dataset.filename)
+    else:
+        matrix = np.asarray(dataset)
+    settings = (matrix, engine, batch_size, max_no_improvement, silhouette_sample)
+    # the biggest K values take the longest, so they are started first
+    order = sorted(k_values, reverse=True)
+    if workers > 1:
+        threads = max(1, (os.cpu_count() or 1) // workers)
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_sweep_worker,
+                                 initargs=settings + (threads,)) as executor:
+            results = list(executor.map(_sweep_one, order))
+    else:
+        _init_sweep_worker(*settings)
+        try:
+            results = [_sweep_one(k) for k in order]
+        finally:
+            # don't keep the dataset alive after the sweep
+            _sweep = None
+    results.sort(key=lambda result: result[0])
+    metrics = pd.DataFrame([result[2:] for result in results], columns=["inertia", "silhouette", "seconds"],
+                           index=pd.Index([result[0] for result in results], name="K"))
+    return metrics, {result[0]: result[1] for result in results}
+
+
+def _init_sweep_worker(matrix, engine, batch_size, max_no_improvement, silhouette_sample, threads=None):
+    """
+    Keeps the block of spectra (or maps it, if matrix is the name of a
+    .npy file) and the settings of a K sweep for _sweep_one, and limits
+    the threads the worker process uses.
+    Must stay a module level function so it can be sent to worker processes.
+    """
+    global _sweep
+    if isinstance(matrix, str):
+        matrix = np.load(matrix, mmap_mode="r")
+    _sweep = (matrix, engine, batch_size, max_no_improvement, silhouette_sample)
+    if threads is not None:
+        threadpool_limits(threads)
+
+
+def _sweep_one(num_clusters):
+    """
+    Clusters the block of spectra of the K sweep (see _init_sweep_worker)
+    into num_clusters clusters.
+    Returns a tuple (num_clusters, kmeans object, inertia, silhouette
+    score, seconds the fit took).
+    Must stay a module level function so it can be sent to worker processes.
+    """
+    matrix, engine, batch_size, max_no_improvement, silhouette_sample = _sweep
+    start = time.perf_counter()
+    if engine == "Mini-batch K-means":
+        kmeans = do_minibatch_Kmeans(num_clusters, matrix, batch_size, max_no_improvement)
+    else:
+        kmeans = do_Kmeans(num_clusters, matrix)
+    seconds = time.perf_counter() - start
+    if 1 < len(np.unique(kmeans.labels_)) < matrix.shape[0]:
+        sample_size = silhouette_sample if matrix.shape[0] > silhouette_sample else None
+        silhouette = silhouette_score(matrix, kmeans.labels_, sample_size=sample_size, random_state=0)
+    else:
+        # the silhouette score is only defined for 2 to n_samples - 1 clusters
+        silhouette = np.nan
+    return num_clusters, kmeans, kmeans.inertia_, silhouette, seconds
+
+
 # linked to functional requirement #1 - kmeans clustering algorithm
 # linked to functional requirement #12 - calculate cluster composition
 def calculate_composition(km, num_clusters, data_objects, sort_category):
@@ -104,6 +386,16 @@ def do_comprehensive(cluster, dobjs):
     return df
 
 
+def _refit_for_plot(km, dataset):
+    """
+    Fits a copy of the kmeans object km to the plotted (reduced) dataset.
+    A warm-started km has starting centers of the full dimension, so the
+    copy goes back to the default k-means++ starting centers; km itself is
+    left as it was.
+    """
+    return clone(km).set_params(init="k-means++", n_init="auto").fit(dataset)
+
+
 # linked to functional requirement #11 - visualize clustered data
 # linked to non-functional requirement #2 - perform visualization in under 5 minutes
 # linked to non-functional requirement #6 - support up to 100 different colors for visualization
@@ -127,7 +419,7 @@ def plot2D(dataset, km, embedded=False, master=None):
 
     cx = []
     cy = []
-    km = km.fit(dataset)  # refit to reduced data for centroids
+    km = _refit_for_plot(km, dataset)  # refit to reduced data for centroids
     for i in km.cluster_centers_:
         cx.append(i[0])
         cy.append(i[1])
@@ -173,7 +465,7 @@ def plot3D(dataset, km, embedded=False, master=None):
     cx = []
     cy = []
     cz = []
-    km = km.fit(dataset)  # refit to reduced data for centroids
+    km = _refit_for_plot(km, dataset)  # refit to reduced data for centroids
     for i in km.cluster_centers_:
         cx.append(i[0])
         cy.append(i[1])
@@ -194,3 +486,42 @@ def plot3D(dataset, km, embedded=False, master=None):
     else:
         plt.show()
         return None
+
+
+# linked to functional requirement #11 - visualize clustered data
+def plot_sweep(metrics, embedded=False, master=None):
+    """
+    This function takes the dataframe of metrics of a K sweep (see
+    kmeans_sweep) and plots the inertia (elbow curve) and the
+    silhouette score against K, marking the K with the best silhouette.
+    If embedded is False, the the plot is displayed in a standalone
+    modal window, master is ignored, and the function returns None.
+    If embedded is True, master must be specified (the parent widget
+    for the canvas), and the function returns a canvas object
+    to be displayed in the GUI.
+    """
+    if embedded:
+        figure = Figure()
+        canvas = FigureCanvasTkAgg(figure, master=master)
+        canvas.draw()
+        axes = figure.add_subplot()
+    else:
+        figure, axes = plt.subplots()
+
+    axes.plot(metrics.index, metrics["inertia"], marker="o", color="tab:blue")
+    axes.set_xlabel("Number of clusters (K)")
+    axes.xaxis.set_major_locator(MaxNLocator(integer=True))
+    axes.set_ylabel("Inertia", color="tab:blue")
+    silhouette_axes = axes.twinx()
+    silhouette_axes.plot(metrics.index, metrics["silhouette"], marker="s", color="tab:orange")
+    silhouette_axes.set_ylabel("Silhouette score", color="tab:orange")
+    if metrics["silhouette"].notna().any():
+        best = metrics["silhouette"].idxmax()
+        silhouette_axes.axvline(best, color="gray", linestyle="--")
+        axes.set_title("Best silhouette at K = %s" % best)
+
+    if embedded:
+        return canvas
+    else:
+        plt.show()
+        return None
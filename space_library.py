@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+# 
+# Spectral Analysis Clustering Explorer (SpACE)
+# Missouri State University
+# CSC450 Fall 2020 - Dr. Razib Iqbal
+#
+# Team 2 (FTIR/ECOSTRESS/SpACE team):
+# Austin Alvidrez
+# Brad Meyer
+# Collin Tinen
+# Kegan Moore
+# Sam Nack
+#
+# Copyright 2020 Austin Alvidrez, Brad Meyer, Collin Tinen,
+# Kegan Moore, Sam Nack
+#
+# Spectral Analysis Clustering Explorer (SpACE) is free software:
+# you can redistribute it and/or modify it under the terms of the
+# GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Spectral Analysis Clustering Explorer (SpACE) is distributed in
+# the hope that it will be useful, but WITHOUT ANY WARRANTY;
+# without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Spectral Analysis Clustering Explorer (SpACE).
+# If not, see <https://www.gnu.org/licenses/>.
+
+
+# space_library.py
+# This file contains the compact container for a library of spectra.
+#
+# Includes: a spectral library that keeps every aligned spectrum in one
+# contiguous matrix with one shared wavelength axis and one metadata
+# table (a column per header field, parsed from the raw headers of the
+# source files only when it is first used), instead of a list of DataObjects
+# each holding its own dataframes. Each spectrum is reached through a
+# small view object with the same filename, path, pairs and descriptive
+# attributes as a DataObject, so code written for a list of DataObjects
+# works with a library too.
+
+import numpy as np
+import pandas as pd
+import space_data_ops as dataops
+from space_metadata import metadata_table
+
+
+# linked to functional requirement #3 - preprocessing of data files into data objects
+class SpectralLibrary:
+    """
+    A library of aligned spectra.
+    matrix holds one spectrum per row (in memory or memory-mapped),
+    wavelengths is the shared x axis (one per column of matrix),
+    table has the path, filename and y units label of each row, and
+    headers has the raw header of the source file of each row (or None
+    where it is not known, e.g. for a saved block).
+    descriptive is the metadata table parsed from the headers (see
+    space_metadata.metadata_table), with one column per header field,
+    or None if no header is known. The headers are only parsed the
+    first time it is used.
+    Indexing or iterating over the library gives SpectrumView objects.
+    """
+
+    def __init__(self, matrix, wavelengths, table, headers=None):
+        self.matrix = matrix
+        self.wavelengths = pd.Index(wavelengths, name='wavelength')
+        self.table = table.reset_index(drop=True)
+        self.headers = headers
+        self._descriptive = None
+
+    @property
+    def descriptive(self):
+        if self._descriptive is None and self.headers is not None:
+            self._descriptive = metadata_table(self.headers)
+        return self._descriptive
+
+    @classmethod
+    def from_dataset(cls, dataset, data_objects):
+        """Makes a library from a combined dataframe (one row per data
+        object, see space_data_ops.combine) and the aligned data objects
+        it was combined from. The dataset's values are used as the
+        matrix without copying them where pandas allows it."""
+        table = pd.DataFrame({"path": [dobj.path for dobj in data_objects],
+                              "filename": [dobj.filename for dobj in data_objects],
+                              "y_units": [dobj.pairs.columns[0] for dobj in data_objects]})
+        return cls(dataset.to_numpy(), dataset.columns, table,
+                   [getattr(dobj, "header", None) for dobj in data_objects])
+
+    def __len__(self):
+        return self.matrix.shape[0]
+
+    def __getitem__(self, row):
+        if row < 0:
+            row += len(self)
+        if not 0 <= row < len(self):
+            raise IndexError("spectral library index out of range")
+        return SpectrumView(self, row)
+
+    def __iter__(self):
+        for row in range(len(self)):
+            yield SpectrumView(self, row)
+
+    def normalized(self, normalization):
+        """Returns a new library with a normalized copy of the matrix,
+        normalized with the normalization type named normalization (a key
+        of space_data_ops.NORMALIZATION_TYPES). This library is not
+        changed."""
+        matrix = np.array(self.matrix)
+        dataops.NORMALIZATION_TYPES[normalization](matrix)
+        return SpectralLibrary(matrix, self.wavelengths, self.table, self.headers)
+
+    def as_dataframe(self):
+        """Returns the matrix as a dataframe shaped like the one built by
+        space_data_ops.combine, without copying it."""
+        return pd.DataFrame(self.matrix, columns=self.wavelengths, copy=False)
+
+
+class SpectrumView:
+    """
+    One spectrum of a SpectralLibrary, with the attributes of a
+    DataObject. 'pairs' is a dataframe indexed by wavelength that is a
+    view of the spectrum's row of the library matrix, made each time it
+    is asked for. 'descriptive' is the (descriptor, value) dataframe of
+    the header fields, also made on demand from the library's metadata
+    table, or "None" if the library has no header fields.
+    """
+
+    __slots__ = ("library", "row")
+
+    def __init__(self, library, row):
+        self.library = library
+        self.row = row
+
+    @property
+    def path(self):
+        return self.library.table.at[self.row, "path"]
+
+    @property
+    def filename(self):
+        return self.library.table.at[self.row, "filename"]
+
+    @property
+    def pairs(self):
+        return dataops.pairs_view(self.library.matrix[self.row], self.library.wavelengths,
+                                  self.library.table.at[self.row, "y_units"])
+
+    @property
+    def header(self):
+        return None if self.library.headers is None else self.library.headers[self.row]
+
+    @property
+    def descriptive(self):
+        if self.library.descriptive is None:
+            return "None"
+        fields = self.library.descriptive.iloc[self.row].dropna()
+        return pd.DataFrame({"descriptor": list(fields.index),
+                             "value": list(fields)}).convert_dtypes(convert_string=True)
+
+    def __str__(self):
+        return self.path
@@ -45,11 +45,50 @@ CONFIG = {
     "APP_VERSION": "1.0.0",
     "PCA_BY_DEFAULT": False,
     "DEFAULT_PCA_DIMENSIONS": 8,
+    "PCA_BY_VARIANCE_BY_DEFAULT": False,
+    "DEFAULT_PCA_VARIANCE": 99.0,
+    "PCA_SOLVER": "auto",
+    "PCA_MAX_RETRIES": 3,
+    "INCREMENTAL_PCA": False,
+    "INCREMENTAL_PCA_CHUNK_ROWS": 512,
     "SAVE_AFTER_DATA_MODIFICATION_BY_DEFAULT": False,
     "DEFAULT_KMEANS_K": 8,
+    "DEFAULT_KMEANS_ENGINE": "K-means",
+    "MINIBATCH_KMEANS_BATCH_SIZE": 1024,
+    "MINIBATCH_KMEANS_MAX_NO_IMPROVEMENT": 10,
+    "MINIBATCH_KMEANS_STREAMING": True,
+    "KMEANS_WARM_START_BY_DEFAULT": False,
+    "DEFAULT_KMEANS_SWEEP_MIN": 2,
+    "DEFAULT_KMEANS_SWEEP_MAX": 12,
+    "KMEANS_SWEEP_WORKERS": None,
+    "KMEANS_SWEEP_SILHOUETTE_SAMPLE": 2000,
     "DEFAULT_DBSCAN_EPS": 1.0,
     "DEFAULT_DBSCAN_MINPTS": 3,
     "DEFAULT_INPUT_PATH": None,
+    "DEFAULT_ALIGNMENT_TARGET": "Highest resolution",
+    "DEFAULT_GRID_STEP": 0.01,
+    "DEFAULT_GRID_POINTS": 1000,
+    "GRID_BIN_AVERAGE_BY_DEFAULT": False,
+    "DEFAULT_PRECISION": "float64",
+    "PRECISION_REPORT": False,
+    "USE_FILE_MANIFEST": False,
+    "FILE_MANIFEST_NAME": "file_manifest.txt",
+    "IMPORT_WORKERS": None,
+    "IMPORT_CHUNK_SIZE": None,
+    "STREAMING_IMPORT": True,
+    "HEADER_PRESCAN": True,
+    "INCREMENTAL_IMPORT": False,
+    "STAGE_CACHE": True,
+    "STAGE_CACHE_KEEP_ALIGNED": False,
+    "USE_PARSE_CACHE": True,
+    "PARSE_CACHE_FOLDER": None,
+    "PARSE_CACHE_MAX_MB": 512,
+    "DISK_BACKED_DATASET": False,
+    "DISK_BACKEND_FOLDER": None,
+    "DISK_BACKEND_CHUNK_ROWS": 256,
+    "BACKGROUND_SAVING": True,
+    "SAVE_WORKERS": 2,
+    "SAVE_BATCH_SIZE": 16,
     "KMEANS_SAVING": {"save": True,
                       "comp": True,
                       "by_type": True,
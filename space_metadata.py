@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+# 
+# Spectral Analysis Clustering Explorer (SpACE)
+# Missouri State University
+# CSC450 Fall 2020 - Dr. Razib Iqbal
+#
+# Team 2 (FTIR/ECOSTRESS/SpACE team):
+# Austin Alvidrez
+# Brad Meyer
+# Collin Tinen
+# Kegan Moore
+# Sam Nack
+#
+# Copyright 2020 Austin Alvidrez, Brad Meyer, Collin Tinen,
+# Kegan Moore, Sam Nack
+#
+# Spectral Analysis Clustering Explorer (SpACE) is free software:
+# you can redistribute it and/or modify it under the terms of the
+# GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Spectral Analysis Clustering Explorer (SpACE) is distributed in
+# the hope that it will be useful, but WITHOUT ANY WARRANTY;
+# without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Spectral Analysis Clustering Explorer (SpACE).
+# If not, see <https://www.gnu.org/licenses/>.
+
+# space_metadata.py
+# This file contains functions that parse the header (descriptive data)
+# of an ECOSTRESS spectrum file.
+#
+# Includes: parse one raw header into a descriptive DataFrame on demand,
+# look up single header fields without parsing the whole header, and
+# parse the headers of many files at once into one metadata table.
+# Headers are kept as the raw bytes read from the file (see DataObject.py)
+# and only parsed when something asks for the descriptive data.
+
+from io import StringIO
+import pandas as pd
+
+# columns include overflow for extra ":" characters found in the description field
+columns = ['descriptor', 'value', 'overflow', 'overflow2', 'overflow3']
+
+
+# linked to functional requirement #3 - preprocessing of data files
+def parse_header(header):
+    """
+    This function takes the raw header of one ECOSTRESS file (the bytes
+    above the xy_pairs) and converts it into the descriptive DataFrame
+    of a DataObject, with one (descriptor, value) row per header line.
+    Returns the descriptive DataFrame.
+    """
+    descriptive_data = pd.read_csv(StringIO(header.decode("utf-8")), sep=":", header=None, engine="python",
+                                   names=columns, quotechar='"')
+    first_col = descriptive_data['descriptor']
+    # find the index for the description field for description processing
+    desc_rows = first_col[first_col == "Description"]
+    desc_index = desc_rows.index[0] if len(desc_rows) > 0 else 0
+    descriptive_data = _merge_description_overflow(descriptive_data, desc_index)
+
+    # DataFrame values are initially typed as objects, convert descriptive data to strings
+    return descriptive_data.convert_dtypes(convert_string=True)
+
+
+def _merge_description_overflow(descriptive_data, desc_index):
+    """
+    Description Processing: for DataFrame conversion, overflow columns were needed
+    for the descriptions of each spectra, this function removes the overflow.
+    Returns the descriptive DataFrame without the overflow columns.
+    """
+    # Make a copy, this is recommended by pandas documentation for modifying individual cells
+    descriptive_copy = descriptive_data.copy()
+    # if overflow is nan, drop overflow columns
+    if pd.isna(descriptive_data.loc[desc_index, 'overflow']):
+        descriptive_data = descriptive_data.dropna(axis=1)
+
+    # if overflow2 is nan, combine value and overflow for description, and drop overflow columns
+    elif pd.isna(descriptive_data.loc[desc_index, 'overflow2']):
+        combine_string = ': ' + descriptive_data.loc[desc_index, 'overflow']
+        descriptive_copy.loc[desc_index, 'value'] = descriptive_data.loc[desc_index, 'value'] + combine_string
+        descriptive_data = descriptive_copy.drop(['overflow', 'overflow2', 'overflow3'], axis=1)
+
+    # if overflow3 is nan, combine value and overflow1 and 2 for description, and drop overflow columns
+    elif pd.isna(descriptive_data.loc[desc_index, 'overflow3']):
+        combine_string = ': ' + descriptive_data.loc[desc_index, 'overflow'] + ': ' + \
+                         descriptive_data.loc[desc_index, 'overflow2']
+        descriptive_copy.loc[desc_index, 'value'] = descriptive_data.loc[desc_index, 'value'] + combine_string
+        descriptive_data = descriptive_copy.drop(['overflow', 'overflow2', 'overflow3'], axis=1)
+
+    # else combine all overflow columns with value, and drop overflow columns
+    else:
+        combine_string = ': ' + descriptive_data.loc[desc_index, 'overflow'] + ': ' + \
+                         descriptive_data.loc[desc_index, 'overflow2'] + ': ' + \
+                         descriptive_data.loc[desc_index, 'overflow3']
+        descriptive_copy.loc[desc_index, 'value'] = descriptive_data.loc[desc_index, 'value'] + combine_string
+        descriptive_data = descriptive_copy.drop(['overflow', 'overflow2', 'overflow3'], axis=1)
+
+    return descriptive_data
+
+
+def header_field(header_text, descriptor):
+    """
+    Looks up the value of one field in the text of a header, the same
+    value parse_header gives it, without parsing the rest of the header.
+    Returns the value, or None if the header has no such field.
+    """
+    for line in header_text.splitlines():
+        fields = line.split(":")
+        if fields[0] == descriptor:
+            return fields[1] if len(fields) > 1 else None
+    return None
+
+
+# linked to functional requirement #3 - preprocessing of data files
+def metadata_table(headers):
+    """
+    Parses the raw headers of many files (bytes, or None for a file
+    without one) at once into one metadata table, with a row per header
+    and a column per descriptor, in the order the descriptors are first
+    seen. Only the first of a repeated descriptor is kept. The values
+    are the same as parse_header gives, but are collected column by
+    column and stored as categoricals, since most fields (type, class,
+    units, etc.) repeat across the files of a library.
+    Returns the table, or None if none of the headers is known.
+    """
+    table = {}
+    for row, header in enumerate(headers):
+        if header is None:
+            continue
+        lines = [line.split(":") for line in header.decode("utf-8").splitlines() if line != ""]
+        descriptors = [fields[0] for fields in lines]
+        # the description (or the first line, if there is none) may hold extra ":" characters
+        desc_index = descriptors.index("Description") if "Description" in descriptors else 0
+        for index, fields in enumerate(lines):
+            column = table.setdefault(fields[0], {})
+            if row in column:
+                continue
+            if len(fields) < 2 or fields[1] == "":
+                column[row] = None
+            elif index == desc_index:
+                column[row] = ": ".join(fields[1:len(columns)])
+            else:
+                column[row] = fields[1]
+    if not table:
+        return None
+    return pd.DataFrame({descriptor: pd.Categorical([column.get(row) for row in range(len(headers))])
+                         for descriptor, column in table.items()})
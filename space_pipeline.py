@@ -0,0 +1,360 @@
+# -*- coding: utf-8 -*-
+# 
+# Spectral Analysis Clustering Explorer (SpACE)
+# Missouri State University
+# CSC450 Fall 2020 - Dr. Razib Iqbal
+#
+# Team 2 (FTIR/ECOSTRESS/SpACE team):
+# Austin Alvidrez
+# Brad Meyer
+# Collin Tinen
+# Kegan Moore
+# Sam Nack
+#
+# Copyright 2020 Austin Alvidrez, Brad Meyer, Collin Tinen,
+# Kegan Moore, Sam Nack
+#
+# Spectral Analysis Clustering Explorer (SpACE) is free software:
+# you can redistribute it and/or modify it under the terms of the
+# GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Spectral Analysis Clustering Explorer (SpACE) is distributed in
+# the hope that it will be useful, but WITHOUT ANY WARRANTY;
+# without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Spectral Analysis Clustering Explorer (SpACE).
+# If not, see <https://www.gnu.org/licenses/>.
+
+
+# space_pipeline.py
+# This file contains the streaming import pipeline.
+#
+# Includes: a two pass pipeline that takes ECOSTRESS files through the
+# stages in space_data_ops.py one spectrum at a time. The first pass
+# parses and re-indexes the files and finds the common range and the
+# highest resolution file. The second pass truncates, aligns and
+# normalizes each spectrum and writes it straight into its row of an
+# output matrix that is allocated once, in memory or as a memory-mapped
+# cube (see space_cube.py). An incremental update brings saved aligned
+# and normalized blocks up to date with only the new or changed files.
+
+import os.path
+import shutil
+import numpy as np
+import pandas as pd
+import space_data_ops as dataops
+import space_file_ops as fileops
+import space_cube as cube_ops
+from space_cube import SpectralCube
+from space_align import AlignmentEngine
+
+
+# linked to functional requirement #3 - preprocessing of data files
+# linked to functional requirement #6 - data normalization
+def scan_spectra(file_list, error_report, workers=None, chunk_size=None, cache=None, x_range=None):
+    """
+    First pass of the pipeline. Streams the files in file_list through
+    the parse and re-index stages (see space_data_ops.iter_parse for
+    workers, chunk_size, cache and error_report), then finds the common
+    range and the data object with the most data points inside it.
+    If the common range is already known from a header prescan
+    (x_range, see space_data_ops.find_prescan_range), only the pairs
+    inside it are kept while parsing, so the data objects come out
+    truncated; files with no pairs inside it are reported and skipped.
+    Every parsed spectrum is held in memory until the second pass, as
+    the common range and the file to align to can only be known once
+    all of them are parsed; if both are known before parsing (a header
+    prescan and a uniform grid), stream_spectra does it all in one pass
+    instead.
+    Returns a tuple (data_objects, range_min, range_max, align_to).
+    range_min, range_max and align_to are None if there is no common range.
+    """
+    data_objects = list(dataops.iter_reindex(dataops.iter_parse(file_list, error_report, workers,
+                                                                 chunk_size, cache, x_range)))
+    if x_range is not None:
+        data_objects = dataops.drop_out_of_range(data_objects, x_range, error_report)
+    if not data_objects:
+        return data_objects, None, None, None
+    if x_range is not None:
+        range_min, range_max = x_range
+    else:
+        range_min, range_max = dataops.find_common_range(data_objects)
+    if (range_min, range_max) == (None, None):
+        return data_objects, None, None, None
+    # same choice as find_max_res after truncate, without truncating anything yet
+    points_in_range = [len(dobj.pairs.loc[range_min:range_max]) for dobj in data_objects]
+    align_to = points_in_range.index(max(points_in_range))
+    return data_objects, range_min, range_max, align_to
+
+
+# linked to functional requirement #6 - data normalization
+def assemble_spectra(data_objects, range_min, range_max, align_to, normalization,
+                     out_folder=None, aligned_folder=None, grid=None, bin_average=False, aligned_info=None,
+                     truncated=False, dtype=float):
+    """
+    Second pass of the pipeline. Streams the data objects returned by
+    scan_spectra through the truncate and align stages, writes each one
+    into its row of the output matrix and normalizes it there in place
+    (see space_data_ops.NORMALIZATION_TYPES).
+    The truncate stage is skipped if the data objects are already
+    truncated to the range (truncated=True).
+    Spectra are aligned to the data object at index align_to, or to
+    the wavelengths in grid if one is given (see
+    space_data_ops.align_to_grid), averaging over bins if bin_average
+    is True.
+    The output matrix is allocated once, with the given dtype (see
+    space_data_ops.PRECISION_TYPES), in memory, or as a cube in
+    out_folder if one is given. If aligned_folder is given, the aligned
+    rows (before normalization) are also written to a spectral block
+    there, like space_file_ops.save_spectral_block does, with
+    aligned_info (see aligned_block_info) saved as its info.
+    As each row is written, the data object's 'pairs' dataframe is
+    replaced with a view of that row, so the intermediate dataframes
+    of one spectrum are freed before the next one is processed.
+    Returns a tuple (combined dataframe, like space_data_ops.combine
+    returns, cube or None).
+    """
+    if grid is None:
+        alignment_pairs = data_objects[align_to].pairs.truncate(before=range_min, after=range_max,
+                                                                axis='index', copy=True)
+        engine = None
+    else:
+        alignment_pairs = pd.DataFrame(index=pd.Index(grid, name='wavelength'))
+        engine = AlignmentEngine(grid, by_wavelength=True, bin_average=bin_average)
+    wavelength_index = alignment_pairs.index
+    wavelengths = wavelength_index.to_numpy(dtype=float)
+    table = fileops.block_table(data_objects)
+    cube = None
+    if out_folder is not None:
+        cube = SpectralCube.create(out_folder, wavelengths, table, dtype)
+        matrix = cube.matrix
+    else:
+        matrix = np.empty((len(data_objects), len(wavelengths)), dtype=dtype)
+
+    aligned_block = None
+    if aligned_folder is not None:
+        aligned_block = SpectralCube.create(aligned_folder, wavelengths, table, dtype)
+    stream = data_objects if truncated else dataops.iter_truncate(data_objects, range_min, range_max)
+    # aligned rows are resampled straight into the aligned block, if there is one
+    stream = dataops.iter_align(stream, alignment_pairs, None if aligned_block is None else aligned_block.matrix,
+                                engine, dtype)
+    _normalize_into(stream, matrix, wavelength_index, normalization)
+
+    if aligned_block is not None:
+        aligned_block.flush()
+        fileops.write_block_info(aligned_folder, aligned_info)
+    if cube is not None:
+        cube.flush()
+    return pd.DataFrame(matrix, columns=wavelength_index, copy=False), cube
+
+
+# linked to functional requirement #3 - preprocessing of data files
+# linked to functional requirement #6 - data normalization
+def stream_spectra(file_list, error_report, x_range, grid, normalization, workers=None, chunk_size=None,
+                   cache=None, out_folder=None, aligned_folder=None, bin_average=False, aligned_info=None,
+                   dtype=float):
+    """
+    Both passes of the pipeline in one, for when the common range is
+    known before parsing (x_range, from a header prescan) and the
+    spectra are aligned to a uniform grid of wavelengths inside it
+    (grid), so nothing about the other files is needed to align a
+    spectrum. Each file is parsed (as scan_spectra does), aligned,
+    written into its row of the output matrix and normalized there
+    before the next one is parsed, so besides the output matrix (and the
+    aligned block) only the spectra being parsed are in memory.
+    The arguments are used as in scan_spectra and assemble_spectra.
+    Rows are allocated for every file in file_list; the rows of files
+    that can't be loaded or have no data in the range are dropped at
+    the end (which rewrites a cube or aligned block if there are any).
+    Returns a tuple (data_objects, combined dataframe, cube or None).
+    """
+    wavelength_index = pd.Index(grid, name='wavelength')
+    alignment_pairs = pd.DataFrame(index=wavelength_index)
+    engine = AlignmentEngine(grid, by_wavelength=True, bin_average=bin_average)
+    wavelengths = wavelength_index.to_numpy(dtype=float)
+    # the real table is only known once the files are parsed
+    file_table = pd.DataFrame({"path": file_list})
+    cube = None
+    if out_folder is not None:
+        cube = SpectralCube.create(out_folder, wavelengths, file_table, dtype)
+        matrix = cube.matrix
+    else:
+        matrix = np.empty((len(file_list), len(wavelengths)), dtype=dtype)
+    aligned_block = None
+    if aligned_folder is not None:
+        aligned_block = SpectralCube.create(aligned_folder, wavelengths, file_table, dtype)
+
+    stream = dataops.iter_reindex(dataops.iter_parse(file_list, error_report, workers, chunk_size, cache, x_range))
+    stream = dataops.iter_drop_out_of_range(stream, x_range, error_report)
+    stream = dataops.iter_align(stream, alignment_pairs, None if aligned_block is None else aligned_block.matrix,
+                                engine, dtype)
+    data_objects = _normalize_into(stream, matrix, wavelength_index, normalization)
+
+    table = fileops.block_table(data_objects)
+    if aligned_block is not None:
+        aligned_block.resize(table)
+        aligned_block.flush()
+        fileops.write_block_info(aligned_folder, aligned_info)
+    if cube is not None:
+        if len(data_objects) < len(file_list):
+            # the rows are views of the matrix file about to be rewritten
+            for dobj in data_objects:
+                dobj.pairs = None
+            del matrix
+            cube.resize(table)
+            matrix = cube.matrix
+            for row, dobj in enumerate(data_objects):
+                dobj.pairs = dataops.pairs_view(matrix[row], wavelength_index, table["y_units"][row])
+        else:
+            cube.resize(table)
+        cube.flush()
+    else:
+        matrix = matrix[:len(data_objects)]
+    return data_objects, pd.DataFrame(matrix, columns=wavelength_index, copy=False), cube
+
+
+def _normalize_into(stream, matrix, wavelength_index, normalization):
+    """
+    Writes the aligned data objects from stream into consecutive rows
+    of matrix, normalizes each row there in place (see
+    space_data_ops.NORMALIZATION_TYPES) and replaces the data object's
+    'pairs' dataframe with a view of its row, so the intermediate
+    dataframes of one spectrum are freed before the next one is
+    processed.
+    Returns the list of data objects.
+    """
+    normalize_rows = dataops.NORMALIZATION_TYPES[normalization]
+    data_objects = []
+    for row, dobj in enumerate(iter_write_rows(stream, matrix)):
+        # normalized in place, in its row of the output matrix
+        normalize_rows(matrix[row:row + 1])
+        dobj.pairs = dataops.pairs_view(matrix[row], wavelength_index, dobj.pairs.columns[0])
+        data_objects.append(dobj)
+    return data_objects
+
+
+def aligned_block_info(range_min, range_max, alignment_target="Highest resolution", grid_value=None,
+                       bin_average=False, precision="float64"):
+    """
+    Returns the info saved with an aligned block (see
+    space_file_ops.write_block_info): the common range it was truncated
+    to and how it was aligned (a key of space_data_ops.ALIGNMENT_TARGETS,
+    the grid step or number of points, and bin averaging) and its
+    precision (a key of space_data_ops.PRECISION_TYPES), which
+    update_spectra needs to add more spectra to it the same way.
+    """
+    return {"range": [float(range_min), float(range_max)], "alignment_target": alignment_target,
+            "grid_value": grid_value, "bin_average": bin_average, "precision": precision}
+
+
+def iter_write_rows(data_objects, matrix):
+    """
+    Pipeline stage: copies the y values of each data object into the
+    next row of matrix and yields the data object.
+    """
+    for row, dobj in enumerate(data_objects):
+        matrix[row] = dobj.pairs.iloc[:, 0].to_numpy()
+        yield dobj
+
+
+# linked to functional requirement #3 - preprocessing of data files
+def find_block_changes(file_list, table):
+    """
+    Compares a list of files with the table of a spectral block
+    (see space_file_ops.block_table).
+    Returns a tuple (files that are new or changed since the block was
+    saved, rows of the block to keep, paths of rows whose file is gone).
+    A changed file's old row is not kept; its file is imported again.
+    A file that can't be looked at (e.g. it has disappeared since it
+    was listed) counts as changed, so the import reports it.
+    """
+    rows = {os.path.abspath(path): row for row, path in enumerate(table['path'])}
+    changed_files, keep_rows = [], []
+    for item in file_list:
+        row = rows.pop(os.path.abspath(item), None)
+        try:
+            stat = os.stat(item)
+        except OSError:
+            changed_files.append(item)
+            continue
+        if row is not None and 'mtime' in table and \
+                table['size'][row] == str(stat.st_size) and table['mtime'][row] == str(stat.st_mtime_ns):
+            keep_rows.append(row)
+        else:
+            changed_files.append(item)
+    keep_rows.sort()
+    return changed_files, keep_rows, [table['path'][row] for row in sorted(rows.values())]
+
+
+# linked to functional requirement #3 - preprocessing of data files
+# linked to functional requirement #6 - data normalization
+def update_spectra(file_list, aligned_folder, normalized_folder, normalization, error_report,
+                   workers=None, chunk_size=None, cache=None, chunk_rows=256):
+    """
+    Incremental import. Brings the aligned spectral block in
+    aligned_folder up to date with file_list: only the new or changed
+    files are parsed, truncated to the block's common range, resampled
+    onto its existing wavelength grid and appended to it. Rows of files that are gone are
+    dropped. Files that don't cover the whole grid can't be added
+    without a full import; they are reported in error_report.
+    The normalized block in normalized_folder is then updated the same
+    way if the normalization only looks at one spectrum at a time and
+    the block was made with the same normalization, otherwise it is
+    rebuilt from the aligned block in chunks of chunk_rows rows.
+    Returns a tuple (number of new or changed files added,
+    number of rows dropped).
+    """
+    aligned_matrix, wavelengths, table = fileops.load_spectral_block(aligned_folder)
+    dtype = aligned_matrix.dtype
+    del aligned_matrix
+    # the common range the block was truncated to, or its wavelengths if not known
+    info = fileops.read_block_info(aligned_folder)
+    range_min, range_max = info.get("range", [wavelengths[0], wavelengths[-1]])
+    changed_files, keep_rows, removed_paths = find_block_changes(file_list, table)
+    if not changed_files and not removed_paths and fileops.spectral_block_exists(normalized_folder) and \
+            fileops.read_block_info(normalized_folder).get("normalization") == normalization:
+        return 0, 0
+
+    # parse, re-index, truncate and align the new or changed files onto the existing grid
+    new_objects = []
+    for dobj in dataops.iter_reindex(dataops.iter_parse(changed_files, error_report, workers, chunk_size, cache)):
+        if dobj.pairs.index.min() > range_min or dobj.pairs.index.max() < range_max:
+            error_report.append(f"{dobj.path} does not cover the aligned range {range_min} to "
+                                f"{range_max}, a full import is needed to include it")
+        else:
+            new_objects.append(dobj)
+    alignment_pairs = pd.DataFrame(index=pd.Index(wavelengths, name='wavelength'))
+    engine = None
+    if dataops.ALIGNMENT_TARGETS.get(info.get("alignment_target")) is not None:
+        engine = AlignmentEngine(wavelengths, by_wavelength=True, bin_average=info.get("bin_average", False))
+    new_objects = list(dataops.iter_align(dataops.iter_truncate(new_objects, range_min, range_max),
+                                          alignment_pairs, engine=engine, dtype=dtype))
+    fileops.append_spectral_block(aligned_folder, new_objects, keep_rows)
+
+    if normalization in dataops.PER_SPECTRUM_NORMALIZATIONS and \
+            fileops.spectral_block_exists(normalized_folder) and \
+            fileops.read_block_info(normalized_folder).get("normalization") == normalization and \
+            _same_rows(fileops.load_spectral_block(normalized_folder)[2], table):
+        fileops.append_spectral_block(normalized_folder,
+                                      list(dataops.iter_normalize(new_objects, normalization)), keep_rows)
+    else:
+        # normalize a copy of the whole aligned block
+        if not fileops.path_exists(normalized_folder):
+            os.makedirs(normalized_folder)
+        for name in (fileops.BLOCK_MATRIX_FILE, fileops.BLOCK_WAVELENGTH_FILE, fileops.BLOCK_TABLE_FILE):
+            shutil.copyfile(os.path.join(aligned_folder, name), os.path.join(normalized_folder, name))
+        normalized_cube = SpectralCube.open(normalized_folder)
+        cube_ops.normalize_cube(normalized_cube, normalization, chunk_rows)
+        del normalized_cube
+    fileops.write_block_info(normalized_folder, {"normalization": normalization})
+    return len(new_objects), len(removed_paths)
+
+
+def _same_rows(table, other_table):
+    """Returns True if two block tables list the same files in the same order."""
+    return list(table['path']) == list(other_table['path'])
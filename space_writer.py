@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+# 
+# Spectral Analysis Clustering Explorer (SpACE)
+# Missouri State University
+# CSC450 Fall 2020 - Dr. Razib Iqbal
+#
+# Team 2 (FTIR/ECOSTRESS/SpACE team):
+# Austin Alvidrez
+# Brad Meyer
+# Collin Tinen
+# Kegan Moore
+# Sam Nack
+#
+# Copyright 2020 Austin Alvidrez, Brad Meyer, Collin Tinen,
+# Kegan Moore, Sam Nack
+#
+# Spectral Analysis Clustering Explorer (SpACE) is free software:
+# you can redistribute it and/or modify it under the terms of the
+# GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Spectral Analysis Clustering Explorer (SpACE) is distributed in
+# the hope that it will be useful, but WITHOUT ANY WARRANTY;
+# without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Spectral Analysis Clustering Explorer (SpACE).
+# If not, see <https://www.gnu.org/licenses/>.
+
+
+# space_writer.py
+# This file contains the background writer for saving files.
+#
+# Includes: a writer that runs save jobs (the save functions in
+# space_file_ops.py) on a small pool of background threads, so saving
+# does not hold up importing and clustering. Small jobs are grouped
+# into batches that run as one task, the number of batches waiting to
+# run is capped, and the result of every job is kept for the GUI to
+# log.
+
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+
+# linked to functional requirement #8 - saving data after modifications
+# linked to functional requirement #9 - saving clustered data
+class BackgroundWriter:
+    """
+    Runs save jobs on max_workers background threads.
+    Jobs added with submit() are collected into a batch that is handed
+    to the pool once it holds batch_size jobs, or when flush() is
+    called. At most max_pending batches wait for or run on the pool at
+    a time; submit() blocks until one finishes when the cap is reached.
+    The data a job saves must not be changed until the job is done
+    (see wait()).
+    The result of each job is a tuple (description, error message or
+    None on success); poll() returns the results that are ready.
+    """
+
+    def __init__(self, max_workers=2, batch_size=16, max_pending=8):
+        self.batch_size = batch_size
+        self.max_pending = max_pending
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._results = queue.Queue()
+        self._batch = []
+        self._lock = threading.Lock()
+        self._running = 0
+
+    def submit(self, description, func, *args):
+        """Adds the job func(*args) to the current batch. description
+        names the job in its result."""
+        self._batch.append((description, func, args))
+        if len(self._batch) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """Hands the current batch, if there is one, to the pool."""
+        if not self._batch:
+            return
+        batch, self._batch = self._batch, []
+        self._slots.acquire()
+        with self._lock:
+            self._running += len(batch)
+        self._executor.submit(self._run_batch, batch)
+
+    def _run_batch(self, batch):
+        """Runs the jobs of a batch one after another and records their results."""
+        try:
+            for description, func, args in batch:
+                try:
+                    func(*args)
+                    self._results.put((description, None))
+                except Exception as e:
+                    self._results.put((description, f"{type(e).__name__}: {e}"))
+                with self._lock:
+                    self._running -= 1
+        finally:
+            self._slots.release()
+
+    @property
+    def pending(self):
+        """The number of jobs that have not finished yet."""
+        with self._lock:
+            return self._running + len(self._batch)
+
+    def poll(self):
+        """Returns the list of results of the jobs that finished since
+        the last call."""
+        results = []
+        while True:
+            try:
+                results.append(self._results.get_nowait())
+            except queue.Empty:
+                return results
+
+    def wait(self):
+        """Flushes the current batch and blocks until every job has
+        finished. Returns the list of results not yet polled."""
+        self.flush()
+        # every batch holds a slot while it runs, so taking all the
+        # slots means the pool is idle
+        for _ in range(self.max_pending):
+            self._slots.acquire()
+        for _ in range(self.max_pending):
+            self._slots.release()
+        return self.poll()
+
+    def shutdown(self):
+        """Waits for every job to finish and stops the threads.
+        Returns the list of results not yet polled."""
+        results = self.wait()
+        self._executor.shutdown()
+        return results